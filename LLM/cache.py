@@ -0,0 +1,155 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator
+
+
+class ExtractionCache:
+    """
+    Persistent content-addressed cache of extraction responses, shared by the batch and the single-call paths.
+
+    Entries are keyed by a hash of the model, the system prompt, the user prompt template and the text (which together
+    identify the rendered request) and hold the raw response content, so a cached response can be formatted with any
+    schema. When the cache grows beyond max_size bytes the least recently used entries are evicted.
+
+    The batch path also records which key every custom_id was created with, so that the merge step can store new
+    responses and backfill the requests which were skipped as cache hits. The entries of these hits are pinned, they
+    are never evicted until the requests of their prefix are cleared by the next step_create_batches of the prefix.
+
+    :param path: str, the path of the SQLite database
+    :param max_size: int, the maximum total size of the cached responses in bytes
+    """
+
+    def __init__(self, path: str = "batch/cache.db", max_size: int = 1024 * 1024 * 1024):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries "
+                          "(key TEXT PRIMARY KEY, content TEXT, size INTEGER, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS requests (custom_id TEXT PRIMARY KEY, key TEXT, hit INTEGER)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS requests_key ON requests (key)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, prompt_system: str, prompt_user: str, text: str) -> str:
+        digest = hashlib.sha256()
+        for part in (model, prompt_system, prompt_user, text):
+            part = str(part).encode('utf-8')
+            # length prefixes keep the boundaries between the parts unambiguous
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            row = self.conn.execute("SELECT content FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def contains(self, key: str) -> bool:
+        with self.lock:
+            # touching the entry keeps it from being evicted before the merge step backfills it
+            hit = self.conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key)).rowcount > 0
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return hit
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def put(self, key: str, content: str, commit: bool = True):
+        size = len(content.encode('utf-8'))
+        with self.lock:
+            row = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO entries (key, content, size, accessed) VALUES (?, ?, ?, ?)",
+                              (key, content, size, time.time()))
+            self.size += size - (row[0] if row else 0)
+            if self.size > self.max_size:
+                self._evict()
+            if commit:
+                self.conn.commit()
+
+    def _evict(self):
+        # evict the least recently used entries down to 90% of max_size to avoid evicting on every put, the entries of
+        # the cache hits which the merge step has to backfill are pinned
+        target = self.size - int(self.max_size * 0.9)
+        keys = []
+        freed = 0
+        for key, size in self.conn.execute("SELECT key, size FROM entries WHERE key NOT IN "
+                                           "(SELECT key FROM requests WHERE hit = 1) ORDER BY accessed"):
+            if freed >= target:
+                break
+            keys.append((key,))
+            freed += size
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", keys)
+        self.size -= freed
+
+    def add_request(self, custom_id: str, key: str, hit: bool):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO requests (custom_id, key, hit) VALUES (?, ?, ?)",
+                              (custom_id, key, int(hit)))
+
+    def clear_requests(self, prefix: str = ""):
+        with self.lock:
+            self.conn.execute("DELETE FROM requests WHERE substr(custom_id, 1, ?) = ?", (len(prefix), prefix))
+            self.conn.commit()
+
+    def key_of(self, custom_id: str) -> str | None:
+        with self.lock:
+            row = self.conn.execute("SELECT key FROM requests WHERE custom_id = ?", (custom_id,)).fetchone()
+        return row[0] if row else None
+
+    def hit_ids(self) -> set:
+        """
+        custom_ids of the requests which were skipped as cache hits.
+        """
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT custom_id FROM requests WHERE hit = 1")}
+
+    def iter_hits(self) -> Iterator[tuple]:
+        """
+        Iterate (custom_id, content) of the requests which were skipped as cache hits.
+        """
+        self.commit()
+        # a separate connection streams the rows without holding the lock
+        conn = sqlite3.connect(self.path)
+        try:
+            yield from conn.execute("SELECT requests.custom_id, entries.content FROM requests "
+                                    "JOIN entries ON requests.key = entries.key WHERE requests.hit = 1")
+        finally:
+            conn.close()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def report(self) -> str:
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        rate = hits / total if total else 0
+        return f"Cache hits: {hits}, misses: {misses} ({rate:.1%} hit rate)"
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -1,17 +1,65 @@
-from langchain.prompts import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
-
-from LLM.models import llm_batch, llm_batch_ollama
+from LLM.cache import ExtractionCache
+from LLM.models import get_llm_batch, get_llm_ollama
 from schema.prompts import prompt_system_extractor, prompt_user_extractor
 from schema.schema import Object
+from schema.utils import format_json_response
+from settings import batch_model, ollama_model
+
+
+def cached_chain(chain_extractor, cache: ExtractionCache, model: str, prompt_system: str, prompt_user: str):
+    """
+    Wrap an extractor chain so that texts which are in the extraction cache return the cached response immediately.
+    """
+    from langchain_core.messages import AIMessage
+    from langchain_core.runnables import RunnableLambda
+
+    def lookup(text):
+        text = text["text"] if isinstance(text, dict) else text
+        key = cache.make_key(model, prompt_system, prompt_user, text)
+        return text, key, cache.get(key)
+
+    def store(key, message):
+        # only parsable responses are cached, like in the batch merge
+        if format_json_response(message.content) is not None:
+            cache.put(key, message.content)
+        return message
+
+    def invoke(text):
+        text, key, content = lookup(text)
+        if content is not None:
+            return AIMessage(content=content)
+        return store(key, chain_extractor.invoke(text))
 
+    async def ainvoke(text):
+        text, key, content = lookup(text)
+        if content is not None:
+            return AIMessage(content=content)
+        return store(key, await chain_extractor.ainvoke(text))
 
-def create_extractor_chain(scheme: Object = None, llm="zhipu",
+    return RunnableLambda(invoke, afunc=ainvoke)
+
+
+def create_extractor_chain(scheme: Object = None, llm: "str | Runnable" = "zhipu",
                            prompt_user: str = prompt_user_extractor,
-                           prompt_system: str = prompt_system_extractor):
+                           prompt_system: str = prompt_system_extractor,
+                           cache: ExtractionCache = None):
+    """
+    Create the extractor chain of a schema.
+
+    :param scheme: schema used to build the prompts
+    :param llm: "zhipu", "ollama" or any chat model, e.g. a ChatOpenAI pointed at a local OpenAI-compatible endpoint
+    :param prompt_user: user prompt used without schema
+    :param prompt_system: system prompt used without schema
+    :param cache: extraction cache returning cached responses without calling the model
+    """
+    # langchain is imported with the first chain only
+    from langchain.prompts import (
+        ChatPromptTemplate,
+        SystemMessagePromptTemplate,
+        HumanMessagePromptTemplate,
+    )
+    from langchain_core.runnables import Runnable
+
     prompt_system = prompt_system if not scheme else scheme.prompt_system
     prompt_user = prompt_user if not scheme else scheme.prompt_user
 
@@ -22,10 +70,17 @@ def create_extractor_chain(scheme: Object = None, llm="zhipu",
         ]
     )
     if llm == "zhipu":
-        chain_extractor = prompt_user_extractor | llm_batch
+        chain_extractor = prompt_user_extractor | get_llm_batch()
+        model = batch_model
     elif llm == "ollama":
-        chain_extractor = prompt_user_extractor | llm_batch_ollama
+        chain_extractor = prompt_user_extractor | get_llm_ollama()
+        model = ollama_model
+    elif isinstance(llm, Runnable):
+        chain_extractor = prompt_user_extractor | llm
+        model = getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
     else:
         raise ValueError("Invalid llm model")
 
+    if cache:
+        chain_extractor = cached_chain(chain_extractor, cache, model, prompt_system, prompt_user)
     return chain_extractor
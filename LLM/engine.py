@@ -0,0 +1,111 @@
+import asyncio
+from typing import AsyncIterator, Iterable, Iterator
+
+from schema.schema import Object
+from schema.utils import format_json_response
+
+
+async def extract_one(chain_extractor, text: str, schema: Object = None, timeout: float = 120,
+                      retries: int = 2, backoff: float = 1.0) -> dict | None:
+    """
+    Run the extractor chain on one text with a timeout and retries, and format the response with the schema.
+    """
+    for attempt in range(retries + 1):
+        try:
+            message = await asyncio.wait_for(chain_extractor.ainvoke(text), timeout)
+            return format_json_response(message.content, schema)
+        except Exception as e:
+            if attempt >= retries:
+                print(f"错误: {type(e).__name__} {e}")
+                return None
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def aextract(texts: Iterable[str], chain_extractor, schema: Object = None, concurrency: int = 16,
+                   timeout: float = 120, retries: int = 2, backoff: float = 1.0,
+                   ordered: bool = True) -> AsyncIterator[tuple]:
+    """
+    Extract information from many texts with bounded concurrency. Texts are consumed lazily and each response is
+    formatted as soon as it arrives.
+
+    :param texts: iterable of texts
+    :param chain_extractor: chain created by create_extractor_chain
+    :param schema: schema used to format the responses
+    :param concurrency: maximum number of requests in flight
+    :param timeout: timeout of a single request in seconds
+    :param retries: number of retries of a failed or timed out request
+    :param backoff: base delay of the exponential backoff between retries
+    :param ordered: if True yield results in input order, otherwise as they complete
+    :return: async iterator of (index, result) where result is None if the request failed
+    """
+    iterator = enumerate(texts)
+    pending = set()
+    finished = {}
+    n_scheduled = 0
+    n_yielded = 0
+    exhausted = False
+    # in ordered mode a slow request must not let the buffer of finished results grow without bound
+    max_ahead = concurrency * 4
+
+    async def run(index, text):
+        return index, await extract_one(chain_extractor, text, schema=schema, timeout=timeout,
+                                        retries=retries, backoff=backoff)
+
+    try:
+        while True:
+            while (not exhausted and len(pending) < concurrency
+                   and (not ordered or n_scheduled - n_yielded < max_ahead)):
+                try:
+                    index, text = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(run(index, text)))
+                n_scheduled += 1
+            if not pending:
+                return
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index, result = task.result()
+                if ordered:
+                    finished[index] = result
+                else:
+                    n_yielded += 1
+                    yield index, result
+            while ordered and n_yielded in finished:
+                yield n_yielded, finished.pop(n_yielded)
+                n_yielded += 1
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def iter_async(results: AsyncIterator) -> Iterator:
+    """
+    Iterate over an async iterator from synchronous code on a private event loop.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.close()
+
+
+def iter_extract(texts: Iterable[str], chain_extractor, schema: Object = None, **kwargs) -> Iterator[tuple]:
+    """
+    Synchronous version of aextract, yields (index, result) while the requests run concurrently.
+    """
+    return iter_async(aextract(texts, chain_extractor, schema=schema, **kwargs))
+
+
+def extract_many(texts: Iterable[str], chain_extractor, schema: Object = None, **kwargs) -> list:
+    """
+    Extract information from many texts concurrently and return the results in input order.
+    """
+    return [result for _, result in iter_extract(texts, chain_extractor, schema=schema, ordered=True, **kwargs)]
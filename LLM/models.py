@@ -1,16 +1,35 @@
-from langchain_ollama.chat_models import ChatOllama
-from langchain_openai import ChatOpenAI
-
-from settings import batch_key, batch_model, ollama_model
-
-llm_batch = ChatOpenAI(
-    temperature=0,
-    model=batch_model,
-    openai_api_key=batch_key,
-    openai_api_base="https://open.bigmodel.cn/api/paas/v4/"
-)
-
-llm_batch_ollama = ChatOllama(
-    temperature=0,
-    model=ollama_model,
-)
+from functools import lru_cache
+
+from settings import batch_key, batch_model, ollama_model, zhipu_api_base
+
+
+# chat models are built on first use and cached, so that importing the chains never constructs a client
+@lru_cache(maxsize=None)
+def get_llm_batch(model: str = batch_model, api_key: str = batch_key, api_base: str = zhipu_api_base):
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        temperature=0,
+        model=model,
+        openai_api_key=api_key,
+        openai_api_base=api_base
+    )
+
+
+@lru_cache(maxsize=None)
+def get_llm_ollama(model: str = ollama_model):
+    from langchain_ollama.chat_models import ChatOllama
+
+    return ChatOllama(
+        temperature=0,
+        model=model,
+    )
+
+
+def __getattr__(name: str):
+    # llm_batch and llm_batch_ollama of earlier versions
+    if name == "llm_batch":
+        return get_llm_batch()
+    if name == "llm_batch_ollama":
+        return get_llm_ollama()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,237 @@
+import asyncio
+import os
+import time
+import uuid
+from typing import AsyncIterator, Iterable, Iterator
+
+from LLM.engine import extract_one, iter_async
+from schema.schema import Object
+from settings import batch_model
+
+
+class Router:
+    """
+    Route a stream of documents between an online chain (the local Ollama model or the synchronous endpoint) and the
+    batch API, and return all results as one stream.
+
+    A document goes online if its deadline is closer than the expected batch latency, or if it is short and the
+    expected wait of the online queue is acceptable. The wait is estimated from the current queue depth and the
+    observed latency of the online requests, so the share of online documents follows the local throughput. All
+    other documents are streamed into batch files, which are uploaded, awaited and merged once the input is exhausted.
+    Only the files of the run are uploaded and merged, into batch/processed/{prefix}_{run id}.jsonl, other batches of
+    the manifest are left alone. The custom_ids of a run are prefixed with its run id, so they never collide with the
+    results of an earlier run.
+
+    :param chain_extractor: online extractor chain, default create_extractor_chain(schema, llm="ollama")
+    :param schema: schema used to build the prompts and format the responses
+    :param concurrency: maximum number of online requests in flight
+    :param max_queue: maximum number of online documents queued or in flight, default 4 * concurrency
+    :param max_online_chars: documents up to this length may go online without deadline
+    :param max_online_wait: maximum expected seconds until the result of a document routed online without deadline
+    :param batch_latency: expected seconds until the result of a batch request
+    :param latency: initial estimate of the seconds of an online request, updated with every response
+    :param prefix: prefix of the batch files and custom_ids, followed by the run id
+    :param model: model of the batch requests
+    :param wait_batches: if True upload the batch files and wait for their results, otherwise only write them
+    :param timeout: timeout of a single online request in seconds
+    :param retries: number of retries of a failed online request
+    :param poll_interval: seconds between polls of the batches of a run
+    :param max_poll_failures: number of consecutive failed polls after which a batch is given up as failed
+    """
+
+    def __init__(self, chain_extractor=None, schema: Object = None, concurrency: int = 8, max_queue: int = None,
+                 max_online_chars: int = 2000, max_online_wait: float = 60, batch_latency: float = 3600,
+                 latency: float = 10, prefix: str = "router", model: str = batch_model, wait_batches: bool = True,
+                 timeout: float = 120, retries: int = 2, poll_interval: float = 30, max_poll_failures: int = 5):
+        if chain_extractor is None:
+            from LLM.chains import create_extractor_chain
+            chain_extractor = create_extractor_chain(schema, llm="ollama")
+        self.chain_extractor = chain_extractor
+        self.schema = schema
+        self.concurrency = concurrency
+        self.max_queue = max_queue or 4 * concurrency
+        self.max_online_chars = max_online_chars
+        self.max_online_wait = max_online_wait
+        self.batch_latency = batch_latency
+        self.latency = latency
+        self.prefix = prefix
+        self.model = model
+        self.wait_batches = wait_batches
+        self.timeout = timeout
+        self.retries = retries
+        self.poll_interval = poll_interval
+        self.max_poll_failures = max_poll_failures
+        self.stats = {"online": 0, "batch": 0}
+
+    def observe(self, seconds: float):
+        # exponential moving average of the online latency
+        self.latency = 0.8 * self.latency + 0.2 * seconds
+
+    def expected_wait(self, queue_depth: int) -> float:
+        """
+        Expected seconds until the result of a document which joins an online queue of queue_depth documents.
+        """
+        return (queue_depth // self.concurrency + 1) * self.latency
+
+    def is_online(self, text: str, deadline: float = None, queue_depth: int = 0) -> bool:
+        if deadline is not None and deadline - time.time() < self.batch_latency:
+            return True
+        return (len(text) <= self.max_online_chars and queue_depth < self.max_queue
+                and self.expected_wait(queue_depth) <= self.max_online_wait)
+
+    @staticmethod
+    def _unpack(index: int, document) -> tuple:
+        # a document is a text, (doc_id, text) or (doc_id, text, deadline) with deadline as a time.time() timestamp
+        if isinstance(document, str):
+            return index, document, None
+        if len(document) == 2:
+            return document[0], document[1], None
+        return tuple(document)
+
+    def _run_batches(self, paths: list, run_prefix: str) -> str:
+        """
+        Upload the batch files of a run, wait for their batches and merge their outputs into the output of the run.
+
+        :return: path of the output of the run
+        """
+        from batch.batch_steps import TERMINAL_STATUSES, _format_output_file, _init_merge_worker, download_batch, \
+            retrieve_batch, upload_with_pool
+        from batch.keys import KeyPool
+        from batch.manifest import Manifest
+        from batch.sinks import open_sink, write_records
+        from settings import batch_key, batch_keys
+
+        manifest = Manifest()
+        pool = KeyPool(batch_keys or [batch_key], manifest=manifest)
+        outstanding = {}
+        for path in paths:
+            try:
+                batch_id = upload_with_pool(path, pool, manifest=manifest, block=True)
+            except Exception as e:
+                print(f"Failed to upload {path}: {e}")
+                continue
+            outstanding[batch_id] = manifest.get(path)["key"]
+
+        os.makedirs("batch/batch_output", exist_ok=True)
+        failures = dict.fromkeys(outstanding, 0)
+        while outstanding:
+            for batch_id, key in list(outstanding.items()):
+                try:
+                    batch_job = retrieve_batch(batch_id, key)
+                except Exception as e:
+                    failures[batch_id] += 1
+                    print(f"Failed to retrieve batch {batch_id}: {e}")
+                    if failures[batch_id] >= self.max_poll_failures:
+                        del outstanding[batch_id]
+                        pool.release(key)
+                        manifest.set_state(batch_id, "failed")
+                    continue
+                failures[batch_id] = 0
+                if batch_job.status not in TERMINAL_STATUSES and not batch_job.output_file_id:
+                    continue
+                del outstanding[batch_id]
+                pool.release(key)
+                error_file_id = getattr(batch_job, "error_file_id", None)
+                if not batch_job.output_file_id and not error_file_id:
+                    manifest.set_state(batch_id, "failed")
+                    continue
+                try:
+                    download_batch(batch_id, key, batch_job.output_file_id, error_file_id, manifest=manifest)
+                except Exception as e:
+                    print(f"Failed to download batch {batch_id}: {e}")
+                    manifest.set_state(batch_id, "failed")
+            if outstanding:
+                time.sleep(self.poll_interval)
+
+        rows = [row for row in map(manifest.get, paths) if row and row["state"] == "downloaded"]
+        _init_merge_worker(self.schema)
+
+        def iter_messages():
+            for row in rows:
+                yield from _format_output_file(row)[0]
+                manifest.set_state(row["batch_id"], "merged")
+
+        os.makedirs("batch/processed", exist_ok=True)
+        output_path = f"batch/processed/{run_prefix}.jsonl"
+        with open_sink(output_path) as sink:
+            write_records(sink, iter_messages())
+        return output_path
+
+    async def aroute(self, documents: Iterable) -> AsyncIterator[tuple]:
+        """
+        Route documents and yield (doc_id, result, route) as results arrive, route is "online" or "batch". Online
+        results arrive while the input is consumed, batch results at the end (with wait_batches).
+        """
+        from batch.batch_steps import BatchFileWriter, format_custom_id, get_request_template
+        from batch.sinks import iter_records
+        from batch.tokens import MESSAGE_OVERHEAD, default_estimator
+
+        template = get_request_template(self.schema, self.model)
+        static_tokens = default_estimator(template.static_text) + 2 * MESSAGE_OVERHEAD
+        semaphore = asyncio.Semaphore(self.concurrency)
+        writer = None
+        # the custom_ids of every run are unique, results of earlier runs never match them
+        run_prefix = f"{self.prefix}_{uuid.uuid4().hex[:12]}"
+        # custom_id -> doc_id of the documents sent to the batch API
+        batch_documents = {}
+        pending = set()
+
+        async def run(doc_id, text):
+            async with semaphore:
+                start = time.monotonic()
+                result = await extract_one(self.chain_extractor, text, schema=self.schema, timeout=self.timeout,
+                                           retries=self.retries)
+                self.observe(time.monotonic() - start)
+            return doc_id, result
+
+        try:
+            for index, document in enumerate(documents):
+                doc_id, text, deadline = self._unpack(index, document)
+                if self.is_online(text, deadline, len(pending)):
+                    # urgent documents wait for room in the queue
+                    while len(pending) >= self.max_queue:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            yield *task.result(), "online"
+                    pending.add(asyncio.ensure_future(run(doc_id, text)))
+                    self.stats["online"] += 1
+                else:
+                    writer = writer or BatchFileWriter(prefix=run_prefix)
+                    custom_id = run_prefix + "_split_" + format_custom_id(str(len(batch_documents)))
+                    batch_documents[custom_id] = doc_id
+                    writer.write(template.render(custom_id, text), static_tokens + default_estimator(text))
+                    self.stats["batch"] += 1
+
+                # hand over finished results without waiting
+                await asyncio.sleep(0)
+                done = {task for task in pending if task.done()}
+                pending -= done
+                for task in done:
+                    yield *task.result(), "online"
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield *task.result(), "online"
+        finally:
+            for task in pending:
+                task.cancel()
+            if writer:
+                writer.close()
+
+        if not batch_documents or not self.wait_batches:
+            return
+        path = await asyncio.get_running_loop().run_in_executor(None, self._run_batches, writer.paths, run_prefix)
+        for record in iter_records(path):
+            doc_id = batch_documents.pop(record.pop("custom_id", None), None)
+            if doc_id is not None:
+                yield doc_id, record, "batch"
+        # documents without a result, e.g. failed batch requests
+        for doc_id in batch_documents.values():
+            yield doc_id, None, "batch"
+
+    def route(self, documents: Iterable) -> Iterator[tuple]:
+        """
+        Synchronous version of aroute.
+        """
+        return iter_async(self.aroute(documents))
@@ -1,18 +1,37 @@
 import csv
 import json
 import os
-import pickle
+import random
 import shutil
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import lru_cache
 from glob import glob
+from itertools import chain
+from typing import Callable, Iterable, Iterator
 
-import pandas as pd
-from tqdm import tqdm
-from zhipuai import ZhipuAI
-
+from LLM.cache import ExtractionCache
+from batch.dedup import deduplicate, load_duplicates
+from batch.ingest import iter_source_rows
+from batch.keys import KeyPool
+from batch.manifest import STATES, Manifest
+from batch.metrics import metrics
+from batch.offsets import LineScanner, OffsetIndex
+from batch.parallel import bounded_map, iter_chunks
+from batch.sinks import OUTPUT_FORMATS, open_sink, write_records
+from batch.storage import COMPRESSION_EXTENSIONS, compression_of, file_stem, list_jsonl, open_file, open_member, \
+    read_payload, strip_compression
+from batch.tokens import MESSAGE_OVERHEAD, TokenEstimator, default_estimator, estimate_request_tokens
 from schema.prompts import prompt_user_extractor, prompt_system_extractor
+from schema.rules import apply_rules
 from schema.schema import Object
-from schema.utils import format_json_response
-from settings import batch_key, batch_model
+from schema.templates import RequestTemplate
+from schema.utils import PARSE_FAILED, PARSE_METHODS, format_json_response
+from settings import batch_key, batch_keys, batch_model, batch_compression
 
 
 # Zhipu AI batch API mode
@@ -43,212 +62,1160 @@ def create_batch_prompt(custom_id: str, text: str, prefix: str = "", schema: Obj
     }
 
 
+def format_custom_id(custom_id) -> str:
+    custom_id = str(custom_id)
+    if len(custom_id) < 6:
+        custom_id = custom_id.zfill(12)
+    elif len(custom_id) >= 65:
+        raise ValueError("Custom ID should be less than 65 characters.")
+    return custom_id
+
+
+def _is_series(obj) -> bool:
+    # pandas is only imported by the callers which use it, a Series can not exist before
+    pd = sys.modules.get("pandas")
+    return pd is not None and isinstance(obj, pd.Series)
+
+
+def iter_texts(text_dict) -> Iterator[tuple]:
+    """
+    Iterate (custom_id, text) pairs from a dict, a pandas Series or any iterable of pairs without copying them.
+    """
+    if isinstance(text_dict, dict) or _is_series(text_dict):
+        return iter(text_dict.items())
+    return iter(text_dict)
+
+
+def iter_batch_prompts(text_dict, schema: Object = None, prefix: str = "", model: str = batch_model) -> Iterator[dict]:
+    for custom_id, text in iter_texts(text_dict):
+        yield create_batch_prompt(format_custom_id(custom_id), text, prefix=prefix, schema=schema, model=model)
+
+
+def filter_cached(text_dict, cache: ExtractionCache, schema: Object = None, prefix: str = "",
+                  model: str = batch_model) -> Iterator[tuple]:
+    """
+    Record the cache key of every text and only yield the (custom_id, text) pairs which are not cached yet. The hit
+    and miss counters of the cache are reset, so that cache.report() covers this run only.
+    """
+    prompt_system = prompt_system_extractor if not schema else schema.prompt_system
+    prompt_user = prompt_user_extractor if not schema else schema.prompt_user
+    cache.clear_requests(prefix + "_split_")
+    cache.reset_stats()
+    for custom_id, text in iter_texts(text_dict):
+        custom_id = format_custom_id(custom_id)
+        key = cache.make_key(model, prompt_system, prompt_user, text)
+        hit = cache.contains(key)
+        cache.add_request(prefix + "_split_" + custom_id, key, hit)
+        if not hit:
+            yield custom_id, text
+    cache.commit()
+
+
 def create_batch_prompts(text_dict: dict, schema: Object = None, prefix: str = "", model: str = batch_model) -> list:
-    if isinstance(text_dict, pd.core.series.Series):
-        text_dict = text_dict.to_dict()
-    batch_prompts = []
-    for custom_id, text in text_dict.items():
-        custom_id = str(custom_id)
-        if len(custom_id) < 6:
-            custom_id = str(custom_id).zfill(12)
-        elif len(custom_id) >= 65:
-            raise ValueError("Custom ID should be less than 65 characters.")
-        batch_prompts.append(create_batch_prompt(custom_id, text, prefix=prefix, schema=schema, model=model))
-    return batch_prompts
-
-
-def write_jsonl_files(batch_prompts: list, batch_input_dir: str = "batch/batch_input", prefix: str = "",
+    return list(iter_batch_prompts(text_dict, schema=schema, prefix=prefix, model=model))
+
+
+# worker state of the prompt rendering process pool
+_render_options = {}
+
+
+def get_request_template(schema: Object = None, model: str = batch_model) -> RequestTemplate:
+    if schema:
+        return schema.request_template(model)
+    return _default_request_template(model)
+
+
+@lru_cache(maxsize=None)
+def _default_request_template(model: str) -> RequestTemplate:
+    return RequestTemplate(prompt_system_extractor, prompt_user_extractor, model)
+
+
+def _init_render_worker(schema: Object, prefix: str, model: str, estimator: TokenEstimator = default_estimator):
+    template = get_request_template(schema, model)
+    # everything but the text is rendered and estimated once
+    static_tokens = estimator(template.static_text) + 2 * MESSAGE_OVERHEAD
+    _render_options.update(template=template, prefix=prefix + "_split_", estimator=estimator,
+                           static_tokens=static_tokens)
+
+
+def _render_batch_lines(items: list) -> list:
+    template = _render_options["template"]
+    prefix = _render_options["prefix"]
+    estimator = _render_options["estimator"]
+    static_tokens = _render_options["static_tokens"]
+    lines = []
+    for custom_id, text in items:
+        # non-string values are rendered like str.format would
+        text = text if isinstance(text, str) else str(text)
+        lines.append((template.render(prefix + format_custom_id(custom_id), text), static_tokens + estimator(text)))
+    return lines
+
+
+def iter_batch_lines(text_dict, schema: Object = None, prefix: str = "", model: str = batch_model,
+                     workers: int = 1, chunk_size: int = 1000,
+                     estimator: TokenEstimator = default_estimator) -> Iterator[tuple]:
+    """
+    Render and serialize batch requests lazily, optionally across a process pool.
+
+    :param text_dict: dict, pandas Series or iterable of (custom_id, text) pairs
+    :param schema: schema used to build the prompts
+    :param prefix: prefix of the custom_id
+    :param model: model name
+    :param workers: number of worker processes, 1 renders in the current process
+    :param chunk_size: number of texts sent to a worker at once
+    :param estimator: token estimator of the requests
+    :return: iterator of (JSONL line, estimated tokens)
+    """
+    chunks = iter_chunks(iter_texts(text_dict), chunk_size)
+    for lines in bounded_map(_render_batch_lines, chunks, workers=workers,
+                             initializer=_init_render_worker, initargs=(schema, prefix, model, estimator)):
+        yield from lines
+
+
+class BatchFileWriter:
+    """
+    Rollover writer of batch input files. A new file is started when the current one would exceed the request, byte
+    or token limit, and every finished file is registered in the manifest with its requests, bytes and estimated
+    tokens.
+
+    checkpoint() makes everything written so far durable and returns a state from which a new writer continues the
+    current file after a crash. Compressed files are written as a sequence of gzip members or zstd frames, one per
+    checkpoint, so the file can be truncated at the end of the last checkpoint and appended to.
+
+    :param batch_input_dir: directory of the batch input files
+    :param prefix: prefix of the file names and custom_ids
+    :param max_tokens_per_file: target token budget per file, None for no budget
+    :param compression: None, "gzip" or "zstd" compression of the files, the limits apply to the uncompressed data
+    :param manifest: manifest of the batch files, default batch/manifest.db
+    :param state: state returned by checkpoint() to resume from
+    :param attempt: retry round of the requests, 0 for the first submission
+    :param name: name of the files batch_input_{name}_{i}, default prefix
+    :param on_file: called with the path of every finished file, e.g. to upload it right away
+    """
+
+    def __init__(self, batch_input_dir: str = "batch/batch_input", prefix: str = "",
+                 max_requests_per_file: int = 50000,
+                 max_file_size: int = 95 * 1024 * 1024,
+                 max_tokens_per_file: int = None,
+                 compression: str = batch_compression,
+                 manifest: Manifest = None,
+                 state: dict = None,
+                 attempt: int = 0,
+                 name: str = None,
+                 on_file: Callable[[str], None] = None):
+        if not os.path.exists(batch_input_dir):
+            os.makedirs(batch_input_dir)
+        self.batch_input_dir = batch_input_dir
+        self.prefix = prefix
+        self.max_requests_per_file = max_requests_per_file
+        self.max_file_size = max_file_size
+        self.max_tokens_per_file = max_tokens_per_file
+        self.compression = compression
+        self.manifest = manifest or Manifest()
+        self.attempt = attempt
+        self.name = name or prefix
+        self.on_file = on_file
+
+        self.paths = []
+        self.raw = None
+        self.stream = None
+        self.current_file_requests = 0
+        self.current_file_size = 0
+        self.current_file_tokens = 0
+        if state:
+            self._resume(state)
+
+    def _resume(self, state: dict):
+        self.paths = list(state["paths"])
+        if state["offset"] is None:
+            return
+        # drop whatever was written after the checkpoint
+        self.raw = open(self.paths[-1], 'r+b')
+        self.raw.truncate(state["offset"])
+        self.raw.seek(state["offset"])
+        self.current_file_requests = state["requests"]
+        self.current_file_size = state["size"]
+        self.current_file_tokens = state["tokens"]
+
+    def _close_stream(self):
+        if self.stream is not None and self.stream is not self.raw:
+            self.stream.close()
+        self.stream = None
+        self.raw.close()
+        self.raw = None
+
+    def _close_file(self):
+        self._close_stream()
+        self.manifest.add_file(self.paths[-1], self.prefix, self.current_file_requests, self.current_file_size,
+                               self.current_file_tokens, attempt=self.attempt)
+        metrics.count("retry" if self.attempt else "create", files=1, rows=self.current_file_requests,
+                      bytes=self.current_file_size, tokens=self.current_file_tokens)
+        if self.on_file:
+            self.on_file(self.paths[-1])
+
+    def write(self, line: str, tokens: int = 0):
+        data = line.encode('utf-8')
+        if self.raw and (self.current_file_requests >= self.max_requests_per_file
+                         or self.current_file_size + len(data) > self.max_file_size
+                         or self.max_tokens_per_file
+                         and self.current_file_tokens + tokens > self.max_tokens_per_file):
+            self._close_file()
+
+        if not self.raw:
+            extension = COMPRESSION_EXTENSIONS[self.compression]
+            path = f"{self.batch_input_dir}/batch_input_{self.name}_{len(self.paths)}.jsonl{extension}"
+            self.raw = open(path, 'wb')
+            self.paths.append(path)
+            self.current_file_requests = 0
+            self.current_file_size = 0
+            self.current_file_tokens = 0
+        if self.stream is None:
+            self.stream = open_member(self.raw, self.compression)
+
+        self.stream.write(data)
+        self.current_file_requests += 1
+        self.current_file_size += len(data)
+        self.current_file_tokens += tokens
+
+    def checkpoint(self) -> dict:
+        """
+        Flush and fsync the current file and return the state to resume from.
+        """
+        if self.raw is None:
+            return {"paths": self.paths, "offset": None}
+        if self.stream is not self.raw:
+            # finish the gzip member / zstd frame, the next write starts a new one
+            self.stream.close()
+            self.stream = None
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        return {"paths": self.paths, "offset": self.raw.tell(), "requests": self.current_file_requests,
+                "size": self.current_file_size, "tokens": self.current_file_tokens}
+
+    def close(self):
+        if self.raw:
+            self._close_file()
+
+    def abort(self):
+        """
+        Close the current file without registering it, e.g. after an error while its requests were written. The file
+        stays on disk but is neither in the manifest nor passed to on_file.
+        """
+        if self.raw:
+            self._close_stream()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_jsonl_files(batch_prompts: Iterable, batch_input_dir: str = "batch/batch_input", prefix: str = "",
                       max_requests_per_file: int = 50000,
-                      max_file_size: int = 95 * 1024 * 1024):
-    if not os.path.exists(batch_input_dir):
-        os.makedirs(batch_input_dir)
+                      max_file_size: int = 95 * 1024 * 1024,
+                      max_tokens_per_file: int = None,
+                      estimator: TokenEstimator = default_estimator,
+                      compression: str = batch_compression,
+                      manifest: Manifest = None,
+                      on_file: Callable[[str], None] = None) -> list:
+    """
+    Stream batch requests into rollover JSONL files without holding more than one line in memory (see
+    BatchFileWriter).
 
-    file_index = 0
-    current_file_requests = []
-    current_file_size = 0
+    :param batch_prompts: iterable of request dicts, serialized JSONL lines or (line, tokens) tuples
+    :param max_tokens_per_file: target token budget per file, None for no budget
+    :param estimator: token estimator of the request dicts (lines without token count are counted as 0)
+    :param compression: None, "gzip" or "zstd" compression of the files, the limits apply to the uncompressed data
+    :param manifest: manifest of the batch files, default batch/manifest.db
+    :param on_file: called with the path of every finished file
+    :return: paths of the written files
+    """
+    with BatchFileWriter(batch_input_dir, prefix, max_requests_per_file=max_requests_per_file,
+                         max_file_size=max_file_size, max_tokens_per_file=max_tokens_per_file,
+                         compression=compression, manifest=manifest, on_file=on_file) as writer:
+        for prompt in batch_prompts:
+            if isinstance(prompt, tuple):
+                writer.write(*prompt)
+            elif isinstance(prompt, str):
+                writer.write(prompt)
+            else:
+                writer.write(json.dumps(prompt, ensure_ascii=False) + '\n', estimate_request_tokens(prompt, estimator))
+    return writer.paths
 
-    for prompt in batch_prompts:
-        prompt_str = json.dumps(prompt, ensure_ascii=False) + '\n'
-        prompt_size = len(prompt_str.encode('utf-8'))
 
-        if len(current_file_requests) >= max_requests_per_file or current_file_size + prompt_size > max_file_size:
-            with open(f"{batch_input_dir}/batch_input_{prefix}_{file_index}.jsonl", 'w', encoding='utf-8') as f:
-                f.writelines(current_file_requests)
-            file_index += 1
-            current_file_requests = []
-            current_file_size = 0
+# API clients are reused across files and threads, one per key. The zhipuai SDK is only imported with the first client.
+@lru_cache(maxsize=None)
+def get_client(key: str = batch_key) -> "ZhipuAI":
+    from zhipuai import ZhipuAI
+    return ZhipuAI(api_key=key)
 
-        current_file_requests.append(prompt_str)
-        current_file_size += prompt_size
 
-    if current_file_requests:
-        with open(f"{batch_input_dir}/batch_input_{prefix}_{file_index}.jsonl", 'w', encoding='utf-8') as f:
-            f.writelines(current_file_requests)
+@lru_cache(maxsize=None)
+def transient_errors() -> tuple:
+    from zhipuai import APIReachLimitError, APIInternalError, APIServerFlowExceedError, APIConnectionError
+    return APIReachLimitError, APIInternalError, APIServerFlowExceedError, APIConnectionError
 
 
-# send batch
-def send_batch(file_path, zhipu_key=batch_key):
-    client = ZhipuAI(api_key=zhipu_key)
+def retry_call(fn, *args, retries: int = 3, backoff: float = 2.0, retry_on: tuple = None, **kwargs):
+    """
+    Call fn and retry transient API errors (rate limits, server errors, connection errors) with exponential backoff.
+    """
+    if retry_on is None:
+        retry_on = transient_errors()
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except retry_on as e:
+            if attempt >= retries:
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            print(f"Transient error: {e}. Retry in {delay:.1f}s")
+            time.sleep(delay)
+
 
+def upload_file(client: "ZhipuAI", file_path: str):
+    if compression_of(file_path):
+        # decompress into the exact upload payload only right before sending it
+        file = (os.path.basename(strip_compression(file_path)), read_payload(file_path))
+        return client.files.create(file=file, purpose="batch")
     with open(file_path, "rb") as f:
-        result = client.files.create(file=f, purpose="batch")
+        return client.files.create(file=f, purpose="batch")
+
 
-    file_name = os.path.basename(file_path).split(".")[0]
-    create = client.batches.create(
+# send batch
+def send_batch(file_path, zhipu_key=batch_key, client: "ZhipuAI" = None, retries: int = 3,
+               retry_on: tuple = None):
+    client = client or get_client(zhipu_key)
+
+    # retry the upload and the batch creation separately so that a failed create never re-uploads the file
+    result = retry_call(upload_file, client, file_path, retries=retries, retry_on=retry_on)
+
+    file_name = file_stem(file_path)
+    create = retry_call(
+        client.batches.create,
         input_file_id=result.id,
         endpoint="/v4/chat/completions",
         auto_delete_input_file=True,
-        metadata={"description": file_name}
+        metadata={"description": file_name},
+        retries=retries,
+        retry_on=retry_on
     )
 
     batch_id = create.id
     return batch_id
 
 
-def save_uploaded_file(file_path, batch_id, key):
-    with open("batch/batch_id.csv", 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([file_path, batch_id, key])
+def save_uploaded_file(file_path, batch_id, key, manifest: Manifest = None):
+    (manifest or Manifest()).set_uploaded(file_path, batch_id, key)
 
 
-def load_uploaded_files():
-    if os.path.exists("batch/batch_id.csv"):
-        uploaded_files = {"uploaded_files": [], "batch_ids": {}}
-        with open("batch/batch_id.csv", 'r', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                file_path, batch_id, key = row
-                uploaded_files["uploaded_files"].append(file_path)
-                uploaded_files["batch_ids"][file_path] = batch_id
-        return uploaded_files
-    return {"uploaded_files": [], "batch_ids": {}}
+def load_uploaded_files(manifest: Manifest = None):
+    uploaded_files = {"uploaded_files": set(), "batch_ids": {}}
+    for row in (manifest or Manifest()).files(states=STATES[1:]):
+        uploaded_files["uploaded_files"].add(row["file_path"])
+        uploaded_files["batch_ids"][row["file_path"]] = row["batch_id"]
+    return uploaded_files
 
 
 # format json batch response with custom_id
-def format_json_batch(data, schema: Object = None):
-    content = data['response']['body']['choices'][0]['message']['content']
+def format_json_batch(data, schema: Object = None, usage: dict = None, methods: dict = None):
+    """
+    Format a line of a batch output file. If a usage dict is given, the token usage of the response is added to it,
+    if a methods dict is given the count of the method which parsed the response (see FormatterPlan.parse).
+    """
+    body = data['response']['body']
+    content = body['choices'][0]['message']['content']
     custom_id = data['custom_id']
+    if usage is not None:
+        for name, value in (body.get('usage') or {}).items():
+            if isinstance(value, (int, float)):
+                usage[name] = usage.get(name, 0) + value
 
-    result = format_json_response(content, schema)
+    result = format_json_response(content, schema, methods=methods)
 
     if isinstance(result, dict):
         result["custom_id"] = custom_id
     return result
 
 
+def pre_extract(text_dict, schema: Object, prefix: str = "", mode: str = "documents") -> list:
+    """
+    Resolve fields with the deterministic rules of the schema (Field pattern / extractor) over all texts at once,
+    before any request is created. The values found are written to batch/rules/rules_{prefix}.jsonl and joined with
+    the LLM results by step_merge_output.
+
+    :param text_dict: dict, pandas Series or iterable of (custom_id, text) pairs
+    :param schema: schema with rule fields
+    :param prefix: prefix of the custom_id
+    :param mode: "documents" sends every document which is not completely resolved with the whole schema, "fields"
+        sends only the unresolved fields of each document (one prompt per combination of unresolved fields)
+    :return: list of (schema, texts) to send to the LLM, the whole schema first
+    """
+    import pandas as pd
+
+    if mode not in ("documents", "fields"):
+        raise ValueError("Invalid rules mode")
+    texts = text_dict if isinstance(text_dict, pd.Series) else pd.Series(dict(iter_texts(text_dict)), dtype=object)
+    values = apply_rules(texts, schema)
+    resolved = values.notna()
+    rule_ids = list(values.columns)
+    if len(rule_ids) == len(schema.fields):
+        complete = resolved.all(axis=1)
+    else:
+        complete = pd.Series(False, index=texts.index)
+
+    os.makedirs("batch/rules", exist_ok=True)
+    with open(f"batch/rules/rules_{prefix}.jsonl", "w", encoding="utf-8") as f:
+        for custom_id, row, is_complete in zip(texts.index, values.itertuples(index=False), complete):
+            found = {field_id: value for field_id, value in zip(rule_ids, row) if value is not None}
+            if is_complete or mode == "fields" and found:
+                f.write(json.dumps({"custom_id": prefix + "_split_" + format_custom_id(custom_id),
+                                    "complete": bool(is_complete), "values": found},
+                                   ensure_ascii=False, default=str) + "\n")
+
+    remaining = texts[~complete]
+    if mode == "documents":
+        groups = [(schema, remaining)]
+    else:
+        # bit mask of the unresolved rule fields of every document
+        masks = sum((~resolved[field_id]).astype(int) * (1 << i) for i, field_id in enumerate(rule_ids))[~complete]
+        groups = []
+        for mask, group in remaining.groupby(masks, sort=False):
+            ids = [field.id for field in schema.fields
+                   if field.id not in rule_ids or mask >> rule_ids.index(field.id) & 1]
+            groups.append((schema if len(ids) == len(schema.fields) else schema.subset(ids), group))
+        groups.sort(key=lambda group: group[0] is not schema)
+
+    n_complete = int(complete.sum())
+    n_fields = int(resolved[~complete].values.sum()) if mode == "fields" else 0
+    metrics.count("create", rules_documents=n_complete, rules_fields=n_fields)
+    print(f"Rules resolved {n_complete} of {len(texts)} documents ({n_complete} requests saved)"
+          + (f" and {n_fields} fields of the others" if mode == "fields" else ""))
+    return groups
+
+
+def iter_rule_values(batch_rules_dir: str = "batch/rules") -> Iterator[dict]:
+    for path in sorted(glob(f"{batch_rules_dir}/rules_*.jsonl")):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def _format_rule_values(formatter, values: dict) -> dict:
+    # converted values of the fields found by the rules only
+    formatted = formatter.format_result(values)
+    return {key: value for key, value in formatted.items() if key.removesuffix("_raw") in values}
+
+
 # step 1: create batches (single file with multiple lines)
-def step_create_batches(text_dict: dict, schema: Object = None, prefix: str = "", model: str = batch_model):
-    batch_prompts = create_batch_prompts(text_dict, schema=schema, prefix=prefix, model=model)
-    write_jsonl_files(batch_prompts, batch_input_dir="batch/batch_input", prefix=prefix)
+@metrics.timed("create")
+def step_create_batches(text_dict: dict, schema: Object = None, prefix: str = "", model: str = batch_model,
+                        workers: int = 1, cache: ExtractionCache = None, max_tokens_per_file: int = None,
+                        estimator: TokenEstimator = default_estimator, rules: str = None,
+                        manifest: Manifest = None, on_file: Callable[[str], None] = None,
+                        dedup: float = None, compression: str = batch_compression) -> list:
+    """
+    Create the batch input files of the texts.
+
+    :param dedup: similarity threshold (0-1, e.g. 0.9) to request only one representative of every cluster of near
+        duplicate texts, whose result is copied to the others, see batch.dedup.deduplicate
+    :param rules: "documents" or "fields" to resolve the rule fields of the schema first and send only the unresolved
+        documents or fields to the LLM, see pre_extract
+    :param manifest: manifest of the batch files, default batch/manifest.db
+    :param on_file: called with the path of every finished file, see batch.pipeline
+    :param compression: None, "gzip" or "zstd" compression of the batch files
+    """
+    # duplicates and rule values of an earlier run of the prefix, step_merge_output would join them with the results
+    # of this one
+    remove_files(path=f"batch/dedup/dedup_{prefix}.jsonl")
+    remove_files(path=f"batch/rules/rules_{prefix}.jsonl")
+    if dedup:
+        text_dict = deduplicate(text_dict, prefix=prefix, threshold=dedup, workers=workers)
+    groups = [(schema, text_dict)]
+    if rules and schema and schema.rule_fields:
+        groups = pre_extract(text_dict, schema, prefix=prefix, mode=rules)
+    if cache and groups and groups[0][0] is schema:
+        # prompts of partial schemas are never cached
+        groups[0] = (schema, filter_cached(groups[0][1], cache, schema=schema, prefix=prefix, model=model))
+    batch_lines = chain.from_iterable(
+        iter_batch_lines(texts, schema=group_schema, prefix=prefix, model=model, workers=workers, estimator=estimator)
+        for group_schema, texts in groups)
+    paths = write_jsonl_files(batch_lines, batch_input_dir="batch/batch_input", prefix=prefix,
+                              max_tokens_per_file=max_tokens_per_file, manifest=manifest, on_file=on_file,
+                              compression=compression)
+    if cache:
+        print(cache.report())
+    return paths
 
 
 # create batch files and pandas DataFrame chunks pickle files
+def _save_progress(progress_file: str, progress: dict):
+    # write-and-rename, so a crash never leaves a truncated progress file
+    with open(progress_file + ".tmp", "w") as f:
+        json.dump(progress, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(progress_file + ".tmp", progress_file)
+
+
+@metrics.timed("create")
 def step_create_batches_chunks(schema: Object, paths_chunk_pkl_files: list, chunk_size: int = 100,
-                               text_column: str = ""):
+                               text_column: str = "", workers: int = 1, read_workers: int = 4,
+                               checkpoint_rows: int = 10000, compression: str = batch_compression,
+                               manifest: Manifest = None):
     """
-    将大量从原始文本数据中分割出来的chunk数据.pkl文件，按照顺序生成处理后的chunk数据.pkl文件，用prefix列标记文件，标签标记每一行。
-    output.jsonl文件中的custom_id相对应，用于后续与结果的匹配 (custom_id = prefix + custom_id)
+    将大量从原始文本数据中分割出来的chunk数据文件 (.pkl, .parquet, .jsonl, .csv)，每chunk_size个文件为一个chunk，用prefix标记，
+    逐行流式生成batch文件。每个chunk写入索引文件batch/batch_chunks/index_{prefix}.csv (custom_id, path, row)，
+    custom_id与output.jsonl中的custom_id相对应，用于后续与结果的匹配 (见batch.join.join_results)。
+    不再生成合并的batch/batch_chunks/page_text_chunk_{prefix}.pkl，源数据按索引从原文件读取。
+    每checkpoint_rows行记录一次进度，中断后从最后一个检查点继续，而不是重新处理整个chunk。
     :param schema:
-    :param paths_chunk_pkl_files:
-    :param chunk_size:
-    :param text_column:
+    :param paths_chunk_pkl_files: 数据文件路径
+    :param chunk_size: 每个chunk的文件数
+    :param text_column: 文本列名
+    :param workers: 生成请求的进程数
+    :param read_workers: 并行读取文件的进程数
+    :param checkpoint_rows: 检查点间隔行数
+    :param compression: None, "gzip" or "zstd" compression of the batch files
+    :param manifest: manifest of the batch files, default batch/manifest.db
     :return:
     """
+    from tqdm import tqdm
+
     progress_file = "batch/batch_chunks/progress.json"
+    os.makedirs("batch/batch_chunks", exist_ok=True)
+    manifest = manifest or Manifest()
 
     # 如果存在进度文件，读取进度
     if os.path.exists(progress_file):
         with open(progress_file, "r") as f:
-            progress_data = json.load(f)
-        start_index = progress_data.get("index", 0)
+            progress = json.load(f)
     else:
-        start_index = 0
+        progress = {"index": 0}
 
-    # 遍历文件路径列表，并以每120个文件为一个chunk进行处理
-    for i in tqdm(range(start_index, len(paths_chunk_pkl_files), chunk_size)):
+    for i in tqdm(range(progress["index"], len(paths_chunk_pkl_files), chunk_size)):
         prefix = str(i // chunk_size + 1)
-        # 获取当前chunk的文件路径
         chunk_paths = paths_chunk_pkl_files[i:i + chunk_size]
+        index_path = f"batch/batch_chunks/index_{prefix}.csv"
+
+        # 从检查点继续：截断检查点之后写入的内容
+        resume = progress if progress["index"] == i and "writer" in progress else None
+        if resume:
+            with open(index_path, "r+b") as f:
+                f.truncate(resume["index_offset"])
+            n_rows, shard, row = resume["n_rows"], resume["shard"], resume["row"]
+        else:
+            with open(index_path, "wb") as f:
+                f.write(b"custom_id,path,row\n")
+            n_rows, shard, row = 0, 0, 0
 
-        # 读取所有当前chunk的文件并合并到一个DataFrame中
-        combined_df = pd.concat([pd.read_pickle(path) for path in chunk_paths], ignore_index=True)
+        rows = iter_source_rows(chunk_paths, text_column, workers=read_workers, start_shard=shard, start_row=row)
+        # position of the rows handed to the renderer but not written yet
+        positions = deque()
 
-        # 生成batch文件到batch/batch_chunks目录下
-        step_create_batches(combined_df[text_column], schema=schema, prefix=prefix)
+        def texts():
+            for custom_id, (shard_index, row_index, text) in enumerate(rows, n_rows):
+                positions.append((shard_index, row_index))
+                yield custom_id, text
 
-        # str(combined_df.index).zfill(12)
-        combined_df["prefix"] = prefix
-        combined_df["custom_id"] = combined_df["prefix"] + "_" + combined_df.index.astype(str).str.zfill(12)
+        writer = BatchFileWriter(prefix=prefix, compression=compression, manifest=manifest,
+                                 state=resume and resume["writer"])
+        with writer, open(index_path, "a", encoding="utf-8", newline="") as index_file:
+            index_writer = csv.writer(index_file)
+            for line, tokens in iter_batch_lines(texts(), schema=schema, prefix=prefix, workers=workers):
+                writer.write(line, tokens)
+                shard, row = positions.popleft()
+                index_writer.writerow([prefix + "_split_" + format_custom_id(n_rows), chunk_paths[shard], row])
+                n_rows += 1
 
-        # 保存当前chunk的DataFrame到batch/batch_chunks目录下
-        combined_df.to_pickle(f'batch/batch_chunks/page_text_chunk_{prefix}.pkl')
+                # 记录检查点
+                if n_rows % checkpoint_rows == 0:
+                    index_file.flush()
+                    os.fsync(index_file.fileno())
+                    _save_progress(progress_file, {"index": i, "n_rows": n_rows, "shard": shard, "row": row + 1,
+                                                   "index_offset": index_file.tell(),
+                                                   "writer": writer.checkpoint()})
 
         # 记录进度
-        with open(progress_file, "w") as f:
-            json.dump({"index": i + chunk_size}, f)
+        progress = {"index": i + chunk_size}
+        _save_progress(progress_file, progress)
+
+
+def upload_with_pool(path: str, pool: KeyPool, manifest: Manifest, semaphores: dict = None, retries: int = 3,
+                     block: bool = False) -> str:
+    """
+    Upload a batch file with a key of the pool and mark it as uploaded in the manifest. A rate limited key is put on
+    cooldown and the file moves to another key, a key which fails authentication is disabled.
+
+    :param path: path of the batch input file
+    :param pool: pool of API keys
+    :param manifest: manifest of the batch files
+    :param semaphores: optional dict of key -> semaphore limiting the concurrent uploads per key
+    :param retries: number of retries of transient errors
+    :param block: wait for a key with free quota instead of failing, see KeyPool.acquire
+    :return: batch_id
+    """
+    from zhipuai import APIAuthenticationError, APIReachLimitError
+
+    # with several keys a rate limited upload moves to another key instead of waiting for the same one
+    retry_on = transient_errors()
+    if len(pool) > 1:
+        retry_on = tuple(e for e in retry_on if e is not APIReachLimitError)
+
+    # every key may be tried a few times before the file is left for the next run
+    for _ in range((retries + 1) * len(pool.quotas)):
+        key = pool.acquire(block=block)
+        if key is None:
+            raise RuntimeError("no API key available")
+        try:
+            with semaphores[key] if semaphores is not None else nullcontext():
+                batch_id = send_batch(path, zhipu_key=key, retries=retries, retry_on=retry_on)
+        except APIReachLimitError as e:
+            pool.penalize(key)
+            metrics.count("upload", rate_limited=1)
+            print(f"Key ...{key[-4:]} rate limited: {e}")
+            continue
+        except APIAuthenticationError as e:
+            pool.disable(key)
+            print(f"Key ...{key[-4:]} disabled: {e}")
+            continue
+        except Exception:
+            pool.release(key)
+            raise
+        pool.succeed(key)
+        manifest.set_uploaded(path, batch_id, key)
+        row = manifest.get(path)
+        metrics.count("upload", files=1, rows=row["n_requests"] or 0, bytes=row["n_bytes"] or 0)
+        return batch_id
+    raise RuntimeError("rate limited on every API key")
 
 
 # step 2: upload batches
-def step_upload_batches(batch_input_dir: str = "batch/batch_input", key: str = ""):
-    if not key:
-        key = batch_key
-    paths_jsonl = glob(f"{batch_input_dir}/*.jsonl")
-    uploaded_files = load_uploaded_files()
-    files_to_upload = [f for f in paths_jsonl if f not in uploaded_files["uploaded_files"]]
+@metrics.timed("upload")
+def step_upload_batches(batch_input_dir: str = "batch/batch_input", key: str = "", workers: int = 4,
+                        max_concurrency_per_key: int = 4, retries: int = 3, manifest: Manifest = None,
+                        keys=None, cooldown: float = 60):
+    """
+    Upload batch files concurrently, spread over a pool of API keys by quota and batches in flight (see KeyPool).
+    Each key has its own concurrency limit, clients are shared by all threads, and a file is marked as uploaded in
+    the manifest with its key only once its batch has been created, so an interrupted run resumes without submitting
+    any file twice and results are always retrieved with the key which created the batch.
+
+    :param batch_input_dir: directory of the batch input files
+    :param key: API key, used if neither keys nor settings.batch_keys are set, default settings.batch_key
+    :param workers: number of upload threads
+    :param max_concurrency_per_key: maximum number of concurrent uploads per key
+    :param retries: number of retries of transient errors
+    :param manifest: manifest of the batch files, default batch/manifest.db
+    :param keys: list of keys, dict of key -> quota of batches in flight or KeyPool, default settings.batch_keys
+    :param cooldown: seconds a key is skipped after a rate limit error, doubled on every further error
+    """
+    from tqdm import tqdm
+
+    manifest = manifest or Manifest()
+    if isinstance(keys, KeyPool):
+        pool = keys
+    else:
+        pool = KeyPool(keys or batch_keys or [key or batch_key], manifest=manifest, cooldown=cooldown)
+    files_to_upload = []
+    for path in list_jsonl(batch_input_dir):
+        row = manifest.get(path)
+        if not row or row["state"] == "created":
+            files_to_upload.append(path)
+
+    key_semaphores = defaultdict(lambda: threading.BoundedSemaphore(max_concurrency_per_key))
+
+    def upload(path):
+        upload_with_pool(path, pool, manifest=manifest, semaphores=key_semaphores, retries=retries)
+        return path
 
     upload_count = 0
-    for path in tqdm(files_to_upload):
-        batch_id = send_batch(path, zhipu_key=key)
-        save_uploaded_file(path, batch_id, key)
-        upload_count += 1
-        print(f"Uploaded {upload_count} files. Current file: {path}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(upload, path): path for path in files_to_upload}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                path = future.result()
+            except Exception as e:
+                print(f"Failed to upload {futures[future]}: {e}")
+                metrics.count("upload", failed=1)
+                continue
+            upload_count += 1
+            print(f"Uploaded {upload_count} files. Current file: {path}")
+    print(f"Uploaded {upload_count} files. {len(files_to_upload) - upload_count} files failed.")
+
+
+# batch statuses after which a batch never changes again
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def download_file(client: "ZhipuAI", file_id: str, path: str, chunk_size: int = 1024 * 1024,
+                  offsets: OffsetIndex = None):
+    """
+    Stream a file to disk in chunks, compressed according to the extension of path. The file is written to
+    path + ".part" first and renamed when complete, so an interrupted download is never mistaken for a finished one.
+    If an offset index is given, the lines of an uncompressed file are indexed from the same chunks.
+    """
+    scanner = LineScanner() if offsets is not None and not compression_of(path) else None
+    # ask the SDK for an unread streaming response instead of loading the whole body into memory
+    content = client.files.content(file_id, extra_headers={"X-Stainless-Raw-Response": "stream"})
+    try:
+        with open_file(path + ".part", 'wb', compression=compression_of(path)) as f:
+            for chunk in content.iter_bytes(chunk_size):
+                f.write(chunk)
+                if scanner:
+                    scanner.feed(chunk)
+    finally:
+        content.close()
+    os.replace(path + ".part", path)
+    if scanner:
+        offsets.add(path, scanner.close())
+
+
+def retrieve_batch(batch_id: str, key: str, retries: int = 3):
+    metrics.count("download", polls=1)
+    return retry_call(get_client(key).batches.retrieve, batch_id, retries=retries)
+
+
+def download_batch(batch_id: str, key: str, output_file_id: str | None, error_file_id: str | None,
+                   manifest: Manifest, compression: str = batch_compression, retries: int = 3,
+                   offsets: OffsetIndex = None) -> bool:
+    """
+    Download the output and error file of a finished batch to batch/batch_output and record them in the manifest.
+    Their lines are added to the offset index if one is given.
+
+    :return: True if the batch has an output file, False if it failed (its error file is downloaded if any)
+    """
+    client = get_client(key)
+    extension = COMPRESSION_EXTENSIONS[compression]
+    error_path = None
+    if error_file_id:
+        error_path = f"batch/batch_output/{batch_id}_error.jsonl{extension}"
+        retry_call(download_file, client, error_file_id, error_path, offsets=offsets, retries=retries)
+        metrics.count("download", error_files=1, bytes=os.path.getsize(error_path))
+    if not output_file_id:
+        manifest.set_state(batch_id, "failed", error_path=error_path)
+        return False
+    path = f"batch/batch_output/{batch_id}.jsonl{extension}"
+    retry_call(download_file, client, output_file_id, path, offsets=offsets, retries=retries)
+    metrics.count("download", files=1, bytes=os.path.getsize(path))
+    manifest.set_state(batch_id, "downloaded", output_path=path, error_path=error_path)
+    return True
 
 
 # step 3: download batches
-def step_download_output():
-    batch_ids = []
-    with open("batch/batch_id.csv", 'r', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            file_path, batch_id, key = row
-            batch_ids.append((batch_id, key))
-
-    paths_download = glob(r"batch/batch_output/*.jsonl")
-    file_names = [os.path.basename(path).split(".")[0] for path in paths_download]
-    num_files = len(batch_ids)
+@metrics.timed("download")
+def step_download_output(wait: bool = False, workers: int = 8, min_interval: float = 30, max_interval: float = 600,
+                         retries: int = 3, compression: str = batch_compression, manifest: Manifest = None,
+                         index: bool = True):
+    """
+    Poll all outstanding batches concurrently and download each output file as soon as its batch is completed.
+    Error files of failed requests are downloaded next to the outputs (batch/batch_output/{batch_id}_error.jsonl) for
+    the retries of step_merge_output. Batches which have been downloaded or reached a terminal status are recorded in
+    the manifest and never polled again.
 
+    :param wait: if True keep polling until every batch is finished, otherwise poll each batch once
+    :param workers: number of threads used for polling and downloading
+    :param min_interval: seconds between polls of a batch which is making progress
+    :param max_interval: upper bound of the poll interval of a batch which is not making progress
+    :param retries: number of retries of transient errors
+    :param compression: None, "gzip" or "zstd" compression of the downloaded files
+    :param manifest: manifest of the batch files, default batch/manifest.db
+    :param index: if True index the lines of uncompressed files in batch/batch_output/offsets.db, see OffsetIndex
+    """
+    manifest = manifest or Manifest()
+    os.makedirs("batch/batch_output", exist_ok=True)
+    offsets = OffsetIndex() if index and not compression else None
+    rows = manifest.files(states=("uploaded", "in_progress", "completed"))
+    outstanding = {row["batch_id"]: row["key"] for row in rows}
+    states = {row["batch_id"]: row["state"] for row in rows}
+
+    # adaptive poll schedule: the interval shrinks while a batch makes progress and grows while it is idle
+    next_poll = {batch_id: 0.0 for batch_id in outstanding}
+    intervals = {batch_id: min_interval for batch_id in outstanding}
+    progress = {}
     n_downloaded = 0
-    for batch_id, key in batch_ids:
-        if batch_id in file_names:
-            num_files -= 1
-            continue
-        client = ZhipuAI(api_key=key)
-        batch_job = client.batches.retrieve(batch_id)
-        if batch_job.output_file_id:
-            content = client.files.content(batch_job.output_file_id)
-            # 使用write_to_file方法把返回结果写入文件
-            content.write_to_file(f"batch/batch_output/{batch_id}.jsonl")
-            print(f"Downloaded {n_downloaded + 1} files. Current file: {batch_id}.jsonl")
+    n_failed = 0
+
+    def poll(batch_id):
+        return retrieve_batch(batch_id, outstanding[batch_id], retries=retries)
+
+    def download(batch_id, output_file_id, error_file_id):
+        return download_batch(batch_id, outstanding[batch_id], output_file_id, error_file_id, manifest=manifest,
+                              compression=compression, retries=retries, offsets=offsets)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        downloads = {}
+        while next_poll:
+            now = time.time()
+            due = [batch_id for batch_id, t in next_poll.items() if t <= now]
+            polls = {executor.submit(poll, batch_id): batch_id for batch_id in due}
+            for future in as_completed(polls):
+                batch_id = polls[future]
+                try:
+                    batch_job = future.result()
+                except Exception as e:
+                    print(f"Failed to retrieve batch {batch_id}: {e}")
+                    next_poll[batch_id] = now + intervals[batch_id]
+                    continue
+
+                if batch_job.status in TERMINAL_STATUSES or batch_job.output_file_id:
+                    del next_poll[batch_id]
+                    error_file_id = getattr(batch_job, "error_file_id", None)
+                    if batch_job.output_file_id:
+                        manifest.set_state(batch_id, "completed")
+                        downloads[executor.submit(download, batch_id, batch_job.output_file_id,
+                                                  error_file_id)] = batch_id
+                    elif error_file_id:
+                        downloads[executor.submit(download, batch_id, None, error_file_id)] = batch_id
+                    else:
+                        manifest.set_state(batch_id, "failed")
+                        metrics.count("download", failed_batches=1)
+                        n_failed += 1
+                        print(f"Batch {batch_id} {batch_job.status} without output.")
+                    continue
+
+                if states[batch_id] == "uploaded" and batch_job.status in ("in_progress", "finalizing"):
+                    manifest.set_state(batch_id, "in_progress")
+                    states[batch_id] = "in_progress"
+
+                counts = batch_job.request_counts
+                done = (counts.completed + counts.failed) if counts else 0
+                if done > progress.get(batch_id, 0):
+                    intervals[batch_id] = min_interval
+                else:
+                    intervals[batch_id] = min(intervals[batch_id] * 2, max_interval)
+                progress[batch_id] = done
+                next_poll[batch_id] = now + intervals[batch_id]
+
+            if not wait:
+                break
+            if next_poll:
+                time.sleep(max(0.0, min(next_poll.values()) - time.time()))
+
+        for future in as_completed(downloads):
+            batch_id = downloads[future]
+            try:
+                has_output = future.result()
+            except Exception as e:
+                print(f"Failed to download batch {batch_id}: {e}")
+                continue
+            if not has_output:
+                metrics.count("download", failed_batches=1)
+                n_failed += 1
+                print(f"Batch {batch_id} failed, downloaded its error file.")
+                continue
             n_downloaded += 1
-    print(f"Downloaded {n_downloaded} files. {num_files - n_downloaded} files not finished.")
+            print(f"Downloaded {n_downloaded} files. Current file: {batch_id}.jsonl")
 
+    print(f"Downloaded {n_downloaded} files. {n_failed} batches failed. "
+          f"{len(outstanding) - n_downloaded - n_failed} files not finished.")
 
-# step 4: merge output
-def step_merge_output(schema: Object = None):
-    paths_output = glob(r"batch/batch_output/*.jsonl")
+
+# worker state of the merge process pool
+_merge_options = {}
+
+
+def _init_merge_worker(schema: Object, collect_responses: bool = False, collect_failures: bool = False):
+    _merge_options.update(schema=schema, collect_responses=collect_responses, collect_failures=collect_failures)
+
+
+def _custom_id_of(line: str) -> str:
+    # request lines start with their custom_id, which spares parsing the whole request
+    head = '{"custom_id": "'
+    if line.startswith(head):
+        end = line.find('"', len(head))
+        if end > 0 and "\\" not in line[len(head):end]:
+            return line[len(head):end]
+    return json.loads(line)["custom_id"]
+
+
+def iter_request_lines(path: str) -> Iterator[tuple]:
+    """
+    Iterate over the (custom_id, line) of a batch input file.
+    """
+    with open_file(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield _custom_id_of(line), line
+
+
+def _is_error_line(data: dict) -> bool:
+    response = data.get("response") or {}
+    return response.get("status_code", 200) != 200 or not (response.get("body") or {}).get("choices")
+
+
+def _format_output_file(row: dict) -> tuple:
+    """
+    Parse the output file of a batch. Besides the formatted messages (and the raw responses for the cache) it
+    returns the custom_ids of the failed requests: API errors, unparsable responses, lines of the error file and
+    requests of the input file without any result, for retry files the custom_ids which succeeded, the token usage
+    of the responses and the counts of their parse methods.
+    """
     messages = []
-    for path in tqdm(paths_output):
-        # read jsonl file
-        with open(path, 'r', encoding='utf-8') as f:
-            data = [json.loads(line) for line in f]
-        messages_chunk = [format_json_batch(r, schema=schema) for r in data]
-        messages_chunk = [message for message in messages_chunk if message]
-        messages.extend(messages_chunk)
+    responses = []
+    failed = []
+    succeeded = []
+    usage = {}
+    methods = Counter()
+    if row["output_path"]:
+        with open_file(row["output_path"], 'r') as f:
+            for line in f:
+                data = json.loads(line)
+                if _is_error_line(data):
+                    failed.append(data['custom_id'])
+                    continue
+                message = format_json_batch(data, schema=_merge_options["schema"], usage=usage, methods=methods)
+                if not message:
+                    failed.append(data['custom_id'])
+                    continue
+                messages.append(message)
+                succeeded.append(data['custom_id'])
+                # keep the raw content of parsable responses for the extraction cache
+                if _merge_options["collect_responses"]:
+                    responses.append((data['custom_id'], data['response']['body']['choices'][0]['message']['content']))
+    if row["error_path"]:
+        with open_file(row["error_path"], 'r') as f:
+            failed.extend(json.loads(line).get('custom_id') for line in f if line.strip())
+
+    if _merge_options["collect_failures"] and os.path.exists(row["file_path"]):
+        seen = set(succeeded).union(failed)
+        failed.extend(custom_id for custom_id, _ in iter_request_lines(row["file_path"]) if custom_id not in seen)
+    failed = [custom_id for custom_id in failed if custom_id]
+    return messages, responses, failed, succeeded if row["attempt"] else [], usage, methods
+
+
+@metrics.timed("retry")
+def write_retry_batches(failures: dict, max_retries: int = 2, compression: str = batch_compression,
+                        estimator: TokenEstimator = default_estimator, manifest: Manifest = None) -> list:
+    """
+    Write the failed requests into compact retry files, batch_input_{prefix}_retry{attempt}_{n}_{i}, copying their
+    lines from the input file they failed in. Requests which are already in a pending retry file are skipped, the
+    custom_ids of requests which failed max_retries retries are written to batch/processed/failed_custom_ids.txt.
+
+    :param failures: dict of custom_id -> (attempt, input file path, prefix) of the last failure of each request
+    :param max_retries: maximum number of retry rounds
+    :param compression: None, "gzip" or "zstd" compression of the retry files
+    :param estimator: token estimator of the requests
+    :param manifest: manifest of the batch files, default batch/manifest.db
+    :return: paths of the retry files
+    """
+    manifest = manifest or Manifest()
+    for row in manifest.files(states=("created", "uploaded", "in_progress", "completed")):
+        if row["attempt"] and os.path.exists(row["file_path"]):
+            for custom_id, _ in iter_request_lines(row["file_path"]):
+                failures.pop(custom_id, None)
+
+    exhausted = sorted(custom_id for custom_id, (attempt, _, _) in failures.items() if attempt >= max_retries)
+    os.makedirs("batch/processed", exist_ok=True)
+    with open("batch/processed/failed_custom_ids.txt", "w", encoding="utf-8") as f:
+        f.writelines(custom_id + "\n" for custom_id in exhausted)
+
+    retries = defaultdict(set)
+    n_lost = 0
+    for custom_id, (attempt, path, prefix) in failures.items():
+        if attempt >= max_retries:
+            continue
+        if not os.path.exists(path):
+            n_lost += 1
+            continue
+        retries[(prefix, attempt + 1, path)].add(custom_id)
+
+    writers = {}
+    try:
+        for (prefix, attempt, path), custom_ids in retries.items():
+            if (prefix, attempt) not in writers:
+                # the number of files of the prefix grows with every written file, so retry file names never repeat
+                name = f"{prefix}_retry{attempt}_{len(manifest.files(prefix=prefix))}"
+                writers[(prefix, attempt)] = BatchFileWriter(prefix=prefix, compression=compression,
+                                                             manifest=manifest, attempt=attempt, name=name)
+            writer = writers[(prefix, attempt)]
+            for custom_id, line in iter_request_lines(path):
+                if custom_id in custom_ids:
+                    writer.write(line, estimate_request_tokens(json.loads(line), estimator))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    paths = [path for writer in writers.values() for path in writer.paths]
+    print(f"{sum(map(len, retries.values()))} failed requests written to {len(paths)} retry files. "
+          f"{len(exhausted)} requests failed after {max_retries} retries, {n_lost} without input file.")
+    return paths
+
+
+def iter_cached_messages(cache: ExtractionCache, schema: Object = None) -> Iterator[dict]:
+    for custom_id, content in cache.iter_hits():
+        message = format_json_response(content, schema)
+        if isinstance(message, dict):
+            message["custom_id"] = custom_id
+        if message:
+            yield message
+
+
+class OutputMerger:
+    """
+    Bookkeeping of a merge, file by file: the failed requests for the retry files, the requests which succeeded in a
+    retry, the new responses for the extraction cache and the values resolved by the rules of step_create_batches.
+    The messages of the representatives of near duplicates (see batch.dedup) are copied to the members.
+
+    :param schema: schema used to format the responses
+    :param cache: extraction cache which stores the new responses and backfills the cache hits
+    """
+
+    def __init__(self, schema: Object = None, cache: ExtractionCache = None):
+        self.schema = schema
+        self.cache = cache
+        # custom_id -> (attempt, input file path, prefix) of the last failure, and the requests which succeeded in a
+        # retry
+        self.failures = {}
+        self.recovered = set()
+        # number of responses by the method which parsed them, see FormatterPlan.parse
+        self.parsed = Counter()
+        metrics.reset("parse")
+        # cache hits of the run which no merged output answered, an output of an earlier run of the prefix which is
+        # merged again answers them already
+        self.pending_hits = cache.hit_ids() if cache else set()
+        # values of the fields resolved by the rules, the complete documents never reached the LLM
+        self.partial = {}
+        self.duplicates = load_duplicates()
+        if schema:
+            formatter = schema.compile()
+            for rule in iter_rule_values():
+                if not rule["complete"]:
+                    self.partial[rule["custom_id"]] = _format_rule_values(formatter, rule["values"])
+
+    def add(self, row: dict, result: tuple) -> list:
+        """
+        Record the result of _format_output_file for a manifest row and return its messages.
+        """
+        messages, responses, failed, succeeded, usage, methods = result
+        metrics.count("merge", files=1, rows=len(messages), failed=len(failed), **usage)
+        parsed = {name[len("parsed_"):]: value for name, value in methods.items()}
+        self.parsed.update(parsed)
+        metrics.count("parse", **parsed)
+        if self.cache:
+            for custom_id, content in responses:
+                key = self.cache.key_of(custom_id)
+                if key:
+                    self.cache.put(key, content, commit=False)
+        for custom_id in failed:
+            if custom_id not in self.failures or self.failures[custom_id][0] < row["attempt"]:
+                self.failures[custom_id] = (row["attempt"], row["file_path"], row["prefix"])
+        self.recovered.update(succeeded)
+        if self.pending_hits:
+            for message in messages:
+                if isinstance(message, dict):
+                    self.pending_hits.discard(message.get("custom_id"))
+        if self.partial:
+            for message in messages:
+                values = isinstance(message, dict) and self.partial.get(message.get("custom_id"))
+                if values:
+                    message.update(values)
+        return self._fan_out(messages)
+
+    def _fan_out(self, messages: list) -> list:
+        if not self.duplicates:
+            return messages
+        copies = [{**message, "custom_id": member} for message in messages if isinstance(message, dict)
+                  for member in self.duplicates.get(message.get("custom_id"), ())]
+        if copies:
+            metrics.count("merge", duplicates=len(copies))
+        return messages + copies
+
+    def parse_summary(self) -> str:
+        """
+        Counts of the parse methods of the merged responses, e.g. "fence 9800, json 150, repair 30, failed 20".
+        """
+        return ", ".join(f"{method} {self.parsed[method]}" for method in PARSE_METHODS + (PARSE_FAILED,)
+                         if self.parsed.get(method))
+
+    def iter_remaining(self) -> Iterator[dict]:
+        """
+        Messages which were not requested: the cache hits and the documents resolved completely by the rules.
+        """
+        if self.cache:
+            self.cache.commit()
+            for message in iter_cached_messages(self.cache, schema=self.schema):
+                if not isinstance(message, dict) or message.get("custom_id") in self.pending_hits:
+                    yield from self._fan_out([message])
+        if self.schema:
+            formatter = self.schema.compile()
+            for rule in iter_rule_values():
+                if rule["complete"]:
+                    metrics.count("merge", rules=1)
+                    yield from self._fan_out([{**formatter.format_result(rule["values"]),
+                                               "custom_id": rule["custom_id"]}])
+
+    def write_retries(self, max_retries: int = 2, compression: str = batch_compression,
+                      manifest: Manifest = None) -> list:
+        """
+        Write the requests which are still failed into retry files, see write_retry_batches.
+        """
+        for custom_id in self.recovered:
+            self.failures.pop(custom_id, None)
+        return write_retry_batches(self.failures, max_retries=max_retries, compression=compression,
+                                   manifest=manifest)
+
+
+# step 4: merge output
+@metrics.timed("merge")
+def step_merge_output(schema: Object = None, workers: int = 1, output_format: str = "jsonl",
+                      chunk_size: int = 10000, cache: ExtractionCache = None,
+                      compression: str = batch_compression, manifest: Manifest = None,
+                      max_retries: int = 2) -> str:
+    """
+    Parse the downloaded output files in worker processes and append the results chunk by chunk to a streamable
+    output file, batch/processed/output.jsonl by default. Only a bounded number of parsed files is held in memory.
+    Use batch.sinks.iter_records to read the output incrementally.
+
+    Failed requests (API errors, unparsable responses and missing results) are collected and written into retry
+    files (see write_retry_batches). Upload, download and merge again to reconcile their results into the output,
+    each request is retried at most max_retries times. Values resolved by the rules of step_create_batches fill the
+    fields of the LLM results and the documents resolved completely by the rules are appended. The results of the
+    representatives of near duplicates are copied to their members (see batch.dedup).
+
+    :param schema: schema used to format the responses
+    :param workers: number of worker processes
+    :param output_format: "jsonl", "parquet" or "arrow" (columnar formats require a schema and pyarrow)
+    :param chunk_size: number of records per written chunk (row group)
+    :param cache: extraction cache which stores the new responses and backfills the cache hits of step_create_batches
+    :param compression: None, "gzip" or "zstd" compression of the JSONL output and of the retry files
+    :param manifest: manifest of the batch files, default batch/manifest.db
+    :param max_retries: maximum number of retry rounds of a failed request, 0 disables retries
+    :return: path of the output file
+    """
+    from tqdm import tqdm
+
+    manifest = manifest or Manifest()
+    rows_output = manifest.files(states=("downloaded", "merged", "failed"))
+    os.makedirs("batch/processed", exist_ok=True)
+    path = f"batch/processed/output{OUTPUT_FORMATS[output_format]}"
+    if output_format == "jsonl":
+        path += COMPRESSION_EXTENSIONS[compression]
+
+    results = bounded_map(_format_output_file, rows_output, workers=workers,
+                          initializer=_init_merge_worker, initargs=(schema, cache is not None, max_retries > 0))
+    merger = OutputMerger(schema=schema, cache=cache)
+
+    def iter_messages():
+        for row, result in tqdm(zip(rows_output, results), total=len(rows_output)):
+            yield from merger.add(row, result)
+        yield from merger.iter_remaining()
+
+    with open_sink(path, output_format=output_format, schema=schema) as sink:
+        n_records = write_records(sink, iter_messages(), chunk_size=chunk_size)
+    for row in rows_output:
+        if row["state"] != "failed":
+            manifest.set_state(row["batch_id"], "merged")
+    metrics.count("merge", records=n_records)
+    print(f"Merged {n_records} results into {path}. Parsed responses: {merger.parse_summary() or 'none'}")
 
-    with open("batch/processed/output.json", 'w', encoding='utf-8') as f:
-        json.dump(messages, f, ensure_ascii=False, indent=4)
-    with open("batch/processed/output.pkl", 'wb') as f:
-        pickle.dump(messages, f)
+    if max_retries:
+        merger.write_retries(max_retries=max_retries, compression=compression, manifest=manifest)
+    return path
 
 
 # remove batch files
@@ -269,9 +1236,14 @@ def remove_files(path):
 
 def remove_batch_files(mode="IN"):
     remove_files("batch/batch_input/")
+    remove_files("batch/rules/")
+    remove_files("batch/dedup/")
     remove_files(path="batch/batch_id.csv")
+    remove_files(path="batch/manifest.db")
     if mode == "IO":
         remove_files(path="batch/batch_output/")
     elif mode == "ALL":
         remove_files(path="batch/batch_output/")
         remove_files(path="batch/processed/")
+        remove_files(path="batch/joined/")
+        remove_files(path="batch/run_report.json")
@@ -0,0 +1,240 @@
+import json
+import os
+import re
+from functools import lru_cache, partial
+from glob import glob
+from typing import Callable, Iterator
+
+from batch.metrics import metrics
+from batch.parallel import bounded_map, iter_chunks
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# numbers of a notice: project numbers, amounts, dates, phone numbers
+NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+# multiplier of the polynomial hash of a shingle
+SHINGLE_BASE = 1000003
+# number of shingles hashed at once, bounds the temporary num_perm x block array of a long text
+SHINGLE_BLOCK = 4096
+# candidates whose estimated similarity is this far below the threshold are not verified, about three standard errors
+# of the estimate of 64 permutations
+ESTIMATE_MARGIN = 0.15
+# shingle sets of representatives kept while the candidates are verified
+SHINGLE_CACHE_SIZE = 4096
+
+
+def lsh_params(threshold: float, num_perm: int, false_negative_weight: float = 0.95) -> tuple:
+    """
+    Number of bands and rows per band of the LSH buckets for a similarity threshold, chosen like datasketch by
+    minimizing the weighted probability of false positives below and false negatives above the threshold. False
+    negatives are weighted much higher by default since every candidate is verified exactly and a missed duplicate
+    costs a request.
+
+    :return: (bands, rows)
+    """
+    def integral(f, a, b, steps=100):
+        width = (b - a) / steps
+        return sum(f(a + (i + 0.5) * width) for i in range(steps)) * width
+
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        false_positive = integral(lambda s: 1 - (1 - s ** rows) ** bands, 0.0, threshold)
+        false_negative = integral(lambda s: (1 - s ** rows) ** bands, threshold, 1.0)
+        error = (1 - false_negative_weight) * false_positive + false_negative_weight * false_negative
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+def shingles(text: str, shingle_size: int = 5) -> set:
+    """
+    Character shingles of a text, whitespace ignored, the same shingles as minhash_signatures.
+    """
+    text = WHITESPACE_PATTERN.sub("", str(text))
+    if len(text) <= shingle_size:
+        return {text}
+    return {text[i:i + shingle_size] for i in range(len(text) - shingle_size + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def numbers_of(text: str) -> frozenset:
+    return frozenset(NUMBER_PATTERN.findall(str(text)))
+
+
+def _hash_params(num_perm: int, seed: int) -> tuple:
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    # odd multipliers of the multiply-shift hash functions
+    a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+    return a[:, None], b[:, None]
+
+
+def minhash_signatures(texts: list, num_perm: int = 64, shingle_size: int = 5, seed: int = 1) -> "np.ndarray":
+    """
+    MinHash signatures of the character shingles of texts, whitespace ignored. Texts shorter than a shingle are one
+    shingle.
+
+    :return: uint32 array of shape (len(texts), num_perm)
+    """
+    import numpy as np
+
+    a, b = _hash_params(num_perm, seed)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for i, text in enumerate(texts):
+        codes = np.frombuffer(WHITESPACE_PATTERN.sub("", str(text)).encode("utf-32-le"), dtype=np.uint32)
+        codes = codes.astype(np.uint64)
+        size = max(1, min(shingle_size, len(codes)))
+        n_shingles = max(1, len(codes) - size + 1)
+        hashes = np.zeros(n_shingles, dtype=np.uint64)
+        for j in range(min(size, len(codes))):
+            hashes = hashes * np.uint64(SHINGLE_BASE) + codes[j:j + n_shingles]
+        signature = np.full(num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+        for start in range(0, n_shingles, SHINGLE_BLOCK):
+            block = hashes[None, start:start + SHINGLE_BLOCK]
+            signature = np.minimum(signature, ((a * block + b) >> np.uint64(32)).min(axis=1))
+        signatures[i] = signature
+    return signatures
+
+
+def cluster_signatures(signatures: "np.ndarray", threshold: float, bands: int, rows: int,
+                       verify: Callable[[int, int], float | None] = None) -> tuple:
+    """
+    Assign every text to a representative with banded LSH. For every band the signatures are sorted by the hash of
+    their band, texts with the same band are candidates of the first text of their bucket. Texts are assigned in
+    order: a text becomes a member of the representative of one of its candidates if their similarity reaches the
+    threshold, otherwise it is a representative itself. Every member is similar to its representative, clusters are
+    never chained.
+
+    :param verify: called with (text, representative) of the candidates in the order of their estimated similarity,
+        returns their exact similarity or None if they must not be merged. Without verify the estimated similarity
+        of the signatures decides.
+    :return: (representative index of every text, similarity to the representative)
+    """
+    import numpy as np
+
+    n = len(signatures)
+    index = np.arange(n)
+    leaders = np.empty((bands, n), dtype=np.int64)
+    for band in range(bands):
+        keys = np.zeros(n, dtype=np.uint64)
+        for column in signatures[:, band * rows:(band + 1) * rows].T:
+            keys = keys * np.uint64(SHINGLE_BASE) + column.astype(np.uint64)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.ones(n, dtype=bool)
+        starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        # the first text of its bucket for every position of the sorted order
+        first = order[np.maximum.accumulate(np.where(starts, np.arange(n), 0))]
+        leaders[band, order] = first
+
+    representatives = index.copy()
+    similarities = np.ones(n)
+    for i in np.flatnonzero((leaders != index).any(axis=0)):
+        candidates = np.unique(representatives[leaders[:, i]])
+        candidates = candidates[candidates != i]
+        if not len(candidates):
+            continue
+        estimates = (signatures[candidates] == signatures[i]).mean(axis=1)
+        for k in np.argsort(-estimates, kind="stable"):
+            if verify is None:
+                similarity = estimates[k] if estimates[k] >= threshold else None
+            elif estimates[k] >= threshold - ESTIMATE_MARGIN:
+                similarity = verify(i, int(candidates[k]))
+            else:
+                break
+            if similarity is not None and similarity >= threshold:
+                representatives[i] = candidates[k]
+                similarities[i] = similarity
+                break
+            if verify is None:
+                break
+    return representatives, similarities
+
+
+def deduplicate(text_dict, prefix: str = "", threshold: float = 0.9, num_perm: int = 64, shingle_size: int = 5,
+                workers: int = 1, seed: int = 1, match_numbers: bool = True):
+    """
+    Find the near duplicates of the texts (republished notices, corrections, mirror sites) with MinHash signatures of
+    their character shingles and banded LSH, so that only one representative per cluster is requested. Every
+    candidate pair of the LSH buckets is verified with the exact Jaccard similarity of the shingles. The members of
+    every cluster are written to batch/dedup/dedup_{prefix}.jsonl and step_merge_output copies the result of the
+    representative to them. The first text of a cluster is its representative.
+
+    Beware that the members get the extracted values of their representative. Notices of the same buyer share most
+    of their boilerplate and reach a high similarity although their project numbers and amounts differ, so with
+    match_numbers (the default) texts are only merged if they contain exactly the same numbers. Without it, or with a
+    low threshold, distinct notices may be merged and get wrong values.
+
+    :param text_dict: dict, pandas Series or iterable of (custom_id, text) pairs
+    :param prefix: prefix of the custom_id
+    :param threshold: Jaccard similarity of the shingles from which a text is a duplicate
+    :param num_perm: number of hash functions of the signatures, more are more exact and slower
+    :param shingle_size: number of characters per shingle
+    :param workers: number of processes computing the signatures
+    :param seed: seed of the hash functions
+    :param match_numbers: only merge texts which contain the same numbers (project numbers, amounts, dates)
+    :return: the representative texts, a pandas Series for a Series and a dict otherwise
+    """
+    import numpy as np
+    from batch.batch_steps import _is_series, format_custom_id, iter_texts
+
+    if not 0 < threshold <= 1:
+        raise ValueError("Invalid similarity threshold")
+    if not _is_series(text_dict) and not isinstance(text_dict, dict):
+        text_dict = dict(iter_texts(text_dict))
+    custom_ids = list(text_dict.keys())
+    texts = text_dict.values if _is_series(text_dict) else list(text_dict.values())
+
+    signatures = np.concatenate(
+        list(bounded_map(partial(minhash_signatures, num_perm=num_perm, shingle_size=shingle_size, seed=seed),
+                         iter_chunks(texts, 10000), workers=workers))
+        or [np.empty((0, num_perm), dtype=np.uint32)])
+    @lru_cache(maxsize=SHINGLE_CACHE_SIZE)
+    def shingles_of(i: int) -> set:
+        return shingles(texts[i], shingle_size)
+
+    def verify(i: int, j: int) -> float | None:
+        if match_numbers and numbers_of(texts[i]) != numbers_of(texts[j]):
+            return None
+        return jaccard(shingles_of(i), shingles_of(j))
+
+    bands, rows = lsh_params(threshold, num_perm)
+    representatives, similarities = cluster_signatures(signatures, threshold, bands, rows, verify=verify)
+
+    is_member = representatives != np.arange(len(custom_ids))
+    os.makedirs("batch/dedup", exist_ok=True)
+    with open(f"batch/dedup/dedup_{prefix}.jsonl", "w", encoding="utf-8") as f:
+        for i in np.flatnonzero(is_member):
+            f.write(json.dumps({"custom_id": prefix + "_split_" + format_custom_id(custom_ids[i]),
+                                "representative": prefix + "_split_" + format_custom_id(custom_ids[representatives[i]]),
+                                "similarity": round(float(similarities[i]), 4)}, ensure_ascii=False) + "\n")
+
+    n_members = int(is_member.sum())
+    metrics.count("create", dedup_documents=n_members)
+    print(f"Dedup found {n_members} near duplicates of {len(np.unique(representatives[is_member]))} of "
+          f"{len(custom_ids)} documents ({n_members} requests saved)")
+    if _is_series(text_dict):
+        return text_dict[~is_member]
+    return {custom_id: text for custom_id, text, member in zip(custom_ids, texts, is_member) if not member}
+
+
+def iter_duplicates(batch_dedup_dir: str = "batch/dedup") -> Iterator[dict]:
+    for path in sorted(glob(f"{batch_dedup_dir}/dedup_*.jsonl")):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def load_duplicates(batch_dedup_dir: str = "batch/dedup") -> dict:
+    """
+    :return: dict of representative custom_id -> custom_ids of its members
+    """
+    duplicates = {}
+    for duplicate in iter_duplicates(batch_dedup_dir):
+        duplicates.setdefault(duplicate["representative"], []).append(duplicate["custom_id"])
+    return duplicates
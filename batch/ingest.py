@@ -0,0 +1,80 @@
+from functools import partial
+from itertools import islice
+from typing import Iterator
+
+from batch.parallel import bounded_map
+from batch.storage import open_file, strip_compression
+
+# source shard formats, detected from the file extension (jsonl and csv may be gzip/zstd compressed)
+SOURCE_FORMATS = (".pkl", ".pickle", ".parquet", ".jsonl", ".csv")
+
+
+def source_format(path: str) -> str:
+    path = strip_compression(path)
+    for extension in SOURCE_FORMATS:
+        if path.endswith(extension):
+            return extension
+    raise ValueError(f"Unsupported source file: {path}")
+
+
+def read_texts(path: str, text_column: str = "") -> list:
+    """
+    Read the text column of a source shard. Only the column is returned, so worker processes send back the texts
+    rather than the whole DataFrame. A pickled Series is used as is.
+    """
+    import pandas as pd
+
+    extension = source_format(path)
+    if extension in (".pkl", ".pickle"):
+        data = pd.read_pickle(path)
+        texts = data if isinstance(data, pd.Series) else data[text_column]
+    elif extension == ".parquet":
+        texts = pd.read_parquet(path, columns=[text_column])[text_column]
+    elif extension == ".jsonl":
+        with open_file(path, 'r') as f:
+            texts = pd.read_json(f, lines=True, dtype=False)[text_column]
+    else:
+        with open_file(path, 'r') as f:
+            texts = pd.read_csv(f, usecols=[text_column], dtype=str, keep_default_na=False)[text_column]
+    return texts.tolist()
+
+
+def read_frame(path: str, columns: list = None) -> "pd.DataFrame":
+    """
+    Read a whole source shard (or some of its columns) as a DataFrame, a pickled Series becomes a single column.
+    """
+    import pandas as pd
+
+    extension = source_format(path)
+    if extension in (".pkl", ".pickle"):
+        frame = pd.read_pickle(path)
+        if isinstance(frame, pd.Series):
+            frame = frame.to_frame()
+    elif extension == ".parquet":
+        return pd.read_parquet(path, columns=columns)
+    elif extension == ".jsonl":
+        with open_file(path, 'r') as f:
+            frame = pd.read_json(f, lines=True, dtype=False)
+    else:
+        with open_file(path, 'r') as f:
+            return pd.read_csv(f, usecols=columns, dtype=str, keep_default_na=False)
+    return frame if columns is None else frame[columns]
+
+
+def iter_source_rows(paths: list, text_column: str = "", workers: int = 1, start_shard: int = 0,
+                     start_row: int = 0) -> Iterator[tuple]:
+    """
+    Stream the rows of source shards in order while the next shards are read in parallel.
+
+    :param paths: paths of the shards (.pkl, .parquet, .jsonl or .csv)
+    :param text_column: name of the text column
+    :param workers: number of reader processes
+    :param start_shard: index of the shard to start from
+    :param start_row: row of the first shard to start from
+    :return: iterator of (shard index, row in shard, text)
+    """
+    shards = bounded_map(partial(read_texts, text_column=text_column), paths[start_shard:], workers=workers)
+    for shard, texts in enumerate(shards, start_shard):
+        first_row = start_row if shard == start_shard else 0
+        for row, text in enumerate(islice(texts, first_row, None), first_row):
+            yield shard, row, text
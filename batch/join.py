@@ -0,0 +1,190 @@
+import json
+import os
+import shutil
+from collections import defaultdict
+from glob import glob
+
+from batch.ingest import SOURCE_FORMATS, read_frame
+from batch.metrics import metrics
+from batch.sinks import iter_records
+from batch.storage import strip_compression
+from schema.schema import Object, Number, Date
+from schema.utils import normalize_amounts
+
+JOIN_FORMATS = {"parquet": ".parquet", "pkl": ".pkl"}
+
+
+class SourceIndex:
+    """
+    Index of custom_id -> (shard, row) of the source rows of step_create_batches_chunks, built from the index files
+    batch/batch_chunks/index_{prefix}.csv. The custom_ids of a prefix are numbered consecutively, so each prefix is
+    held as two integer arrays indexed by that number (12 bytes per row) rather than as a dict of strings.
+
+    :param index_dir: directory of the index files
+    """
+
+    def __init__(self, index_dir: str = "batch/batch_chunks"):
+        import numpy as np
+        import pandas as pd
+
+        shard_ids = {}
+        self.prefixes = {}
+        for index_path in sorted(glob(f"{index_dir}/index_*.csv")):
+            prefix = os.path.basename(index_path)[len("index_"):-len(".csv")]
+            index = pd.read_csv(index_path, dtype={"custom_id": str, "path": str, "row": "int64"})
+            numbers = index["custom_id"].str.rpartition("_split_")[2].astype("int64").to_numpy()
+            codes, paths = pd.factorize(index["path"])
+            ids = np.array([shard_ids.setdefault(path, len(shard_ids)) for path in paths], dtype=np.int32)
+            size = int(numbers.max()) + 1 if len(index) else 0
+            shards = np.full(size, -1, dtype=np.int32)
+            rows = np.full(size, -1, dtype=np.int64)
+            shards[numbers] = ids[codes]
+            rows[numbers] = index["row"].to_numpy()
+            self.prefixes[prefix] = (shards, rows)
+        self.paths = list(shard_ids)
+
+    def lookup(self, custom_id: str) -> tuple | None:
+        """
+        :return: (shard index in self.paths, row in the shard), None if the custom_id is not indexed
+        """
+        prefix, _, number = custom_id.rpartition("_split_")
+        arrays = self.prefixes.get(prefix)
+        if arrays is None or not number.isdigit():
+            return None
+        shards, rows = arrays
+        number = int(number)
+        if number >= len(shards) or shards[number] < 0:
+            return None
+        return int(shards[number]), int(rows[number])
+
+
+def _result_columns(schema: Object | None, names: list) -> list:
+    if not schema:
+        return [name for name in names if name != "custom_id"] + ["custom_id"]
+    columns = []
+    for field in schema.fields:
+        columns.append(field.id)
+        if field.keep:
+            columns.append(field.id + "_raw")
+    return columns + ["custom_id"]
+
+
+def _typed_column(schema: Object | None, name: str, values: list, output_format: str):
+    import pandas as pd
+
+    field = next((field for field in schema.fields if field.id == name), None) if schema else None
+    if isinstance(field, Number) and field.unit:
+        # raw amounts, e.g. of results found by rules, are normalized to 万元 like the formatted ones
+        return pd.Series(normalize_amounts(values), dtype="float64")
+    if isinstance(field, Date):
+        return pd.to_datetime(pd.Series(values, dtype=object), errors="coerce")
+    if output_format == "parquet":
+        # nested values as JSON strings, like the columnar merge output
+        values = [value if value is None or isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+                  for value in values]
+    return pd.Series(values, dtype=object)
+
+
+def _shard_stem(path: str) -> str:
+    name = os.path.basename(strip_compression(path))
+    for extension in SOURCE_FORMATS:
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+@metrics.timed("join")
+def join_results(output_path: str = "batch/processed/output.jsonl", schema: Object = None,
+                 out_dir: str = "batch/joined", index_dir: str = "batch/batch_chunks",
+                 output_format: str = "parquet", column_prefix: str = "", spill_rows: int = 100000) -> list:
+    """
+    Join the merged results back to the source rows of step_create_batches_chunks without loading either side into
+    memory. The results are streamed once and partitioned by source shard into spill files, holding at most
+    spill_rows results in memory, then the shards are read one by one, their results are placed at their rows and
+    the enriched shards are written to out_dir. The result columns are typed by the schema fields (Number(unit=True)
+    as float64, Date as datetime64), rows without a result are null.
+
+    :param output_path: merged output of step_merge_output (.jsonl, .parquet or .arrow)
+    :param schema: schema of the results, without schema all keys of the results become object columns
+    :param out_dir: directory of the enriched shards, named after the source shards
+    :param index_dir: directory of the index files of step_create_batches_chunks
+    :param output_format: "parquet" or "pkl"
+    :param column_prefix: prefix of the result columns, required if they collide with source columns
+    :param spill_rows: number of results buffered in memory before they are appended to the spill files
+    :return: paths of the enriched shards
+    """
+    if output_format not in JOIN_FORMATS:
+        raise ValueError("Invalid output format")
+    index = SourceIndex(index_dir)
+    stems = [_shard_stem(path) for path in index.paths]
+    if len(set(stems)) < len(stems):
+        raise ValueError("Source shards with the same file name can not be joined into one directory")
+
+    # 1. partition the results by shard
+    spill_dir = f"{out_dir}/_spill"
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    os.makedirs(spill_dir)
+    buffers = defaultdict(list)
+    names = {}
+    n_buffered = 0
+    n_results = 0
+    n_unmatched = 0
+
+    def spill():
+        for shard, lines in buffers.items():
+            with open(f"{spill_dir}/{shard}.jsonl", "a", encoding="utf-8") as f:
+                f.writelines(lines)
+        buffers.clear()
+
+    for record in iter_records(output_path):
+        n_results += 1
+        position = index.lookup(str(record.get("custom_id")))
+        if position is None:
+            n_unmatched += 1
+            continue
+        shard, row = position
+        if not schema:
+            names.update(dict.fromkeys(record))
+        buffers[shard].append(json.dumps([row, record], ensure_ascii=False, default=str) + "\n")
+        n_buffered += 1
+        if n_buffered >= spill_rows:
+            spill()
+            n_buffered = 0
+    spill()
+
+    # 2. enrich the shards one by one
+    columns = _result_columns(schema, list(names))
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for shard, source_path in enumerate(index.paths):
+        frame = read_frame(source_path)
+        collisions = [column_prefix + name for name in columns if column_prefix + name in frame.columns]
+        if collisions:
+            raise ValueError(f"Result columns {collisions} exist in {source_path}, set a column_prefix")
+
+        results = {}
+        spill_path = f"{spill_dir}/{shard}.jsonl"
+        if os.path.exists(spill_path):
+            with open(spill_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    row, record = json.loads(line)
+                    results[row] = record
+        empty = {}
+        for name in columns:
+            values = [results.get(row, empty).get(name) for row in range(len(frame))]
+            frame[column_prefix + name] = _typed_column(schema, name, values, output_format).to_numpy()
+
+        path = f"{out_dir}/{stems[shard]}{JOIN_FORMATS[output_format]}"
+        if output_format == "parquet":
+            frame.to_parquet(path + ".part")
+        else:
+            frame.to_pickle(path + ".part", compression=None)
+        os.replace(path + ".part", path)
+        paths.append(path)
+        metrics.count("join", shards=1, rows=len(frame), matched=len(results))
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+    metrics.count("join", results=n_results, unmatched=n_unmatched)
+    print(f"Joined {n_results - n_unmatched} of {n_results} results into {len(paths)} shards in {out_dir}. "
+          f"{n_unmatched} results without source row.")
+    return paths
@@ -0,0 +1,111 @@
+import threading
+import time
+
+from batch.manifest import Manifest
+
+# manifest states of batches which are still running on the server
+IN_FLIGHT_STATES = ("uploaded", "in_progress")
+
+
+class KeyPool:
+    """
+    Pool of API keys (accounts) which spreads batch files by quota. Each key has a quota of batches in flight, and
+    the key with the lowest load (batches in flight / quota, then batches in flight) is handed out next, so keys
+    without quota take turns. The batches already in flight are counted from the manifest, so a new run continues to
+    balance the keys where the last one stopped.
+
+    A key which hits a rate limit or quota error is cooled down with an exponentially growing delay and its work moves
+    to the other keys, a key which fails authentication is disabled for the rest of the run.
+
+    :param keys: list of keys, or dict of key -> quota (maximum number of batches in flight, None for no limit)
+    :param manifest: manifest of the batch files, default batch/manifest.db
+    :param cooldown: seconds a key is skipped after its first rate limit error
+    :param max_cooldown: upper bound of the cooldown of a key which keeps failing
+    :param max_wait: maximum seconds acquire() waits for a key to cool down
+    """
+
+    def __init__(self, keys, manifest: Manifest = None, cooldown: float = 60, max_cooldown: float = 3600,
+                 max_wait: float = 600):
+        self.quotas = dict(keys) if isinstance(keys, dict) else dict.fromkeys(keys)
+        if not self.quotas:
+            raise ValueError("No API key")
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.in_flight = dict.fromkeys(self.quotas, 0)
+        self.cooldowns = dict.fromkeys(self.quotas, 0.0)
+        self.available_at = dict.fromkeys(self.quotas, 0.0)
+        self.disabled = set()
+        for row in (manifest or Manifest()).files(states=IN_FLIGHT_STATES):
+            if row["key"] in self.in_flight:
+                self.in_flight[row["key"]] += 1
+
+    def __len__(self):
+        return len(self.quotas) - len(self.disabled)
+
+    def _load(self, key: str) -> tuple:
+        # keys without quota have no load ratio, they are balanced by their batches in flight
+        quota = self.quotas[key]
+        return self.in_flight[key] / quota if quota else 0.0, self.in_flight[key]
+
+    def _has_capacity(self, key: str) -> bool:
+        quota = self.quotas[key]
+        return key not in self.disabled and (not quota or self.in_flight[key] < quota)
+
+    def acquire(self, block: bool = False) -> str | None:
+        """
+        Reserve a batch slot on the least loaded key. Waits while every key with free capacity cools down, returns
+        None if no key has capacity left or none is available within max_wait.
+
+        :param block: if True wait for a slot to be released when every key is at its quota instead of returning None
+        """
+        with self.condition:
+            while True:
+                candidates = [key for key in self.quotas if self._has_capacity(key)]
+                if not candidates:
+                    if not block or not len(self):
+                        return None
+                    self.condition.wait()
+                    continue
+                now = time.time()
+                ready = [key for key in candidates if self.available_at[key] <= now]
+                if ready:
+                    key = min(ready, key=self._load)
+                    self.in_flight[key] += 1
+                    return key
+                delay = min(self.available_at[key] for key in candidates) - now
+                if delay > self.max_wait:
+                    return None
+                self.condition.wait(delay)
+
+    def release(self, key: str):
+        """
+        Give back a slot whose batch was not created or has finished.
+        """
+        with self.condition:
+            self.in_flight[key] -= 1
+            self.condition.notify_all()
+
+    def succeed(self, key: str):
+        """
+        Keep the slot of a created batch and reset the cooldown of the key.
+        """
+        with self.condition:
+            self.cooldowns[key] = 0.0
+
+    def penalize(self, key: str):
+        """
+        Give back the slot and cool the key down after a rate limit or quota error.
+        """
+        with self.condition:
+            self.in_flight[key] -= 1
+            self.cooldowns[key] = min(self.cooldowns[key] * 2 or self.cooldown, self.max_cooldown)
+            self.available_at[key] = time.time() + self.cooldowns[key]
+            self.condition.notify_all()
+
+    def disable(self, key: str):
+        with self.condition:
+            self.in_flight[key] -= 1
+            self.disabled.add(key)
+            self.condition.notify_all()
@@ -0,0 +1,125 @@
+import csv
+import os
+import sqlite3
+import threading
+import time
+
+# life cycle of a batch file, "failed" is reached by batches which ended without output
+STATES = ("created", "uploaded", "in_progress", "completed", "downloaded", "merged", "failed")
+
+
+class Manifest:
+    """
+    Transactional manifest of the batch files with indexed lookups by file path, batch id and custom_id prefix.
+    Every file goes through the states created -> uploaded -> in_progress -> completed -> downloaded -> merged (or
+    failed), so each step only picks up the files in the states it handles and resumes exactly where it stopped.
+    Retry files of failed requests keep the prefix of their original file and count their attempt.
+
+    An existing batch/batch_id.csv of earlier versions is imported into an empty manifest.
+
+    :param path: str, the path of the SQLite database
+    """
+
+    def __init__(self, path: str = "batch/manifest.db"):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS files (file_path TEXT PRIMARY KEY, prefix TEXT, "
+                              "batch_id TEXT, key TEXT, state TEXT, n_requests INTEGER, n_bytes INTEGER, "
+                              "n_tokens INTEGER, output_path TEXT, error_path TEXT, updated REAL, "
+                              "attempt INTEGER DEFAULT 0)")
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS files_batch_id ON files (batch_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_prefix ON files (prefix)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_state ON files (state)")
+        self.import_csv()
+
+    def _update(self, sql: str, params: tuple):
+        with self.lock, self.conn:
+            self.conn.execute(sql, params)
+
+    def add_file(self, file_path: str, prefix: str = "", n_requests: int = None, n_bytes: int = None,
+                 n_tokens: int = None, attempt: int = 0):
+        """
+        Register a newly written batch input file. A file which is written again starts over as created, unless its
+        batch is still in flight (uploaded or in_progress): then it keeps its batch id, key and state, so the batch is
+        still polled and its key slot still counted.
+        """
+        self._update("INSERT INTO files (file_path, prefix, state, n_requests, n_bytes, n_tokens, updated, attempt) "
+                     "VALUES (?, ?, 'created', ?, ?, ?, ?, ?) "
+                     "ON CONFLICT (file_path) DO UPDATE SET prefix = excluded.prefix, "
+                     "n_requests = excluded.n_requests, n_bytes = excluded.n_bytes, n_tokens = excluded.n_tokens, "
+                     "updated = excluded.updated, attempt = excluded.attempt, "
+                     "batch_id = CASE WHEN state IN ('uploaded', 'in_progress') THEN batch_id END, "
+                     "key = CASE WHEN state IN ('uploaded', 'in_progress') THEN key END, "
+                     "output_path = CASE WHEN state IN ('uploaded', 'in_progress') THEN output_path END, "
+                     "error_path = CASE WHEN state IN ('uploaded', 'in_progress') THEN error_path END, "
+                     "state = CASE WHEN state IN ('uploaded', 'in_progress') THEN state ELSE 'created' END",
+                     (file_path, prefix, n_requests, n_bytes, n_tokens, time.time(), attempt))
+
+    def set_uploaded(self, file_path: str, batch_id: str, key: str):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO files (file_path, state) VALUES (?, 'created')", (file_path,))
+            self.conn.execute("UPDATE files SET batch_id = ?, key = ?, state = 'uploaded', updated = ? "
+                              "WHERE file_path = ?", (batch_id, key, time.time(), file_path))
+
+    def set_state(self, batch_id: str, state: str, output_path: str = None, error_path: str = None):
+        if state not in STATES:
+            raise ValueError(f"Invalid state: {state}")
+        self._update("UPDATE files SET state = ?, output_path = COALESCE(?, output_path), "
+                     "error_path = COALESCE(?, error_path), updated = ? WHERE batch_id = ?",
+                     (state, output_path, error_path, time.time(), batch_id))
+
+    def get(self, file_path: str) -> dict | None:
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM files WHERE file_path = ?", (file_path,)).fetchone()
+        return dict(row) if row else None
+
+    def get_batch(self, batch_id: str) -> dict | None:
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM files WHERE batch_id = ?", (batch_id,)).fetchone()
+        return dict(row) if row else None
+
+    def files_of_custom_id(self, custom_id: str) -> list:
+        """
+        Files which may contain a custom_id (custom_id = prefix + "_split_" + id).
+        """
+        return self.files(prefix=custom_id.rsplit("_split_", 1)[0])
+
+    def files(self, states: tuple = None, prefix: str = None) -> list:
+        sql = "SELECT * FROM files WHERE 1"
+        params = []
+        if states:
+            sql += f" AND state IN ({', '.join('?' * len(states))})"
+            params.extend(states)
+        if prefix is not None:
+            sql += " AND prefix = ?"
+            params.append(prefix)
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql + " ORDER BY file_path", params)]
+
+    def count(self) -> dict:
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM files GROUP BY state").fetchall())
+
+    def import_csv(self, path: str = "batch/batch_id.csv", batch_output_dir: str = "batch/batch_output"):
+        """
+        Import the batch/batch_id.csv of earlier versions into an empty manifest, batches whose output file is
+        already in batch_output_dir are imported as downloaded.
+        """
+        if not os.path.exists(path) or self.files():
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for file_path, batch_id, key in csv.reader(f):
+                self.set_uploaded(file_path, batch_id, key)
+                for extension in ("", ".gz", ".zst"):
+                    output_path = f"{batch_output_dir}/{batch_id}.jsonl{extension}"
+                    if os.path.exists(output_path):
+                        self.set_state(batch_id, "downloaded", output_path=output_path)
+
+    def close(self):
+        self.conn.close()
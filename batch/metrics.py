@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable
+
+
+class Metrics:
+    """
+    Counters and timings of the batch steps. Every step is a stage with its wall time and counters like rows, bytes,
+    files and tokens. The report is written to a JSON file at the end of each stage, and because the steps usually
+    run in separate processes the report keeps the last run of every stage.
+
+    Hooks are called with (event, stage, values): "count" with the increments of a counter update and "end" with all
+    counters of a finished stage, e.g. to forward them to a monitoring system.
+
+    :param path: path of the run report, None to keep it in memory only
+    :param hooks: callables receiving (event, stage, values)
+    """
+
+    def __init__(self, path: str | None = "batch/run_report.json", hooks: list = None):
+        self.path = path
+        self.hooks = list(hooks or [])
+        self.lock = threading.Lock()
+        self.stages = defaultdict(lambda: defaultdict(int))
+
+    def add_hook(self, hook: Callable[[str, str, dict], None]):
+        self.hooks.append(hook)
+
+    def _emit(self, event: str, stage: str, values: dict):
+        for hook in self.hooks:
+            hook(event, stage, values)
+
+    def count(self, stage: str, **values):
+        """
+        Add values to the counters of a stage, e.g. count("upload", files=1, bytes=n).
+        """
+        with self.lock:
+            counters = self.stages[stage]
+            for name, value in values.items():
+                counters[name] += value
+        self._emit("count", stage, values)
+
+    @contextmanager
+    def timed(self, stage: str):
+        """
+        Time a stage, its counters start from zero.
+        """
+        with self.lock:
+            self.stages[stage] = defaultdict(int, started=time.time())
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            with self.lock:
+                counters = self.stages[stage]
+                counters["seconds"] = time.perf_counter() - start
+                if counters.get("rows"):
+                    counters["rows_per_s"] = counters["rows"] / counters["seconds"]
+                values = dict(counters)
+            self._emit("end", stage, values)
+            self.save()
+
+    def reset(self, stage: str):
+        """
+        Start the counters of an untimed stage from zero, e.g. the parse methods of a merge.
+        """
+        with self.lock:
+            self.stages.pop(stage, None)
+
+    def report(self) -> dict:
+        with self.lock:
+            return {"updated": time.time(), "stages": {stage: dict(values) for stage, values in self.stages.items()}}
+
+    def save(self, path: str = None):
+        """
+        Write the report, stages of earlier runs which did not run in this process are kept.
+        """
+        path = path or self.path
+        if not path:
+            return
+        report = self.report()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                stages = json.load(f).get("stages", {})
+            report["stages"] = {**stages, **report["stages"]}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+
+def jsonl_hook(path: str) -> Callable[[str, str, dict], None]:
+    """
+    Hook appending every finished stage to a JSONL file.
+    """
+    lock = threading.Lock()
+
+    def hook(event: str, stage: str, values: dict):
+        if event == "end":
+            with lock, open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"stage": stage, **values}) + "\n")
+
+    return hook
+
+
+# metrics of the batch steps, add hooks with metrics.add_hook
+metrics = Metrics()
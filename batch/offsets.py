@@ -0,0 +1,165 @@
+import mmap
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from batch.storage import compression_of
+
+# the custom_id key of a result line, quotes inside the JSON strings of the response are escaped and never match
+CUSTOM_ID_PATTERN = re.compile(rb'(?<!\\)"custom_id":\s*"([^"\\]*)"')
+
+
+class LineScanner:
+    """
+    Collect the (custom_id, offset, length) of every line of a JSONL stream while it is written chunk by chunk.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.tail = b""
+        self.entries = []
+
+    def _line(self, data: bytes, start: int, end: int):
+        match = CUSTOM_ID_PATTERN.search(data, start, end)
+        if match:
+            self.entries.append((match.group(1).decode("utf-8"), self.offset + start, end - start))
+
+    def feed(self, chunk: bytes):
+        data = self.tail + chunk if self.tail else chunk
+        start = 0
+        while (end := data.find(b"\n", start)) >= 0:
+            self._line(data, start, end + 1)
+            start = end + 1
+        self.offset += start
+        self.tail = data[start:]
+
+    def close(self) -> list:
+        if self.tail.strip():
+            self._line(self.tail, 0, len(self.tail))
+        self.offset += len(self.tail)
+        self.tail = b""
+        return self.entries
+
+
+class OffsetIndex:
+    """
+    Index of custom_id -> (file, byte offset, length) of the lines of the downloaded output and error files, so the
+    raw result of a single request is read back with a memory-mapped reader instead of scanning every file. The index
+    is filled during the download in the same streaming pass, only uncompressed files can be indexed.
+
+    A custom_id is found in several files when its request was retried, the file indexed last is used.
+
+    :param path: path of the SQLite database
+    """
+
+    def __init__(self, path: str = "batch/batch_output/offsets.db"):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS offsets (
+                    custom_id TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    added REAL NOT NULL,
+                    PRIMARY KEY (custom_id, path)
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS offsets_path ON offsets (path)")
+        self.maps = {}
+
+    def add(self, path: str, entries: list):
+        """
+        Replace the entries of a file with a list of (custom_id, offset, length).
+        """
+        added = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM offsets WHERE path = ?", (path,))
+            self.conn.executemany("INSERT OR REPLACE INTO offsets VALUES (?, ?, ?, ?, ?)",
+                                  ((custom_id, path, offset, length, added) for custom_id, offset, length in entries))
+        self._unmap(path)
+
+    def index_file(self, path: str, chunk_size: int = 1024 * 1024) -> int:
+        """
+        Index a file which has been downloaded without index, returns the number of lines indexed.
+        """
+        if compression_of(path):
+            raise ValueError("Compressed files can not be indexed")
+        scanner = LineScanner()
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                scanner.feed(chunk)
+        entries = scanner.close()
+        self.add(path, entries)
+        return len(entries)
+
+    def locate(self, custom_id: str) -> tuple | None:
+        """
+        :return: (path, offset, length) of the last indexed line of the custom_id, None if it is not indexed
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT path, offset, length FROM offsets WHERE custom_id = ? ORDER BY added DESC LIMIT 1",
+                (custom_id,)).fetchone()
+
+    def locate_all(self, custom_id: str) -> list:
+        with self.lock:
+            return self.conn.execute("SELECT path, offset, length FROM offsets WHERE custom_id = ? ORDER BY added",
+                                     (custom_id,)).fetchall()
+
+    def _map(self, path: str) -> mmap.mmap:
+        with self.lock:
+            if path not in self.maps:
+                with open(path, "rb") as f:
+                    self.maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.maps[path]
+
+    def _unmap(self, path: str):
+        with self.lock:
+            mapped = self.maps.pop(path, None)
+            if mapped is not None:
+                mapped.close()
+
+    def read_line(self, custom_id: str) -> bytes | None:
+        """
+        Raw line of a custom_id, read from the memory-mapped file.
+        """
+        location = self.locate(custom_id)
+        if location is None:
+            return None
+        path, offset, length = location
+        return self._map(path)[offset:offset + length]
+
+    def read(self, custom_id: str) -> dict | None:
+        import json
+
+        line = self.read_line(custom_id)
+        return json.loads(line) if line is not None else None
+
+    def format(self, custom_id: str, schema=None) -> dict | None:
+        """
+        Format the raw result of a custom_id again, e.g. with a new schema, without parsing the whole output file.
+        None if the custom_id is not indexed or its last attempt failed (a line of an error file).
+        """
+        from batch.batch_steps import format_json_batch
+
+        data = self.read(custom_id)
+        if data is None or "choices" not in (data.get("response") or {}).get("body", {}):
+            return None
+        return format_json_batch(data, schema=schema)
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM offsets").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            for path in list(self.maps):
+                self._unmap(path)
+            self.conn.close()
@@ -0,0 +1,47 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+
+def iter_chunks(iterable: Iterable, size: int) -> Iterator[list]:
+    """
+    Split an iterable into lists of at most `size` items without materializing it.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bounded_map(fn: Callable, iterable: Iterable, workers: int = 1, max_pending: int = None,
+                initializer: Callable = None, initargs: tuple = ()) -> Iterator:
+    """
+    Ordered map over a process pool which only keeps `max_pending` tasks in flight, so the input is consumed lazily
+    and memory stays flat however long the iterable is. With workers <= 1 everything runs in the current process.
+
+    :param fn: picklable function applied to every item
+    :param iterable: input items, consumed lazily
+    :param workers: number of worker processes
+    :param max_pending: maximum number of submitted but not yet yielded tasks, default 2 * workers
+    :param initializer: optional per-process initializer
+    :param initargs: arguments of the initializer
+    :return: iterator of results in input order
+    """
+    if workers is None or workers <= 1:
+        if initializer:
+            initializer(*initargs)
+        yield from map(fn, iterable)
+        return
+
+    max_pending = max_pending or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
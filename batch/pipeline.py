@@ -0,0 +1,319 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+
+from LLM.cache import ExtractionCache
+from batch.batch_steps import TERMINAL_STATUSES, OutputMerger, _format_output_file, _init_merge_worker, \
+    download_batch, retrieve_batch, step_create_batches, upload_with_pool
+from batch.keys import IN_FLIGHT_STATES, KeyPool
+from batch.manifest import Manifest
+from batch.metrics import metrics
+from batch.offsets import OffsetIndex
+from batch.sinks import OUTPUT_FORMATS, open_sink, write_records
+from batch.storage import COMPRESSION_EXTENSIONS
+from schema.schema import Object
+from settings import batch_compression, batch_key, batch_keys, batch_model
+
+
+class Pipeline:
+    """
+    Run create, upload, download and merge as concurrent stages connected by queues instead of one blocking step after
+    the other. Every batch file is uploaded as soon as it is written, downloaded as soon as its batch is completed and
+    merged right away into the output, so a large run takes about as long as its slowest batch instead of the sum of
+    all steps. Failed requests are written into retry files (see write_retry_batches) which go through the stages
+    again until every request succeeded or used up its retries.
+
+    The manifest records the state of every file as in the single steps, so an interrupted run is continued by
+    Pipeline.run() without texts: created files are uploaded, running batches are polled and downloaded outputs are
+    merged again.
+
+        pipeline = Pipeline(schema, keys={"key1": 50, "key2": 50})
+        path = pipeline.run(df["文本"], prefix="2024")
+
+    :param schema: schema of the requests and of the merged output
+    :param keys: list of keys, dict of key -> quota of batches in flight or KeyPool, default settings.batch_keys
+    :param key: API key used if neither keys nor settings.batch_keys are set, default settings.batch_key
+    :param upload_workers: number of upload threads
+    :param poll_workers: number of threads polling and downloading the batches
+    :param min_interval: seconds between polls of a batch which is making progress
+    :param max_interval: upper bound of the poll interval of a batch which is not making progress
+    :param retries: number of retries of transient API errors
+    :param max_retries: maximum number of retry rounds of a failed request, 0 disables retries
+    :param output_format: "jsonl", "parquet" or "arrow"
+    :param chunk_size: number of records per written chunk (row group)
+    :param compression: None, "gzip" or "zstd" compression of the batch files and of the JSONL output
+    :param cache: extraction cache of step_create_batches and of the merge
+    :param manifest: manifest of the batch files, default batch/manifest.db
+    :param cooldown: seconds a key is skipped after a rate limit error, doubled on every further error
+    :param index: if True index the lines of uncompressed downloads in batch/batch_output/offsets.db, see OffsetIndex
+    :param max_poll_failures: number of consecutive failed polls after which a batch is given up as failed and its
+        requests are retried
+    """
+
+    def __init__(self, schema: Object = None, keys=None, key: str = "", upload_workers: int = 4,
+                 poll_workers: int = 8, min_interval: float = 30, max_interval: float = 600, retries: int = 3,
+                 max_retries: int = 2, output_format: str = "jsonl", chunk_size: int = 10000,
+                 compression: str = batch_compression, cache: ExtractionCache = None, manifest: Manifest = None,
+                 cooldown: float = 60, index: bool = True, max_poll_failures: int = 5):
+        self.schema = schema
+        self.manifest = manifest or Manifest()
+        if isinstance(keys, KeyPool):
+            self.pool = keys
+        else:
+            self.pool = KeyPool(keys or batch_keys or [key or batch_key], manifest=self.manifest, cooldown=cooldown)
+        self.upload_workers = upload_workers
+        self.poll_workers = poll_workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.retries = retries
+        self.max_retries = max_retries
+        self.output_format = output_format
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.cache = cache
+        self.index = index
+        self.offsets = None
+        self.max_poll_failures = max_poll_failures
+
+        self.upload_queue = queue.Queue()
+        self.poll_queue = queue.Queue()
+        self.merge_queue = queue.Queue()
+        # number of files which entered a stage and are not merged or given up yet
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.merger = None
+        self.merged_rows = []
+        self.n_records = 0
+        # batches which hold a slot of their key in the pool: uploaded in this run or in flight when the pool was
+        # created, completed batches of an earlier run hold none
+        self.held = set()
+
+    def _add(self, n: int = 1):
+        with self.condition:
+            self.pending += n
+
+    def _done(self):
+        with self.condition:
+            self.pending -= 1
+            self.condition.notify_all()
+
+    def _wait(self):
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+    def submit(self, path: str):
+        """
+        Queue a batch input file for upload, called by the create stage for every finished file.
+        """
+        self._add()
+        self.upload_queue.put(path)
+
+    def _resume(self, created: bool):
+        if created:
+            for row in self.manifest.files(states=("created",)):
+                if os.path.exists(row["file_path"]):
+                    self.submit(row["file_path"])
+        for row in self.manifest.files(states=IN_FLIGHT_STATES + ("completed",)):
+            if row["state"] in IN_FLIGHT_STATES:
+                self.held.add(row["batch_id"])
+            self._add()
+            self.poll_queue.put((row["batch_id"], row["key"]))
+        # merged outputs are merged again, the output file always holds all results like with step_merge_output
+        for row in self.manifest.files(states=("downloaded", "merged", "failed")):
+            self._add()
+            self.merge_queue.put(row)
+
+    # upload stage
+    def _upload_loop(self):
+        while (path := self.upload_queue.get()) is not None:
+            try:
+                batch_id = upload_with_pool(path, self.pool, manifest=self.manifest, retries=self.retries,
+                                            block=True)
+            except Exception as e:
+                print(f"Failed to upload {path}: {e}")
+                metrics.count("upload", failed=1)
+                self._done()
+                continue
+            self.held.add(batch_id)
+            self.poll_queue.put((batch_id, self.manifest.get(path)["key"]))
+
+    # download stage
+    def _download(self, batch_id: str, key: str, output_file_id: str | None, error_file_id: str | None):
+        try:
+            if not download_batch(batch_id, key, output_file_id, error_file_id, manifest=self.manifest,
+                                  compression=self.compression, retries=self.retries, offsets=self.offsets):
+                metrics.count("download", failed_batches=1)
+                print(f"Batch {batch_id} failed, downloaded its error file.")
+        except Exception as e:
+            print(f"Failed to download batch {batch_id}: {e}")
+            self._done()
+            return
+        self.merge_queue.put(self.manifest.get_batch(batch_id))
+
+    def _release(self, batch_id: str, key: str):
+        # the batch no longer counts against the quota of its key
+        if batch_id in self.held:
+            self.held.discard(batch_id)
+            self.pool.release(key)
+
+    def _poll_loop(self):
+        outstanding = {}
+        failures = {}
+        states = {}
+        next_poll = {}
+        intervals = {}
+        progress = {}
+        stopping = False
+        with ThreadPoolExecutor(max_workers=self.poll_workers) as executor:
+            while not stopping or outstanding:
+                # take the new batches, waiting at most until the next poll is due
+                timeout = max(0.0, min(next_poll.values()) - time.time()) if next_poll else None
+                try:
+                    item = self.poll_queue.get(timeout=timeout)
+                    while True:
+                        if item is None:
+                            stopping = True
+                        else:
+                            batch_id, key = item
+                            outstanding[batch_id] = key
+                            states[batch_id] = self.manifest.get_batch(batch_id)["state"]
+                            next_poll[batch_id] = 0.0
+                            intervals[batch_id] = self.min_interval
+                        item = self.poll_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+                now = time.time()
+                polls = {executor.submit(retrieve_batch, batch_id, outstanding[batch_id], self.retries): batch_id
+                         for batch_id, t in next_poll.items() if t <= now}
+                for future in as_completed(polls):
+                    batch_id = polls[future]
+                    try:
+                        batch_job = future.result()
+                    except Exception as e:
+                        print(f"Failed to retrieve batch {batch_id}: {e}")
+                        failures[batch_id] = failures.get(batch_id, 0) + 1
+                        if failures[batch_id] < self.max_poll_failures:
+                            next_poll[batch_id] = now + intervals[batch_id]
+                            continue
+                        # given up, merged without output so that all its requests are retried
+                        self._release(batch_id, outstanding.pop(batch_id))
+                        del next_poll[batch_id]
+                        self.manifest.set_state(batch_id, "failed")
+                        metrics.count("download", failed_batches=1)
+                        print(f"Batch {batch_id} given up after {failures[batch_id]} failed polls.")
+                        self.merge_queue.put(self.manifest.get_batch(batch_id))
+                        continue
+                    failures.pop(batch_id, None)
+
+                    if batch_job.status in TERMINAL_STATUSES or batch_job.output_file_id:
+                        key = outstanding.pop(batch_id)
+                        del next_poll[batch_id]
+                        self._release(batch_id, key)
+                        if batch_job.output_file_id:
+                            self.manifest.set_state(batch_id, "completed")
+                        error_file_id = getattr(batch_job, "error_file_id", None)
+                        if batch_job.output_file_id or error_file_id:
+                            executor.submit(self._download, batch_id, key, batch_job.output_file_id, error_file_id)
+                        else:
+                            # merged without output, so that all its requests are retried
+                            self.manifest.set_state(batch_id, "failed")
+                            metrics.count("download", failed_batches=1)
+                            print(f"Batch {batch_id} {batch_job.status} without output.")
+                            self.merge_queue.put(self.manifest.get_batch(batch_id))
+                        continue
+
+                    if states[batch_id] == "uploaded" and batch_job.status in ("in_progress", "finalizing"):
+                        self.manifest.set_state(batch_id, "in_progress")
+                        states[batch_id] = "in_progress"
+
+                    counts = batch_job.request_counts
+                    done = (counts.completed + counts.failed) if counts else 0
+                    if done > progress.get(batch_id, 0):
+                        intervals[batch_id] = self.min_interval
+                    else:
+                        intervals[batch_id] = min(intervals[batch_id] * 2, self.max_interval)
+                    progress[batch_id] = done
+                    next_poll[batch_id] = now + intervals[batch_id]
+
+    # merge stage
+    def _iter_merged(self):
+        _init_merge_worker(self.schema, self.cache is not None, self.max_retries > 0)
+        while (row := self.merge_queue.get()) is not None:
+            try:
+                messages = self.merger.add(row, _format_output_file(row))
+            except Exception as e:
+                print(f"Failed to merge batch {row['batch_id']}: {e}")
+                self._done()
+                continue
+            self.merged_rows.append(row)
+            self._done()
+            yield from messages
+        yield from self.merger.iter_remaining()
+
+    def _merge_loop(self, path: str):
+        with open_sink(path, output_format=self.output_format, schema=self.schema) as sink:
+            self.n_records = write_records(sink, self._iter_merged(), chunk_size=self.chunk_size)
+
+    def run(self, text_dict=None, prefix: str = "", model: str = batch_model, workers: int = 1,
+            max_tokens_per_file: int = None, rules: str = None, dedup: float = None) -> str:
+        """
+        Create the batch files of the texts and run all stages until every file is merged, see step_create_batches.
+        Without texts the files of an interrupted run are continued.
+
+        :return: path of the output file
+        """
+        os.makedirs("batch/batch_output", exist_ok=True)
+        os.makedirs("batch/processed", exist_ok=True)
+        path = f"batch/processed/output{OUTPUT_FORMATS[self.output_format]}"
+        if self.output_format == "jsonl":
+            path += COMPRESSION_EXTENSIONS[self.compression]
+        self.merger = OutputMerger(schema=self.schema, cache=self.cache)
+        if self.index and not self.compression and self.offsets is None:
+            self.offsets = OffsetIndex()
+        self.merged_rows = []
+
+        with ExitStack() as stages:
+            for stage in ("pipeline", "upload", "download", "merge"):
+                stages.enter_context(metrics.timed(stage))
+            threads = [threading.Thread(target=self._upload_loop, daemon=True) for _ in range(self.upload_workers)]
+            threads.append(threading.Thread(target=self._poll_loop, daemon=True))
+            merge_thread = threading.Thread(target=self._merge_loop, args=(path,), daemon=True)
+            for thread in threads + [merge_thread]:
+                thread.start()
+
+            self._resume(created=text_dict is None)
+            if text_dict is not None:
+                step_create_batches(text_dict, schema=self.schema, prefix=prefix, model=model, workers=workers,
+                                    cache=self.cache, max_tokens_per_file=max_tokens_per_file, rules=rules,
+                                    manifest=self.manifest, on_file=self.submit, dedup=dedup,
+                                    compression=self.compression)
+            while True:
+                self._wait()
+                if not self.max_retries:
+                    break
+                paths = self.merger.write_retries(max_retries=self.max_retries, compression=self.compression,
+                                                  manifest=self.manifest)
+                if not paths:
+                    break
+                for retry_path in paths:
+                    self.submit(retry_path)
+
+            for _ in range(self.upload_workers):
+                self.upload_queue.put(None)
+            self.poll_queue.put(None)
+            self.merge_queue.put(None)
+            for thread in threads + [merge_thread]:
+                thread.join()
+
+            for row in self.merged_rows:
+                if row["state"] != "failed":
+                    self.manifest.set_state(row["batch_id"], "merged")
+            metrics.count("merge", records=self.n_records)
+        print(f"Merged {self.n_records} results into {path}. "
+              f"Parsed responses: {self.merger.parse_summary() or 'none'}")
+        return path
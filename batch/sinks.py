@@ -0,0 +1,148 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator
+
+from batch.storage import open_file, strip_compression
+from schema.schema import Object, Number, Date
+
+
+class Sink(ABC):
+    """
+    Base class of the merged output writers. Records are appended chunk by chunk with write().
+    """
+
+    @abstractmethod
+    def write(self, records: list):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class JsonlSink(Sink):
+    """
+    Append records to a JSONL file, one JSON object per line, compressed if the path ends with .gz or .zst.
+
+    :param path: str, the path of the output file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open_file(path, 'w')
+
+    def write(self, records: list):
+        self.file.writelines(json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in records)
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowSink(Sink):
+    """
+    Append records to a chunked columnar file, one record batch (row group) per write. The columns are typed by the
+    fields of the schema: Number(unit=True) is float64, everything else is a string and nested values are stored as
+    JSON strings. Requires pyarrow.
+
+    :param path: str, the path of the output file
+    :param schema: Object, the schema of the records
+    :param file_format: str, "parquet" or "arrow" (Arrow IPC file)
+    """
+
+    def __init__(self, path: str, schema: Object = None, file_format: str = "parquet"):
+        if not schema:
+            raise ValueError("A schema is required to write columnar output.")
+        import pyarrow as pa
+
+        self.path = path
+        self.pa = pa
+        self.columns = {}
+        for field in schema.fields:
+            self.columns[field.id] = pa.float64() if isinstance(field, Number) and field.unit else pa.string()
+            if field.keep:
+                self.columns[field.id + "_raw"] = pa.string()
+        self.columns["custom_id"] = pa.string()
+        self.arrow_schema = pa.schema(list(self.columns.items()))
+        self.dates = {field.id for field in schema.fields if isinstance(field, Date)}
+
+        if file_format == "parquet":
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.arrow_schema)
+        elif file_format == "arrow":
+            self.writer = pa.ipc.new_file(path, self.arrow_schema)
+        else:
+            raise ValueError("Invalid file format")
+
+    def _to_column(self, name, values):
+        if self.columns[name] == self.pa.string():
+            values = [value if value is None or isinstance(value, str) else
+                      str(value) if name in self.dates else json.dumps(value, ensure_ascii=False)
+                      for value in values]
+        return self.pa.array(values, type=self.columns[name])
+
+    def write(self, records: list):
+        if not records:
+            return
+        arrays = [self._to_column(name, [record.get(name) for record in records]) for name in self.columns]
+        self.writer.write_batch(self.pa.record_batch(arrays, schema=self.arrow_schema))
+
+    def close(self):
+        self.writer.close()
+
+
+OUTPUT_FORMATS = {"jsonl": ".jsonl", "parquet": ".parquet", "arrow": ".arrow"}
+
+
+def open_sink(path: str, output_format: str = "jsonl", schema: Object = None) -> Sink:
+    if output_format == "jsonl":
+        return JsonlSink(path)
+    elif output_format in ("parquet", "arrow"):
+        return ArrowSink(path, schema=schema, file_format=output_format)
+    else:
+        raise ValueError("Invalid output format")
+
+
+def iter_records(path: str, batch_size: int = 10000) -> Iterator[dict]:
+    """
+    Stream the records of a merged output file (.jsonl, .parquet or .arrow) without loading it fully.
+    """
+    extension = os.path.splitext(strip_compression(path))[1]
+    if extension == ".jsonl":
+        with open_file(path, 'r') as f:
+            for line in f:
+                yield json.loads(line)
+    elif extension == ".parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield from batch.to_pylist()
+    elif extension == ".arrow":
+        import pyarrow as pa
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield from reader.get_batch(i).to_pylist()
+    else:
+        raise ValueError("Invalid output format")
+
+
+def write_records(sink: Sink, records: Iterable[dict], chunk_size: int = 10000) -> int:
+    """
+    Write records to a sink in chunks of chunk_size rows and return the number of records written.
+    """
+    n_records = 0
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            sink.write(chunk)
+            n_records += len(chunk)
+            chunk = []
+    sink.write(chunk)
+    return n_records + len(chunk)
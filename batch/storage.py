@@ -0,0 +1,82 @@
+import gzip
+import io
+import os
+from glob import glob
+
+# file extension of every supported compression, None stores plain files
+COMPRESSION_EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def compression_of(path: str) -> str | None:
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if compression and path.endswith(extension):
+            return compression
+    return None
+
+
+def strip_compression(path: str) -> str:
+    extension = COMPRESSION_EXTENSIONS[compression_of(path)]
+    return path[:-len(extension)] if extension else path
+
+
+def open_file(path: str, mode: str = 'r', compression: str = "infer"):
+    """
+    Open a plain, gzip or zstd compressed file as a stream. Text modes use utf-8.
+
+    :param path: str, the path of the file
+    :param mode: str, "r", "w", "a" with an optional "b" for binary mode
+    :param compression: str, None, "gzip" or "zstd", "infer" detects it from the file extension
+    """
+    if compression == "infer":
+        compression = compression_of(path)
+    binary = "b" in mode
+    encoding = None if binary else 'utf-8'
+    if compression is None:
+        return open(path, mode, encoding=encoding)
+    mode = mode if binary else mode.replace("t", "") + "t"
+    if compression == "gzip":
+        return gzip.open(path, mode, compresslevel=6, encoding=encoding)
+    elif compression == "zstd":
+        import zstandard
+        if "r" in mode:
+            # files written with checkpoints consist of several frames
+            f = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+            return f if binary else io.TextIOWrapper(f, encoding=encoding)
+        return zstandard.open(path, mode, encoding=encoding)
+    raise ValueError("Invalid compression")
+
+
+def open_member(raw, compression: str = None):
+    """
+    Start a compressed member (gzip) or frame (zstd) on an open binary file. Closing the returned stream finishes the
+    member without closing the file, so a file can be checkpointed and later continued after truncating it to the
+    end of its last complete member. Without compression the file itself is returned.
+    """
+    if compression is None:
+        return raw
+    elif compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+    elif compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    raise ValueError("Invalid compression")
+
+
+def read_payload(path: str) -> bytes:
+    """
+    Read the uncompressed content of a file, e.g. the exact payload of a batch upload.
+    """
+    with open_file(path, 'rb') as f:
+        return f.read()
+
+
+def list_jsonl(directory: str) -> list:
+    """
+    List the JSONL files of a directory, plain or compressed.
+    """
+    return [path for path in glob(f"{directory}/*.jsonl*")
+            if strip_compression(path).endswith(".jsonl")]
+
+
+def file_stem(path: str) -> str:
+    return os.path.basename(path).split(".")[0]
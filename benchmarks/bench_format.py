@@ -0,0 +1,64 @@
+"""
+Micro-benchmark of format_json_response: the per-response implementation before the compiled formatter plan against
+the plan compiled once by Object.compile().
+
+    python -m benchmarks.bench_format
+"""
+import json
+import re
+import time
+
+from schema.schema import Object, Text, Number
+from schema.utils import format_by_field, format_json_response
+
+
+def format_json_response_legacy(json_str: str, schema: Object = None) -> dict | None:
+    try:
+        json_pattern = r'```json\n(.*?)\n```'
+        json_str = re.search(json_pattern, json_str, re.DOTALL).group(1)
+        result = json.loads(json_str)
+
+        if not schema:
+            return result
+
+        formatted = {}
+        for field in schema.fields:
+            formatted[field.id] = format_by_field(field, result)
+            if field.keep:
+                formatted[field.id + "_raw"] = result.get(field.id)
+        return formatted
+    except Exception:
+        return None
+
+
+def make_responses(n: int) -> list:
+    amounts = ["350.5万元", "386192.5元", "1.2亿元", "238,000.00元", "伍拾万元"]
+    return ["```json\n" + json.dumps({
+        "项目编号": f"XFZC2018-{i:06d}",
+        "预算金额": amounts[i % len(amounts)],
+        "商品明细": [{"名称": f"商品{i}", "数量": "2", "单价": "200元"}],
+        "采购人名称": "澄迈县加乐镇人民政府",
+    }, ensure_ascii=False, indent=2) + "\n```" for i in range(n)]
+
+
+def measure(fn, responses: list, schema: Object) -> float:
+    start = time.perf_counter()
+    for response in responses:
+        fn(response, schema)
+    return len(responses) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    schema = Object(fields=[
+        Text("项目编号"),
+        Number("预算金额", unit=True, keep=True),
+        Text("商品明细"),
+        Text("采购人名称"),
+    ])
+    responses = make_responses(100000)
+    assert all(format_json_response(r, schema) == format_json_response_legacy(r, schema) for r in responses[:1000])
+
+    before = measure(format_json_response_legacy, responses, schema)
+    after = measure(format_json_response, responses, schema)
+    print(f"before: {before:,.0f} responses/s")
+    print(f"after:  {after:,.0f} responses/s ({after / before:.2f}x)")
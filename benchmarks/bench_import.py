@@ -0,0 +1,93 @@
+"""
+Import time of the library modules and the CLI, measured in fresh interpreters. Every module has a time budget and a
+list of heavy dependencies which must not be imported with it, the benchmark exits with an error when one of them is
+exceeded so that it can guard against regressions in CI.
+
+    python -m benchmarks.bench_import
+    python -m benchmarks.bench_import --repeat 10 --save
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.bench_pipeline import REPO, version
+
+HEAVY = ["pandas", "numpy", "zhipuai", "tqdm", "cn2an", "langchain", "langchain_core", "langchain_openai",
+         "langchain_ollama", "pyarrow", "zstandard"]
+
+# module -> budget in seconds, measured in a subprocess including the interpreter startup
+BUDGETS = {
+    "batch.batch_steps": 0.5,
+    "batch.sinks": 0.5,
+    "LLM.chains": 0.5,
+    "LLM.engine": 0.5,
+    "LLM.router": 0.5,
+    "schema.utils": 0.5,
+    "cli": 0.5,
+}
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(seconds, ",".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def measure(module: str, repeat: int) -> dict:
+    wall, imports, heavy = [], [], ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)], cwd=REPO,
+                                capture_output=True, text=True, check=True).stdout.split()
+        wall.append(time.perf_counter() - start)
+        imports.append(float(output[0]))
+        heavy = output[1] if len(output) > 1 else ""
+    return {"wall_seconds": round(min(wall), 4), "import_seconds": round(min(imports), 4),
+            "heavy_imports": heavy.split(",") if heavy else []}
+
+
+def baseline(repeat: int) -> float:
+    wall = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], cwd=REPO, check=True)
+        wall.append(time.perf_counter() - start)
+    return min(wall)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the library modules")
+    parser.add_argument("--repeat", type=int, default=5, help="best of repeat fresh interpreters")
+    parser.add_argument("--save", action="store_true", help="save the results in benchmarks/results")
+    parser.add_argument("--results-dir", default=os.path.join(REPO, "benchmarks", "results"))
+    args = parser.parse_args()
+
+    startup = baseline(args.repeat)
+    print(f"{'module':<20} {'import':>9} {'wall':>9} {'budget':>8}  heavy imports (interpreter {startup:.3f}s)")
+    results, failures = {}, []
+    for module, budget in BUDGETS.items():
+        result = measure(module, args.repeat)
+        results[module] = {**result, "budget_seconds": budget}
+        print(f"{module:<20} {result['import_seconds']:8.3f}s {result['wall_seconds']:8.3f}s {budget:7.2f}s  "
+              f"{', '.join(result['heavy_imports']) or '-'}")
+        if result["wall_seconds"] > budget:
+            failures.append(f"{module} took {result['wall_seconds']:.3f}s, budget {budget:.2f}s")
+        if result["heavy_imports"]:
+            failures.append(f"{module} imports {', '.join(result['heavy_imports'])}")
+
+    if args.save:
+        os.makedirs(args.results_dir, exist_ok=True)
+        path = f"{args.results_dir}/import_{version()}_{time.strftime('%Y%m%d_%H%M%S')}.json"
+        with open(path, "w") as f:
+            json.dump({"version": version(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": platform.python_version(), "platform": platform.platform(),
+                       "interpreter_seconds": round(startup, 4), "modules": results}, f, indent=2)
+        print(f"Saved {path}")
+    if failures:
+        sys.exit("\n".join(failures))
@@ -0,0 +1,209 @@
+"""
+End-to-end benchmark of the batch pipeline against the local mock of the ZhipuAI files and batches API, on synthetic
+procurement notices. Every stage (create, upload, download, merge, format, and optionally online extraction through
+the chat stub) reports its wall time, throughput and peak memory (RSS of the main process). The results are saved as
+JSON in benchmarks/results so that versions can be compared.
+
+    python -m benchmarks.bench_pipeline --rows 10000 100000 1000000
+    python -m benchmarks.bench_pipeline --rows 10000 --error-rate 0.01 --latency 0.05 --online 200
+    python -m benchmarks.bench_pipeline --compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from glob import glob
+
+import batch.batch_steps as batch_steps
+from benchmarks.chat_stub import ChatStub
+from benchmarks.corpus import write_corpus
+from benchmarks.mock_zhipu import MockZhipuAI
+from schema.schema import Object, Text, Number
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Stage:
+    """
+    Measure the wall time and the peak RSS of a block, the RSS is sampled by a background thread.
+    """
+
+    def __init__(self, results: dict, name: str, rows: int, interval: float = 0.01):
+        self.results = results
+        self.name = name
+        self.rows = rows
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.base = rss()
+        self.peak = self.base
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        seconds = time.perf_counter() - self.start
+        self.running = False
+        self.thread.join()
+        self.results[self.name] = {"seconds": round(seconds, 3), "rows_per_s": round(self.rows / seconds, 1),
+                                   "peak_rss_mb": round(self.peak / 2 ** 20, 1),
+                                   "rss_growth_mb": round((self.peak - self.base) / 2 ** 20, 1)}
+        print(f"  {self.name:<9} {seconds:9.2f}s {self.rows / seconds:12,.0f} rows/s "
+              f"{self.peak / 2 ** 20:9.1f} MB peak RSS")
+
+
+def make_schema() -> Object:
+    return Object(prompt_system="你擅长从文本中提取关键信息。", description="# Role: 文本提取专家\n", fields=[
+        Text("项目编号", "项目编号，确定特定的项目。", ["XFZC2018-015", "包采谈〔2018〕1096号"]),
+        Number("预算金额", "预算金额，单位为万元或元。", ["350.5万元", "386192.5元"], unit=True),
+    ], complete_example={"项目编号": "包采谈〔2018〕1096号", "预算金额": "23.5万元"})
+
+
+def version() -> str:
+    try:
+        return subprocess.run(["git", "-C", REPO, "describe", "--always", "--dirty"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_online(results: dict, texts: list, schema: Object, args):
+    from langchain_openai import ChatOpenAI
+    from LLM.chains import create_extractor_chain
+    from LLM.engine import extract_many
+
+    with ChatStub(latency=args.chat_latency, failure_rate=args.chat_failure_rate) as stub:
+        llm = ChatOpenAI(model="stub", openai_api_key="stub", openai_api_base=stub.url + "/v1", max_retries=0)
+        chain_extractor = create_extractor_chain(schema, llm=llm)
+        with Stage(results, "online", len(texts)):
+            extract_many(texts, chain_extractor, schema=schema, concurrency=args.concurrency, backoff=0.1)
+
+
+def run(rows: int, args) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"bench_{rows}_", dir=args.workdir)
+    data_dir = os.path.abspath(f"{args.data_dir}/{rows}")
+    print(f"{rows:,} rows (data {data_dir}, work {workdir})")
+    paths = write_corpus(rows, data_dir, shard_rows=args.shard_rows)
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    mock = MockZhipuAI(f"{workdir}/mock", latency=args.latency, failure_rate=args.failure_rate,
+                       error_rate=args.error_rate, bad_json_rate=args.bad_json_rate,
+                       processing_seconds=args.processing_seconds)
+    batch_steps.get_client = mock.client_for
+    schema = make_schema()
+    stages = {}
+    try:
+        with Stage(stages, "create", rows):
+            batch_steps.step_create_batches_chunks(schema, paths, chunk_size=args.chunk_files, text_column="文本",
+                                                   workers=args.workers, compression=args.compression)
+        with Stage(stages, "upload", rows):
+            batch_steps.step_upload_batches(workers=args.upload_workers, key="bench")
+        with Stage(stages, "download", rows):
+            batch_steps.step_download_output(wait=True, min_interval=0.1, max_interval=1,
+                                             compression=args.compression)
+        with Stage(stages, "merge", rows):
+            batch_steps.step_merge_output(schema, workers=args.workers, output_format=args.output_format,
+                                          compression=args.compression, max_retries=0)
+
+        # formatting alone, on the raw responses of the downloaded files
+        contents = []
+        for path in glob("batch/batch_output/*.jsonl*"):
+            if "_error" not in path:
+                with batch_steps.open_file(path) as f:
+                    contents.extend(json.loads(line)["response"]["body"]["choices"][0]["message"]["content"]
+                                    for line in f)
+        with Stage(stages, "format", len(contents)):
+            for content in contents:
+                batch_steps.format_json_response(content, schema)
+        del contents
+
+        if args.online:
+            import pandas as pd
+            texts = pd.read_parquet(paths[0], columns=["文本"])["文本"].tolist()[:args.online]
+            run_online(stages, texts, schema, args)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            import shutil
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {"version": version(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "platform": platform.platform(), "rows": rows, "mock_api_calls": mock.calls,
+            "params": {key: value for key, value in vars(args).items() if key not in ("rows", "compare")},
+            "stages": stages, "pipeline_metrics": batch_steps.metrics.report()["stages"]}
+
+
+def compare(path_a: str, path_b: str):
+    with open(path_a) as f:
+        a = json.load(f)
+    with open(path_b) as f:
+        b = json.load(f)
+    print(f"{'stage':<9} {a['version']:>14} {b['version']:>14} {'speedup':>8} {'RSS a':>9} {'RSS b':>9}")
+    for stage in a["stages"]:
+        if stage not in b["stages"]:
+            continue
+        sa, sb = a["stages"][stage], b["stages"][stage]
+        print(f"{stage:<9} {sa['seconds']:13.2f}s {sb['seconds']:13.2f}s {sa['seconds'] / sb['seconds']:7.2f}x "
+              f"{sa['peak_rss_mb']:6.0f} MB {sb['peak_rss_mb']:6.0f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the batch pipeline against a mock batch API")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000])
+    parser.add_argument("--compare", nargs=2, metavar=("A", "B"), help="compare two saved results")
+    parser.add_argument("--data-dir", default=os.path.join(REPO, "benchmarks", "data"))
+    parser.add_argument("--results-dir", default=os.path.join(REPO, "benchmarks", "results"))
+    parser.add_argument("--workdir", default=None, help="parent of the temporary working directories")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    parser.add_argument("--shard-rows", type=int, default=10000)
+    parser.add_argument("--chunk-files", type=int, default=100, help="shards per batch prefix")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--upload-workers", type=int, default=4)
+    parser.add_argument("--compression", default=None, choices=["gzip", "zstd"])
+    parser.add_argument("--output-format", default="jsonl", choices=["jsonl", "parquet", "arrow"])
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of every mock API call")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of failing mock API calls")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests in the error files")
+    parser.add_argument("--bad-json-rate", type=float, default=0.0, help="share of unparsable responses")
+    parser.add_argument("--processing-seconds", type=float, default=0.0, help="seconds until a batch completes")
+    parser.add_argument("--online", type=int, default=0, help="texts extracted through the chat stub")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrency of the online extraction")
+    parser.add_argument("--chat-latency", type=float, default=0.05)
+    parser.add_argument("--chat-failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    for rows in args.rows:
+        result = run(rows, args)
+        path = f"{args.results_dir}/pipeline_{rows}_{result['version']}_{time.strftime('%Y%m%d_%H%M%S')}.json"
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Saved {path}")
@@ -0,0 +1,58 @@
+"""
+Benchmark of batch request rendering: create_batch_prompt with str.format and json.dumps of the whole request against
+the pre-serialized request template of the schema.
+
+    python -m benchmarks.bench_prompts
+"""
+import json
+import time
+
+from batch.batch_steps import create_batch_prompt
+from schema.schema import Object, Text, Number
+
+
+def make_texts(n: int, length: int = 2000) -> list:
+    sentence = "本项目为某市人民政府采购项目，项目编号：XFZC2018-015，预算金额：350.5万元。\n"
+    return [f"{i} " + sentence * (length // len(sentence)) for i in range(n)]
+
+
+def render_legacy(texts: list, schema: Object, model: str) -> int:
+    size = 0
+    for i, text in enumerate(texts):
+        size += len(json.dumps(create_batch_prompt(str(i).zfill(12), text, schema=schema, model=model),
+                               ensure_ascii=False) + '\n')
+    return size
+
+
+def render_template(texts: list, schema: Object, model: str) -> int:
+    template = schema.request_template(model)
+    size = 0
+    for i, text in enumerate(texts):
+        size += len(template.render("_split_" + str(i).zfill(12), text))
+    return size
+
+
+def measure(fn, texts: list, schema: Object, model: str = "glm-4-air") -> float:
+    start = time.perf_counter()
+    fn(texts, schema, model)
+    return len(texts) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    schema = Object(prompt_system="你擅长从文本中提取关键信息。", description="# Role: 文本提取专家\n" * 20, fields=[
+        Text("项目编号", "项目编号，确定特定的项目。", ["XFZC2018-015", "包采谈〔2018〕1096号"]),
+        Number("预算金额", "预算金额，单位为万元或元。", ["350.5万元", "386192.5元"], unit=True),
+    ], complete_example={"项目编号": "包采谈〔2018〕1096号", "预算金额": "23.5万元"})
+
+    for length in (500, 5000):
+        texts = make_texts(20000, length)
+        first = texts[0]
+        assert (json.dumps(create_batch_prompt("000000000000", first, schema=schema, model="glm-4-air"),
+                           ensure_ascii=False) + '\n' ==
+                schema.request_template("glm-4-air").render("_split_000000000000", first))
+
+        before = measure(render_legacy, texts, schema)
+        after = measure(render_template, texts, schema)
+        print(f"text length {length}:")
+        print(f"  before: {before:,.0f} requests/s")
+        print(f"  after:  {after:,.0f} requests/s ({after / before:.2f}x)")
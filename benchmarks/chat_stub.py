@@ -0,0 +1,90 @@
+"""
+OpenAI and Ollama compatible chat endpoint with configurable latency and failure rate, for benchmarks of the online
+extraction path without a model.
+
+    with ChatStub(latency=0.2) as stub:
+        llm = ChatOpenAI(model="stub", openai_api_key="stub", openai_api_base=stub.url + "/v1")
+        llm = ChatOllama(model="stub", base_url=stub.url)
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.corpus import answer_of
+
+
+class ChatStub:
+    """
+    Chat endpoint served from a background thread: POST /v1/chat/completions (OpenAI) and POST /api/chat (Ollama,
+    non-streaming). The answer is the extraction of benchmarks.corpus.answer_of from the last message.
+
+    :param latency: seconds of every request
+    :param failure_rate: share of requests failing with HTTP 500
+    :param host: host to bind
+    :param port: port to bind, 0 picks a free port
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self.thread = None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: dict):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                stub.requests += 1
+                time.sleep(stub.latency)
+                if random.random() < stub.failure_rate:
+                    return self._send(500, {"error": {"message": "stub failure"}})
+
+                content = answer_of(request["messages"][-1]["content"])
+                if self.path.endswith("/chat/completions"):
+                    return self._send(200, {
+                        "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+                        "model": request.get("model", "stub"),
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": content}}],
+                        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}})
+                if self.path == "/api/chat":
+                    return self._send(200, {
+                        "model": request.get("model", "stub"), "created_at": "2024-01-01T00:00:00Z",
+                        "message": {"role": "assistant", "content": content}, "done": True, "done_reason": "stop",
+                        "total_duration": 0, "prompt_eval_count": 0, "eval_count": 0})
+                self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+
+        return Handler
+
+    def start(self) -> "ChatStub":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
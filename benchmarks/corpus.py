@@ -0,0 +1,85 @@
+"""
+Synthetic procurement notice corpus for the pipeline benchmarks, written as shards like the chunk files of the
+batch pipeline. The texts carry a project number and a budget, which the mock endpoints return as their extraction.
+
+    python -m benchmarks.corpus --rows 100000 --out benchmarks/data
+"""
+import argparse
+import json
+import os
+import random
+import re
+
+REGIONS = ["江西省上饶市广丰区", "海南省澄迈县", "内蒙古自治区包头市昆都仑区", "辽宁省大连市甘井子区", "山东省滨州市沾化区",
+           "上海市杨浦区", "四川省成都市武侯区", "广东省深圳市南山区"]
+BUYERS = ["人民政府", "教育局", "卫生健康委员会", "文化体育新闻出版局", "交通运输局", "人民医院", "第一中学"]
+ITEMS = ["办公家具", "计算机设备", "医疗器械", "图书资料", "空调设备", "监控系统", "物业服务", "印刷服务"]
+UNITS = ["元", "万元"]
+PARAGRAPH = ("根据《中华人民共和国政府采购法》等有关规定，{buyer}就{item}采购项目进行公开招标，欢迎合格的供应商参加投标。"
+             "投标人须具备独立承担民事责任的能力，具有良好的商业信誉和健全的财务会计制度，参加政府采购活动前三年内，"
+             "在经营活动中没有重大违法记录。\n")
+
+PROJECT_PATTERN = re.compile(r"项目编号：(\S+)")
+BUDGET_PATTERN = re.compile(r"预算金额：(\S+)")
+
+
+def make_notice(rng: random.Random, i: int) -> dict:
+    region = rng.choice(REGIONS)
+    buyer = region + rng.choice(BUYERS)
+    item = rng.choice(ITEMS)
+    unit = rng.choice(UNITS)
+    amount = round(rng.uniform(1, 1000), 2) if unit == "万元" else round(rng.uniform(10000, 5000000), 2)
+    text = (f"{buyer}{item}采购项目招标公告\n"
+            f"项目编号：ZC{2015 + i % 10}-{i:07d}\n"
+            f"预算金额：{amount}{unit}\n"
+            f"采购人：{buyer}\n"
+            + PARAGRAPH.format(buyer=buyer, item=item) * rng.randint(1, 8))
+    return {"年份": 2015 + i % 10, "标题": f"{buyer}{item}采购项目招标公告", "文本": text, "采购人": buyer,
+            "地区": region, "类别": item}
+
+
+def answer_of(text: str) -> str:
+    """
+    Response of a model to a notice: the project number and budget as a fenced JSON block.
+    """
+    project = PROJECT_PATTERN.search(text)
+    budget = BUDGET_PATTERN.search(text)
+    answer = {"项目编号": project.group(1) if project else "", "预算金额": budget.group(1) if budget else ""}
+    return "```json\n" + json.dumps(answer, ensure_ascii=False) + "\n```"
+
+
+def write_corpus(rows: int, out_dir: str, shard_rows: int = 10000, seed: int = 0, file_format: str = "parquet") -> list:
+    """
+    Write a corpus of rows notices into shards of shard_rows rows, shards which already exist are kept.
+
+    :param file_format: "parquet" or "pkl"
+    :return: paths of the shards
+    """
+    import pandas as pd
+
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for start in range(0, rows, shard_rows):
+        path = f"{out_dir}/notices_{start // shard_rows:05d}.{file_format}"
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        rng = random.Random(seed * 1000003 + start)
+        df = pd.DataFrame([make_notice(rng, i) for i in range(start, min(start + shard_rows, rows))])
+        if file_format == "parquet":
+            df.to_parquet(path)
+        else:
+            df.to_pickle(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic procurement notice corpus")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--out", default="benchmarks/data")
+    parser.add_argument("--shard-rows", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", default="parquet", choices=["parquet", "pkl"])
+    args = parser.parse_args()
+    shards = write_corpus(args.rows, f"{args.out}/{args.rows}", args.shard_rows, args.seed, args.format)
+    print(f"Wrote {len(shards)} shards to {args.out}/{args.rows}")
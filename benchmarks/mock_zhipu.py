@@ -0,0 +1,156 @@
+"""
+Local stand-in for the files and batches API of the ZhipuAI client, used to benchmark the batch pipeline without
+quota. Uploaded files are kept on disk, batches complete after a configurable processing time, and the output and
+error files are generated from the input lines when they are downloaded.
+
+    from benchmarks.mock_zhipu import MockZhipuAI
+    import batch.batch_steps
+    batch.batch_steps.get_client = MockZhipuAI("/tmp/mock").client_for
+"""
+import itertools
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+import httpx
+from zhipuai import APIInternalError, APIReachLimitError
+
+from benchmarks.corpus import answer_of
+
+
+class MockResponse:
+    """
+    Streaming response of files.content.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def iter_bytes(self, chunk_size: int = 1024 * 1024):
+        buffer = bytearray()
+        for chunk in self.chunks:
+            buffer += chunk
+            if len(buffer) >= chunk_size:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+
+    def close(self):
+        pass
+
+
+class MockZhipuAI:
+    """
+    Mock of ZhipuAI().files and ZhipuAI().batches.
+
+    :param root: directory of the uploaded files
+    :param latency: seconds of every API call
+    :param failure_rate: share of API calls failing with a rate limit or server error
+    :param error_rate: share of requests ending in the error file
+    :param bad_json_rate: share of requests answered with unparsable content
+    :param processing_seconds: seconds until a batch is completed
+    :param seed: seed of the injected API failures
+    """
+
+    def __init__(self, root: str, latency: float = 0.0, failure_rate: float = 0.0, error_rate: float = 0.0,
+                 bad_json_rate: float = 0.0, processing_seconds: float = 0.0, seed: int = 0):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.bad_json_rate = bad_json_rate
+        self.processing_seconds = processing_seconds
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.batches_by_id = {}
+        self.calls = 0
+        self.files = SimpleNamespace(create=self.create_file, content=self.file_content)
+        self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve_batch)
+
+    def client_for(self, key: str = "") -> "MockZhipuAI":
+        # replaces batch.batch_steps.get_client, every key shares the mock
+        return self
+
+    def _call(self):
+        with self.lock:
+            self.calls += 1
+            fail = self.random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            response = httpx.Response(429, request=httpx.Request("POST", "http://mock"))
+            error = APIReachLimitError if self.random.random() < 0.5 else APIInternalError
+            raise error("mock failure", response=response)
+
+    def _outcome(self, custom_id: str) -> str:
+        # deterministic per request, so the output and the error file agree without any stored state
+        share = zlib.crc32(custom_id.encode()) % 10000 / 10000
+        if share < self.error_rate:
+            return "error"
+        if share < self.error_rate + self.bad_json_rate:
+            return "bad_json"
+        return "ok"
+
+    def create_file(self, file, purpose: str = "batch"):
+        self._call()
+        file_id = f"file-{next(self.ids)}"
+        with open(f"{self.root}/{file_id}", "wb") as f:
+            if isinstance(file, tuple):
+                f.write(file[1])
+            else:
+                shutil.copyfileobj(file, f)
+        return SimpleNamespace(id=file_id)
+
+    def create_batch(self, input_file_id: str, endpoint: str, auto_delete_input_file: bool = True,
+                     metadata: dict = None, **kwargs):
+        self._call()
+        batch_id = f"batch-{next(self.ids)}"
+        with self.lock:
+            self.batches_by_id[batch_id] = {"input_file_id": input_file_id, "created": time.time()}
+        return SimpleNamespace(id=batch_id)
+
+    def retrieve_batch(self, batch_id: str):
+        self._call()
+        batch = self.batches_by_id[batch_id]
+        progress = (time.time() - batch["created"]) / self.processing_seconds if self.processing_seconds else 1.0
+        if progress < 1.0:
+            counts = SimpleNamespace(total=100, completed=int(progress * 100), failed=0)
+            return SimpleNamespace(id=batch_id, status="in_progress", output_file_id=None, error_file_id=None,
+                                   request_counts=counts)
+        counts = SimpleNamespace(total=100, completed=100, failed=0)
+        return SimpleNamespace(id=batch_id, status="completed", output_file_id=f"output-{batch_id}",
+                               error_file_id=f"error-{batch_id}" if self.error_rate else None,
+                               request_counts=counts)
+
+    def _iter_results(self, batch_id: str, errors: bool):
+        with open(f"{self.root}/{self.batches_by_id[batch_id]['input_file_id']}", "rb") as f:
+            for line in f:
+                request = json.loads(line)
+                custom_id = request["custom_id"]
+                outcome = self._outcome(custom_id)
+                if errors != (outcome == "error"):
+                    continue
+                if outcome == "error":
+                    response = {"status_code": 500, "body": {"error": {"code": "500", "message": "mock error"}}}
+                else:
+                    content = (answer_of(request["body"]["messages"][-1]["content"])
+                               if outcome == "ok" else "无法提取")
+                    response = {"status_code": 200, "body": {
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": content}}],
+                        "usage": {"prompt_tokens": len(line) // 3, "completion_tokens": len(content) // 2}}}
+                yield (json.dumps({"custom_id": custom_id, "response": response}, ensure_ascii=False)
+                       + "\n").encode("utf-8")
+
+    def file_content(self, file_id: str, extra_headers: dict = None):
+        self._call()
+        kind, batch_id = file_id.split("-", 1)
+        return MockResponse(self._iter_results(batch_id, errors=kind == "error"))
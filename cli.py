@@ -0,0 +1,263 @@
+"""
+Command line interface of the batch pipeline, every step runs as a subcommand in its own process:
+
+    python cli.py create data/chunk_*.parquet --text-column 文本 --schema schemas:schema
+    python cli.py create-chunks data/chunk_*.parquet --text-column 文本 --schema schemas:schema --chunk-size 100
+    python cli.py upload --workers 4
+    python cli.py download --wait
+    python cli.py merge --schema schemas:schema --output-format parquet
+    python cli.py run data/chunk_*.parquet --text-column 文本 --schema schemas:schema
+    python cli.py join --schema schemas:schema
+    python cli.py show 2024_split_17 --schema schemas:schema
+    python cli.py report
+    python cli.py remove --mode IO
+
+The schema is given as module:attribute (or path/to/file.py:attribute), the attribute is an Object or a function
+returning one.
+"""
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import time
+
+from schema.schema import Object
+
+
+def load_schema(spec: str | None) -> Object | None:
+    if not spec:
+        return None
+    if ":" not in spec:
+        raise ValueError("Schema should be given as module:attribute")
+    module_name, attribute = spec.rsplit(":", 1)
+    if module_name.endswith(".py"):
+        module_spec = importlib.util.spec_from_file_location(os.path.basename(module_name)[:-3], module_name)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        sys.path.insert(0, os.getcwd())
+        module = importlib.import_module(module_name)
+    schema = getattr(module, attribute)
+    if not isinstance(schema, Object) and callable(schema):
+        schema = schema()
+    if not isinstance(schema, Object):
+        raise ValueError(f"{spec} is not a schema")
+    return schema
+
+
+def cmd_create(args):
+    from batch.batch_steps import step_create_batches
+    from batch.ingest import read_texts
+
+    texts = {}
+    for path in args.paths:
+        texts.update(enumerate(read_texts(path, args.text_column), start=len(texts)))
+    paths = step_create_batches(texts, schema=load_schema(args.schema), prefix=args.prefix, workers=args.workers,
+                                max_tokens_per_file=args.max_tokens_per_file, rules=args.rules, dedup=args.dedup,
+                                compression=args.compression)
+    print(f"Created {len(paths)} batch files")
+
+
+def cmd_create_chunks(args):
+    from batch.batch_steps import step_create_batches_chunks
+
+    step_create_batches_chunks(load_schema(args.schema), args.paths, chunk_size=args.chunk_size,
+                               text_column=args.text_column, workers=args.workers, read_workers=args.read_workers,
+                               compression=args.compression)
+
+
+def cmd_upload(args):
+    from batch.batch_steps import step_upload_batches
+
+    step_upload_batches(batch_input_dir=args.input_dir, key=args.key, workers=args.workers, retries=args.retries)
+
+
+def cmd_download(args):
+    from batch.batch_steps import step_download_output
+
+    step_download_output(wait=args.wait, workers=args.workers, min_interval=args.min_interval,
+                         max_interval=args.max_interval, retries=args.retries, compression=args.compression)
+
+
+def cmd_merge(args):
+    from batch.batch_steps import step_merge_output
+
+    step_merge_output(schema=load_schema(args.schema), workers=args.workers, output_format=args.output_format,
+                      chunk_size=args.chunk_size, compression=args.compression, max_retries=args.max_retries)
+
+
+def cmd_run(args):
+    from batch.ingest import read_texts
+    from batch.pipeline import Pipeline
+
+    texts = None
+    if args.paths:
+        texts = {}
+        for path in args.paths:
+            texts.update(enumerate(read_texts(path, args.text_column), start=len(texts)))
+    pipeline = Pipeline(schema=load_schema(args.schema), key=args.key, upload_workers=args.upload_workers,
+                        poll_workers=args.poll_workers, min_interval=args.min_interval,
+                        max_interval=args.max_interval, max_retries=args.max_retries,
+                        output_format=args.output_format, compression=args.compression)
+    pipeline.run(texts, prefix=args.prefix, workers=args.workers, max_tokens_per_file=args.max_tokens_per_file,
+                 rules=args.rules, dedup=args.dedup)
+
+
+def cmd_join(args):
+    from batch.join import join_results
+
+    join_results(args.output_path, schema=load_schema(args.schema), out_dir=args.out_dir,
+                 output_format=args.output_format, column_prefix=args.column_prefix)
+
+
+def cmd_show(args):
+    from batch.offsets import OffsetIndex
+
+    offsets = OffsetIndex(args.index_path)
+    try:
+        if args.all:
+            for path, offset, length in offsets.locate_all(args.custom_id):
+                print(f"{path} {offset} {length}")
+            return
+        if offsets.locate(args.custom_id) is None:
+            sys.exit(f"{args.custom_id} is not indexed in {args.index_path}")
+        if args.raw:
+            print(offsets.read_line(args.custom_id).decode("utf-8").rstrip("\n"))
+        else:
+            print(json.dumps(offsets.format(args.custom_id, schema=load_schema(args.schema)), ensure_ascii=False,
+                             indent=2, default=str))
+    finally:
+        offsets.close()
+
+
+def cmd_report(args):
+    if not os.path.exists(args.path):
+        sys.exit(f"No run report at {args.path}")
+    with open(args.path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    for stage, values in report["stages"].items():
+        print(stage)
+        for name, value in values.items():
+            if name == "started":
+                print(f"  {name:<20} {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(value))}")
+            else:
+                print(f"  {name:<20} {value:,.2f}" if isinstance(value, float) else f"  {name:<20} {value:,}")
+
+
+def cmd_remove(args):
+    from batch.batch_steps import remove_batch_files
+
+    remove_batch_files(mode=args.mode)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    # only the settings are read here, every step imports its dependencies when it runs
+    from settings import batch_compression
+
+    parser = argparse.ArgumentParser(description="Extract structured information with the ZhipuAI batch API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    create = commands.add_parser("create", help="create the batch files of source files")
+    create.add_argument("paths", nargs="+", help=".pkl, .parquet, .jsonl or .csv files")
+    create.add_argument("--text-column", default="", help="column of the texts")
+    create.add_argument("--schema", help="module:attribute of the schema")
+    create.add_argument("--prefix", default="", help="prefix of the custom_id")
+    create.add_argument("--workers", type=int, default=1)
+    create.add_argument("--max-tokens-per-file", type=int, default=None)
+    create.add_argument("--rules", choices=["documents", "fields"], default=None,
+                        help="resolve the rule fields of the schema before creating requests")
+    create.add_argument("--dedup", type=float, default=None, metavar="THRESHOLD",
+                        help="request one representative of every cluster of near duplicates (similarity 0-1)")
+    create.add_argument("--compression", choices=["gzip", "zstd"], default=batch_compression)
+    create.set_defaults(func=cmd_create)
+
+    chunks = commands.add_parser("create-chunks", help="create the batch files of many source shards with checkpoints")
+    chunks.add_argument("paths", nargs="+", help=".pkl, .parquet, .jsonl or .csv shards")
+    chunks.add_argument("--text-column", default="", help="column of the texts")
+    chunks.add_argument("--schema", help="module:attribute of the schema")
+    chunks.add_argument("--chunk-size", type=int, default=100, help="shards per batch prefix")
+    chunks.add_argument("--workers", type=int, default=1)
+    chunks.add_argument("--read-workers", type=int, default=4)
+    chunks.add_argument("--compression", choices=["gzip", "zstd"], default=batch_compression)
+    chunks.set_defaults(func=cmd_create_chunks)
+
+    upload = commands.add_parser("upload", help="upload the batch files")
+    upload.add_argument("--input-dir", default="batch/batch_input")
+    upload.add_argument("--key", default="", help="API key, default settings.batch_keys or settings.batch_key")
+    upload.add_argument("--workers", type=int, default=4)
+    upload.add_argument("--retries", type=int, default=3)
+    upload.set_defaults(func=cmd_upload)
+
+    download = commands.add_parser("download", help="download the outputs of the completed batches")
+    download.add_argument("--wait", action="store_true", help="poll until every batch is finished")
+    download.add_argument("--workers", type=int, default=8)
+    download.add_argument("--min-interval", type=float, default=30)
+    download.add_argument("--max-interval", type=float, default=600)
+    download.add_argument("--retries", type=int, default=3)
+    download.add_argument("--compression", choices=["gzip", "zstd"], default=batch_compression)
+    download.set_defaults(func=cmd_download)
+
+    merge = commands.add_parser("merge", help="merge the downloaded outputs and write the retry files")
+    merge.add_argument("--schema", help="module:attribute of the schema")
+    merge.add_argument("--workers", type=int, default=1)
+    merge.add_argument("--output-format", choices=["jsonl", "parquet", "arrow"], default="jsonl")
+    merge.add_argument("--chunk-size", type=int, default=10000)
+    merge.add_argument("--compression", choices=["gzip", "zstd"], default=batch_compression)
+    merge.add_argument("--max-retries", type=int, default=2)
+    merge.set_defaults(func=cmd_merge)
+
+    run = commands.add_parser("run", help="run all steps as a pipeline, without paths continue an interrupted run")
+    run.add_argument("paths", nargs="*", help=".pkl, .parquet, .jsonl or .csv files")
+    run.add_argument("--text-column", default="", help="column of the texts")
+    run.add_argument("--schema", help="module:attribute of the schema")
+    run.add_argument("--prefix", default="", help="prefix of the custom_id")
+    run.add_argument("--workers", type=int, default=1)
+    run.add_argument("--max-tokens-per-file", type=int, default=None)
+    run.add_argument("--rules", choices=["documents", "fields"], default=None)
+    run.add_argument("--dedup", type=float, default=None, metavar="THRESHOLD")
+    run.add_argument("--key", default="", help="API key, default settings.batch_keys or settings.batch_key")
+    run.add_argument("--upload-workers", type=int, default=4)
+    run.add_argument("--poll-workers", type=int, default=8)
+    run.add_argument("--min-interval", type=float, default=30)
+    run.add_argument("--max-interval", type=float, default=600)
+    run.add_argument("--max-retries", type=int, default=2)
+    run.add_argument("--output-format", choices=["jsonl", "parquet", "arrow"], default="jsonl")
+    run.add_argument("--compression", choices=["gzip", "zstd"], default=batch_compression)
+    run.set_defaults(func=cmd_run)
+
+    join = commands.add_parser("join", help="join the merged results back to the rows of the source shards")
+    join.add_argument("--output-path", default="batch/processed/output.jsonl", help="merged output")
+    join.add_argument("--schema", help="module:attribute of the schema")
+    join.add_argument("--out-dir", default="batch/joined")
+    join.add_argument("--output-format", choices=["parquet", "pkl"], default="parquet")
+    join.add_argument("--column-prefix", default="", help="prefix of the result columns")
+    join.set_defaults(func=cmd_join)
+
+    show = commands.add_parser("show", help="read the result of one request from the downloaded outputs")
+    show.add_argument("custom_id")
+    show.add_argument("--schema", help="module:attribute of the schema the result is formatted with")
+    show.add_argument("--raw", action="store_true", help="print the raw line of the output file")
+    show.add_argument("--all", action="store_true", help="list the locations of every attempt of the request")
+    show.add_argument("--index-path", default="batch/batch_output/offsets.db")
+    show.set_defaults(func=cmd_show)
+
+    report = commands.add_parser("report", help="print the run report of the steps")
+    report.add_argument("--path", default="batch/run_report.json")
+    report.set_defaults(func=cmd_report)
+
+    remove = commands.add_parser("remove", help="remove the batch files")
+    remove.add_argument("--mode", choices=["IN", "IO", "ALL"], default="IN",
+                        help="IN: inputs and manifest, IO: and outputs, ALL: and processed results")
+    remove.set_defaults(func=cmd_remove)
+    return parser
+
+
+def main(argv: list = None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
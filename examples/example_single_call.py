@@ -1,7 +1,7 @@
 import pandas as pd
-from tqdm import tqdm
 
 from LLM.chains import create_extractor_chain
+from LLM.engine import extract_many
 from schema.schema import Object, Text, Number
 from schema.utils import format_json_response
 
@@ -53,11 +53,11 @@ if __name__ == "__main__":
     # Single call to extract information from text
     # create extractor chain
     chain_extractor = create_extractor_chain(schema, llm="ollama")
-    df = pd.read_pickle("batch/batch_chunks/page_text_chunk_1.pkl")
+    df = pd.read_pickle("examples/example_data.pkl")
 
+    # extract many texts concurrently, results are formatted and returned in input order
     text_list = df['文本'].tolist()
-    results = [format_json_response(json_str=chain_extractor.invoke(text).content, schema=schema) for text in
-               tqdm(text_list[70:100])]
+    results = extract_many(text_list[70:100], chain_extractor, schema=schema, concurrency=8)
     r = chain_extractor.invoke(df['文本'][0])
     # print response
     print(r.content)
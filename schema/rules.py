@@ -0,0 +1,33 @@
+import re
+
+from schema.schema import Object
+
+
+def _extract_pattern(texts: "pd.Series", pattern: str) -> "pd.Series":
+    # the first group is the value, a pattern without group returns the whole match
+    if re.compile(pattern).groups == 0:
+        pattern = f"({pattern})"
+    return texts.str.extract(pattern, expand=True).iloc[:, 0]
+
+
+def apply_rules(texts: "pd.Series", schema: Object) -> "pd.DataFrame":
+    """
+    Run the deterministic extractors of the schema fields over all texts at once with vectorized pandas string
+    operations.
+
+    :param texts: pandas Series of texts
+    :param schema: schema whose fields have a pattern or an extractor
+    :return: DataFrame with the index of texts and one column of raw values per rule field, None where not found
+    """
+    import pandas as pd
+
+    texts = texts.astype(str)
+    columns = {}
+    for field in schema.rule_fields:
+        if field.extractor:
+            values = pd.Series(field.extractor(texts), index=texts.index)
+        else:
+            values = _extract_pattern(texts, field.pattern)
+        values = values.where(values.notna() & (values.astype(str).str.strip() != ""))
+        columns[field.id] = values.astype(object).where(values.notna(), None)
+    return pd.DataFrame(columns, index=texts.index)
@@ -1,4 +1,5 @@
 import json
+from typing import Callable
 
 
 class Field:
@@ -9,13 +10,23 @@ class Field:
     :param description: str, the description of the field
     :param examples: list, the examples of the field
     :param keep: bool, if True it will keep raw string as {colname}_raw
+    :param pattern: str, optional regex which extracts the raw value without LLM (the first group, or the whole match)
+    :param extractor: callable, optional vectorized extractor taking a pandas Series of texts and returning the raw
+        values (None, NaN or "" where not found), used instead of pattern
     """
 
-    def __init__(self, id: str, description: str = None, examples: list = None, keep: bool = False):
+    def __init__(self, id: str, description: str = None, examples: list = None, keep: bool = False,
+                 pattern: str = None, extractor: Callable = None):
         self.id = id
         self.description = description
         self.examples = examples
         self.keep = keep
+        self.pattern = pattern
+        self.extractor = extractor
+
+    @property
+    def has_rule(self) -> bool:
+        return bool(self.pattern or self.extractor)
 
     def __str__(self):
         return f"{self.id}: {self.description}"
@@ -28,8 +39,9 @@ class Date(Field):
     :param date_format: str, the format of the date
     """
 
-    def __init__(self, id: str, description: str = None, examples: list = None, keep: bool = False, date_format: str = "YYYY-MM-DD"):
-        super().__init__(id, description, examples, keep)
+    def __init__(self, id: str, description: str = None, examples: list = None, keep: bool = False, date_format: str = "YYYY-MM-DD",
+                 pattern: str = None, extractor: Callable = None):
+        super().__init__(id, description, examples, keep, pattern, extractor)
 
         self.date_format = date_format
 
@@ -41,8 +53,9 @@ class Number(Field):
     :param unit: bool, whether the number has a unit
     """
 
-    def __init__(self, id: str, description: str = None, examples: list = None, keep: bool = False, unit: bool = False):
-        super().__init__(id, description, examples, keep)
+    def __init__(self, id: str, description: str = None, examples: list = None, keep: bool = False, unit: bool = False,
+                 pattern: str = None, extractor: Callable = None):
+        super().__init__(id, description, examples, keep, pattern, extractor)
 
         self.unit = unit
 
@@ -52,8 +65,9 @@ class Text(Field):
     Text field class to define the text field in the schema.
     """
 
-    def __init__(self, id: str, description: str = None, examples: list = None, keep: bool = False):
-        super().__init__(id, description, examples, keep)
+    def __init__(self, id: str, description: str = None, examples: list = None, keep: bool = False,
+                 pattern: str = None, extractor: Callable = None):
+        super().__init__(id, description, examples, keep, pattern, extractor)
 
 
 class Object:
@@ -71,6 +85,7 @@ class Object:
                  complete_example: str | dict = None, mode: str = "json"):
         self.prompt_system = prompt_system
         self.description = description
+        self.example = complete_example
         if isinstance(complete_example, dict):
             self.complete_example = json.dumps(complete_example, ensure_ascii=False, indent=4)
         else:
@@ -86,6 +101,51 @@ class Object:
 
         self.prompt_user = self.format_prompt_user()
 
+        self._formatter = None
+        self._request_templates = {}
+
+    def __getstate__(self):
+        # compiled plans are rebuilt lazily, e.g. after the schema has been sent to a worker process
+        state = self.__dict__.copy()
+        state["_formatter"] = None
+        state["_request_templates"] = {}
+        return state
+
+    def compile(self):
+        """
+        Compile the schema once into a formatter plan of its responses, see schema.utils.FormatterPlan.
+        """
+        if self._formatter is None:
+            from schema.utils import FormatterPlan
+            self._formatter = FormatterPlan(self)
+        return self._formatter
+
+    @property
+    def rule_fields(self) -> list:
+        """
+        Fields with a deterministic extractor (pattern or extractor), see schema.rules.
+        """
+        return [field for field in self.fields if field.has_rule]
+
+    def subset(self, ids: list) -> "Object":
+        """
+        Schema asking only for some of the fields, e.g. the fields which the rules did not resolve.
+        """
+        example = self.example
+        if isinstance(example, dict):
+            example = {key: value for key, value in example.items() if key in ids}
+        return Object([field for field in self.fields if field.id in ids], prompt_system=self.prompt_system,
+                      description=self.description, complete_example=example, mode=self.mode)
+
+    def request_template(self, model: str):
+        """
+        Pre-serialized batch request of the schema for a model, see schema.templates.RequestTemplate.
+        """
+        if model not in self._request_templates:
+            from schema.templates import RequestTemplate
+            self._request_templates[model] = RequestTemplate(self.prompt_system, self.prompt_user, model)
+        return self._request_templates[model]
+
     def format_field_description(self) -> str:
         field_description = "## Field Descriptions\n"
         for field in self.fields:
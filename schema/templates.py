@@ -0,0 +1,50 @@
+import json
+from json.encoder import encode_basestring
+
+# private use characters are not escaped by json.dumps(ensure_ascii=False), so they survive serialization unchanged
+CUSTOM_ID_SLOT = "custom_id"
+TEXT_SLOT = "text"
+
+
+class RequestTemplate:
+    """
+    Pre-serialized JSON skeleton of a batch request. The request is serialized once with placeholders for the
+    custom_id and the text, so rendering a request is a plain concatenation of the constant parts with the escaped
+    custom_id and text. The result is identical to json.dumps(create_batch_prompt(...), ensure_ascii=False).
+
+    :param prompt_system: str, the system prompt
+    :param prompt_user: str, the user prompt with a {text} placeholder (str.format syntax)
+    :param model: str, the model name
+    """
+
+    def __init__(self, prompt_system: str, prompt_user: str, model: str):
+        request = {
+            "custom_id": CUSTOM_ID_SLOT,
+            "method": "POST",
+            "url": "/v4/chat/completions",
+            "body": {
+                "model": model,
+                "messages": [
+                    {
+                        "role": "system",
+                        "content": prompt_system
+                    },
+                    {
+                        "role": "user",
+                        "content": prompt_user.format(text=TEXT_SLOT)
+                    }
+                ],
+                "temperature": 0
+            }
+        }
+        self.head, body = json.dumps(request, ensure_ascii=False).split(encode_basestring(CUSTOM_ID_SLOT))
+        self.parts = body.split(TEXT_SLOT)
+        # the user prompt without the text, used for token estimates
+        self.static_text = prompt_system + prompt_user.format(text="")
+
+    def render(self, custom_id: str, text: str) -> str:
+        """
+        Render the JSONL line (with trailing newline) of a request.
+        """
+        text = encode_basestring(text)[1:-1]
+        return self.head + encode_basestring(custom_id) + text.join(self.parts) + '\n'
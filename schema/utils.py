@@ -1,37 +1,297 @@
 import json
 import re
+from functools import lru_cache, partial
 
-import cn2an
-import numpy as np
+from schema.schema import Object, Field, Text, Number, Date
 
-from schema.schema import Object, Text, Number, Date
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def format_json_response(json_str: str, schema: Object = None) -> dict | None:
+JSON_FENCE_PATTERN = re.compile(r'```json\n(.*?)\n```', re.DOTALL)
+# a yaml block, its closing fence may be cut off
+YAML_FENCE_PATTERN = re.compile(r'```ya?ml[ \t]*\n(.*?)(?:\n```|$)', re.DOTALL)
+
+# parse methods of FormatterPlan in the order they are tried, and the name of responses none of them parsed
+PARSE_METHODS = ("fence", "json", "yaml", "repair")
+PARSE_FAILED = "failed"
+
+# bare objects and cut points of a truncated object tried before giving up
+MAX_OBJECT_STARTS = 8
+MAX_REPAIR_CUTS = 16
+
+
+def _keep_value(value):
+    return value
+
+
+def _drop_value(value):
+    return None
+
+
+def _to_datetime(date_format: str, value) -> "np.datetime64":
+    import numpy as np
+    return np.datetime64(value, date_format)
+
+
+def _json_loads_fast(json_str: str):
+    # orjson is stricter than json (e.g. NaN, huge integers), fall back to json so that results never differ
     try:
-        json_pattern = r'```json\n(.*?)\n```'
-        json_str = re.search(json_pattern, json_str, re.DOTALL).group(1)
-        result = json.loads(json_str)
+        return orjson.loads(json_str)
+    except orjson.JSONDecodeError:
+        return json.loads(json_str)
+
+
+@lru_cache(maxsize=None)
+def _yaml():
+    # optional dependency, only needed for schemas in yaml mode
+    try:
+        import yaml
+    except ImportError:
+        return None
+    return yaml
+
+
+def _yaml_strings(value):
+    # yaml resolves numbers and dates, the field converters expect the raw strings like from JSON
+    if isinstance(value, dict):
+        return {str(key): _yaml_strings(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_yaml_strings(item) for item in value]
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+def _is_candidate(value, keys: frozenset | None) -> bool:
+    # a non-empty object, with at least one of the keys if keys are given
+    return isinstance(value, dict) and bool(value) and (keys is None or not keys.isdisjoint(value))
+
+
+def find_json_object(text: str, keys: frozenset = None) -> dict | None:
+    """
+    The first JSON object in a text, ignoring anything around it: a fence without json tag, commentary before or
+    after the object. If keys are given, objects without any of them are skipped.
+    """
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    for _ in range(MAX_OBJECT_STARTS):
+        if start < 0:
+            return None
+        try:
+            value, end = decoder.raw_decode(text, start)
+        except json.JSONDecodeError:
+            value = None
+        if _is_candidate(value, keys):
+            return value
+        start = text.find("{", start + 1)
+    return None
+
+
+def _repair_at(text: str, start: int, loads, keys: frozenset | None) -> tuple:
+    # repair the object starting at start, returns (object or None, end of the scanned text)
+    closers = []
+    # (end, closing brackets) after which the object can be closed
+    cuts = []
+    in_string = escaped = False
+    end = len(text)
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            closers.append("}")
+        elif char == "[":
+            closers.append("]")
+        elif char in "}]":
+            if not closers or closers[-1] != char:
+                return None, i + 1
+            closers.pop()
+            cuts.append((i + 1, "".join(reversed(closers))))
+            if not closers:
+                # complete but invalid, e.g. a trailing comma, anything after it is commentary
+                end = i + 1
+                break
+        elif char == ",":
+            cuts.append((i, "".join(reversed(closers))))
+    tail = text[start:end].rstrip()
+    if closers and not in_string and (tail.endswith(('"', "}", "]", "true", "false", "null"))):
+        # cut off right after a value which is complete, a number may have lost digits
+        cuts.append((end, "".join(reversed(closers))))
+
+    for cut, closing in sorted(cuts, reverse=True)[:MAX_REPAIR_CUTS]:
+        try:
+            value = loads(text[start:cut].rstrip().rstrip(",") + closing)
+        except ValueError:
+            continue
+        if _is_candidate(value, keys):
+            return value, end
+    return None, end
+
+
+def repair_json_object(text: str, loads=json.loads, keys: frozenset = None) -> dict | None:
+    """
+    Repair a truncated or malformed JSON object by balancing its braces: the object is cut after its last complete
+    member and the open objects and arrays are closed, e.g. '{"a": "1", "b": ["x", "y' becomes '{"a": "1", "b": ["x"]}'.
+    Values cut off are dropped rather than completed, an object without any complete member is not repaired.
+    If keys are given, objects without any of them are skipped and the next object of the text is tried.
+    """
+    start = text.find("{")
+    for _ in range(MAX_OBJECT_STARTS):
+        if start < 0:
+            return None
+        value, end = _repair_at(text, start, loads, keys)
+        if value is not None:
+            return value
+        start = text.find("{", end)
+    return None
+
+
+def field_converter(field: Field):
+    """
+    Return the function converting a non-empty raw value of the field, the same dispatch as format_by_field.
+    """
+    if isinstance(field, Text):
+        return _keep_value
+    elif isinstance(field, Number):
+        return _parse_amount if field.unit else _keep_value
+    elif isinstance(field, Date):
+        return partial(_to_datetime, field.date_format) if field.date_format else _keep_value
+    return _drop_value
+
+
+class FormatterPlan:
+    """
+    Formatter of LLM responses compiled once for a schema: a precompiled fence pattern, a converter per field and
+    orjson as JSON backend when it is installed. Use Object.compile() to get the cached plan of a schema.
+
+    Responses which are not a fenced JSON block are recovered in layers, from the cheapest to the most lenient, so
+    that they do not have to be requested again:
 
-        if not schema:
+    1. fence: the ```json block the prompts ask for
+    2. json: the first JSON object in the response, without or with another fence, with commentary around it
+    3. yaml: a ```yaml block or the whole response for schemas in yaml mode (requires PyYAML)
+    4. repair: a truncated or malformed object cut after its last complete member and closed, see repair_json_object
+
+    :param schema: Object, the schema, None returns the parsed JSON as it is
+    :param json_backend: str, "auto" uses orjson if available, "json" always uses the standard library
+    """
+
+    def __init__(self, schema: Object = None, json_backend: str = "auto"):
+        self.schema = schema
+        self.pattern = JSON_FENCE_PATTERN
+        if json_backend == "auto" and orjson is not None:
+            self.loads = _json_loads_fast
+        elif json_backend in ("auto", "json"):
+            self.loads = json.loads
+        else:
+            raise ValueError("Invalid JSON backend")
+        self.converters = [(field.id, field_converter(field), field.keep) for field in schema.fields] if schema else []
+        self.yaml_mode = bool(schema) and schema.mode == "yaml"
+        # a recovered object must contain a field of the schema, otherwise it is not the answer
+        self.keys = frozenset(field.id for field in schema.fields) if schema else None
+
+    def format_result(self, result: dict) -> dict:
+        """
+        Convert the raw values of a parsed response, e.g. values found by the rules of schema.rules.
+        """
+        if not self.schema:
             return result
 
         formatted = {}
-        for field in schema.fields:
-            formatted[field.id] = format_by_field(field, result)
-            if field.keep:
-                formatted[field.id + "_raw"] = result.get(field.id)
+        for field_id, converter, keep in self.converters:
+            value = result.get(field_id)
+            formatted[field_id] = converter(value) if value else None
+            if keep:
+                formatted[field_id + "_raw"] = value
         return formatted
 
-    except json.JSONDecodeError as e:
-        print(f"JSON解码错误: {e}")
-        return None
-    except Exception as e:
-        print(f"错误: {e}")
-        return None
+    def _parse_yaml(self, json_str: str) -> dict | None:
+        match = YAML_FENCE_PATTERN.search(json_str)
+        if not match and not self.yaml_mode:
+            return None
+        yaml = _yaml()
+        if yaml is None:
+            return None
+        text = match.group(1) if match else json_str.replace("```", "")
+        try:
+            value = yaml.safe_load(text)
+        except yaml.YAMLError:
+            return None
+        return _yaml_strings(value) if _is_candidate(value, self.keys) else None
+
+    def parse(self, json_str: str) -> tuple:
+        """
+        Parse a response with the first method of PARSE_METHODS which succeeds.
+
+        :return: (parsed object, method), (None, PARSE_FAILED) if no method found an object, with a schema an object
+            which contains at least one of its fields
+        """
+        error = None
+        match = self.pattern.search(json_str)
+        if match:
+            try:
+                value = self.loads(match.group(1))
+                # without schema any JSON value is returned as it is
+                if not self.schema or _is_candidate(value, self.keys):
+                    return value, "fence"
+            except ValueError as e:
+                error = e
+
+        value = find_json_object(json_str, self.keys)
+        if value is not None:
+            return value, "json"
+        value = self._parse_yaml(json_str)
+        if value is not None:
+            return value, "yaml"
+        value = repair_json_object(json_str, self.loads, self.keys)
+        if value is not None:
+            return value, "repair"
+
+        if error is not None:
+            print(f"JSON解码错误: {error}")
+        else:
+            print("错误: 响应中没有JSON对象")
+        return None, PARSE_FAILED
+
+    def __call__(self, json_str: str, methods: dict = None) -> dict | None:
+        """
+        :param methods: if given, the count of the parse method of the response is added to it as parsed_{method}
+        """
+        try:
+            value, method = self.parse(json_str)
+        except Exception as e:
+            print(f"错误: {e}")
+            value, method = None, PARSE_FAILED
+        if methods is not None:
+            methods["parsed_" + method] = methods.get("parsed_" + method, 0) + 1
+        if value is None:
+            return None
+        try:
+            return self.format_result(value)
+        except Exception as e:
+            print(f"错误: {e}")
+            return None
+
+
+default_formatter = FormatterPlan()
 
 
-def format_by_field(field: Text | Number, result: dict) -> str | float | np.datetime64 | None:
+def format_json_response(json_str: str, schema: Object = None, methods: dict = None) -> dict | None:
+    formatter = schema.compile() if schema else default_formatter
+    return formatter(json_str, methods=methods)
+
+
+def format_by_field(field: Text | Number, result: dict) -> "str | float | np.datetime64 | None":
     response_str = result.get(field.id)
     if response_str:
         # Format by field type
@@ -49,28 +309,32 @@ def format_by_field(field: Text | Number, result: dict) -> str | float | np.date
         # (3) Date
         elif isinstance(field, Date):
             if field.date_format:
-                return np.datetime64(response_str, field.date_format)
+                return _to_datetime(field.date_format, response_str)
             else:
                 return response_str
     else:
         return None
 
 
+CN_NUMBER_CHARS = frozenset('零一二三四五六七八九壹贰叁肆伍陆柒捌玖拾佰仟万亿千')
+AMOUNT_CHARS = CN_NUMBER_CHARS | frozenset('1234567890.')
+DIGIT_PATTERN = re.compile(r'\d')
+NUMBER_PATTERN = re.compile(r'([\d,]+\.?\d*)\s*')
+
+# number of distinct raw amounts remembered by parse_amount
+AMOUNT_CACHE_SIZE = 65536
+
+
 def number_unit_paser(number: str) -> float | None:
-    str_number = ['零', '一', '二', '三', '四', '五', '六', '七', '八', '九', '壹', '贰', '叁', '肆', '伍', '陆', '柒',
-                  '捌', '玖', '拾', '佰', '仟', '万', '亿', '千', '1', '2', '3', '4', '5', '6', '7', '8', '9', '0', '.']
     try:
-        number = ''.join([char for char in number if char in str_number])
+        number = ''.join([char for char in number if char in AMOUNT_CHARS])
     except:
         return None
 
     if number:
-        if re.search(r'\d', number):
-            # 匹配规则
-            pattern_number = r'([\d,]+\.?\d*)\s*'
-
+        if DIGIT_PATTERN.search(number):
             # 匹配并转换
-            match_number = re.search(pattern_number, number)
+            match_number = NUMBER_PATTERN.search(number)
 
             if match_number:
                 number_num = float(match_number.group(1))
@@ -87,12 +351,46 @@ def number_unit_paser(number: str) -> float | None:
                 return None
         else:
             try:
-                number = "".join([char for char in number if
-                                  char in ['零', '一', '二', '三', '四', '五', '六', '七', '八', '九', '壹', '贰', '叁',
-                                           '肆', '伍', '陆', '柒', '捌', '玖', '拾', '佰', '仟', '万', '亿', '千']])
+                import cn2an
+                number = "".join([char for char in number if char in CN_NUMBER_CHARS])
                 number = cn2an.cn2an(number)
                 return number / 10000
             except:
                 return None
     else:
         return None
+
+
+@lru_cache(maxsize=AMOUNT_CACHE_SIZE)
+def parse_amount(number: str) -> float | None:
+    """
+    number_unit_paser memoized in a bounded LRU cache, raw amounts like "350.5万元" repeat heavily across notices.
+    """
+    return number_unit_paser(number)
+
+
+def _parse_amount(number) -> float | None:
+    try:
+        return parse_amount(number)
+    except TypeError:
+        # unhashable values are not cached
+        return number_unit_paser(number)
+
+
+def normalize_amounts(amounts) -> "np.ndarray":
+    """
+    Normalize a whole pandas Series, array or list of raw amounts to 万元 with the rules of number_unit_paser. Every
+    distinct value is parsed only once. Numbers are taken as already normalized and kept as they are, so a column of
+    formatted results mixed with raw strings is normalized consistently.
+
+    :param amounts: Series, array or list of raw amounts
+    :return: float64 array, NaN where the amount is missing or cannot be parsed
+    """
+    import numpy as np
+    import pandas as pd
+
+    codes, uniques = pd.factorize(pd.Series(amounts, dtype=object), use_na_sentinel=True)
+    parsed = np.array([number if isinstance(number, (int, float, np.number)) else _parse_amount(number)
+                       for number in uniques], dtype=np.float64)
+    # append NaN so that the sentinel code -1 of missing values maps to NaN
+    return np.append(parsed, np.nan)[codes]
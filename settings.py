@@ -1,5 +1,7 @@
 # API key
 batch_key = ""
+# several batch API keys (accounts): list of keys or dict of key -> quota of batches in flight
+batch_keys = {}
 agent_key = ""
 
 # API base
@@ -9,4 +11,7 @@ zhipu_api_base = "https://open.bigmodel.cn/api/paas/v4/"
 batch_model = "glm-4-air"
 ollama_model = "glm4:latest"
 
-agent_model = "gpt-4o"
\ No newline at end of file
+agent_model = "gpt-4o"
+
+# compression of local batch files: None, "gzip" or "zstd"
+batch_compression = None
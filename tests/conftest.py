@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+from batch import batch_steps
+from batch.manifest import Manifest
+from benchmarks.bench_pipeline import make_schema
+from benchmarks.corpus import make_notice
+from benchmarks.mock_zhipu import MockZhipuAI
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # the batch steps write below batch/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def mock_api(workdir, monkeypatch):
+    """
+    Mock of the ZhipuAI files and batches API shared by every key.
+    """
+    mock = MockZhipuAI(str(workdir / "mock"))
+    monkeypatch.setattr(batch_steps, "get_client", mock.client_for)
+    return mock
+
+
+@pytest.fixture
+def manifest(workdir):
+    manifest = Manifest("batch/manifest.db")
+    yield manifest
+    manifest.close()
+
+
+@pytest.fixture
+def schema():
+    return make_schema()
+
+
+@pytest.fixture
+def texts() -> dict:
+    """
+    Synthetic notices by custom_id, the mock answers with their project number and budget.
+    """
+    rng = random.Random(0)
+    return {i: make_notice(rng, i)["文本"] for i in range(30)}
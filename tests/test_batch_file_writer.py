@@ -0,0 +1,29 @@
+import pytest
+
+from batch.batch_steps import BatchFileWriter
+from batch.manifest import Manifest
+
+
+def test_file_is_registered_on_success(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    manifest = Manifest(str(tmp_path / "manifest.db"))
+    finished = []
+    with BatchFileWriter(str(tmp_path / "input"), prefix="test", compression=None, manifest=manifest,
+                         on_file=finished.append) as writer:
+        writer.write('{"custom_id": "test_split_0"}\n')
+    assert finished == writer.paths
+    assert manifest.get(writer.paths[0])["n_requests"] == 1
+
+
+def test_file_is_not_registered_on_error(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    manifest = Manifest(str(tmp_path / "manifest.db"))
+    finished = []
+    with pytest.raises(RuntimeError):
+        with BatchFileWriter(str(tmp_path / "input"), prefix="test", compression="gzip", manifest=manifest,
+                             on_file=finished.append) as writer:
+            writer.write('{"custom_id": "test_split_0"}\n')
+            raise RuntimeError("prompt failed")
+    assert finished == []
+    assert manifest.get(writer.paths[0]) is None
+    assert writer.raw is None
@@ -0,0 +1,66 @@
+import json
+
+from langchain_core.messages import AIMessage
+
+from LLM.cache import ExtractionCache
+from LLM.chains import cached_chain
+from batch.pipeline import Pipeline
+
+
+def test_least_recently_used_entries_are_evicted(workdir):
+    cache = ExtractionCache("cache.db", max_size=100)
+    for i in range(4):
+        cache.put(f"key{i}", "x" * 30)
+    # 120 bytes, evicted down to 90 bytes from the least recently used
+    assert cache.get("key0") is None
+    assert [cache.get(f"key{i}") for i in range(1, 4)] == ["x" * 30] * 3
+    assert cache.size == 90
+
+
+def test_cache_hits_are_pinned_until_their_requests_are_cleared(workdir):
+    cache = ExtractionCache("cache.db", max_size=100)
+    cache.put("hit", "x" * 30)
+    assert cache.contains("hit")
+    cache.add_request("p_split_1", "hit", True)
+    for i in range(10):
+        cache.put(f"key{i}", "x" * 30)
+    assert cache.get("hit") == "x" * 30
+    assert dict(cache.iter_hits()) == {"p_split_1": "x" * 30}
+
+    cache.clear_requests("p_split_")
+    for i in range(10, 14):
+        cache.put(f"key{i}", "x" * 30)
+    assert cache.get("hit") is None
+
+
+def test_batch_run_backfills_cache_hits(mock_api, manifest, schema, texts):
+    cache = ExtractionCache("batch/cache.db")
+    options = dict(keys=["a"], manifest=manifest, min_interval=0.01, compression=None, index=False, cache=cache)
+    path = Pipeline(schema, **options).run(texts, prefix="p")
+    with open(path, encoding="utf-8") as f:
+        first = sorted(f, key=lambda line: json.loads(line)["custom_id"])
+    batches = len(mock_api.batches_by_id)
+    assert cache.report() == "Cache hits: 0, misses: 30 (0.0% hit rate)"
+
+    path = Pipeline(schema, **options).run(texts, prefix="p")
+    with open(path, encoding="utf-8") as f:
+        second = sorted(f, key=lambda line: json.loads(line)["custom_id"])
+    # every text is answered from the cache, nothing is requested again
+    assert len(mock_api.batches_by_id) == batches
+    assert cache.report() == "Cache hits: 30, misses: 0 (100.0% hit rate)"
+    assert second == first and len(second) == 30
+
+
+def test_cached_chain(workdir):
+    class Chain:
+        calls = 0
+
+        def invoke(self, text):
+            Chain.calls += 1
+            return AIMessage(content='```json\n{"项目编号": "' + text + '"}\n```')
+
+    cache = ExtractionCache("cache.db")
+    chain = cached_chain(Chain(), cache, "model", "system", "{text}")
+    first = chain.invoke("ZC2016-001")
+    assert chain.invoke({"text": "ZC2016-001"}).content == first.content
+    assert Chain.calls == 1
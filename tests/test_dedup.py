@@ -0,0 +1,53 @@
+import json
+
+from batch.batch_steps import step_create_batches
+from batch.dedup import deduplicate, jaccard, load_duplicates, shingles
+from batch.manifest import Manifest
+from schema.schema import Object, Text
+
+BOILERPLATE = ("根据《中华人民共和国政府采购法》等有关规定，上海市杨浦区教育局就办公家具采购项目进行公开招标，欢迎合格的供应商参加投标。"
+               "投标人须具备独立承担民事责任的能力，具有良好的商业信誉和健全的财务会计制度，参加政府采购活动前三年内，"
+               "在经营活动中没有重大违法记录。\n") * 3
+
+
+def notice(project_id: str, amount: str) -> str:
+    return (f"上海市杨浦区教育局办公家具采购项目招标公告\n项目编号：{project_id}\n预算金额：{amount}\n"
+            f"采购人：上海市杨浦区教育局\n" + BOILERPLATE)
+
+
+def test_notices_differing_in_id_and_amount_stay_separate(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    a = notice("ZC2016-0000001", "358.69万元")
+    b = notice("ZC2016-0000002", "120.00万元")
+    # the boilerplate makes them look alike
+    assert jaccard(shingles(a), shingles(b)) > 0.8
+
+    for threshold in (0.8, 0.9):
+        representatives = deduplicate({1: a, 2: b}, prefix="p", threshold=threshold)
+        assert list(representatives) == [1, 2]
+        assert load_duplicates() == {}
+
+
+def test_republished_notice_is_a_duplicate(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    original = notice("ZC2016-0000001", "358.69万元")
+    texts = {1: original, 2: notice("ZC2016-0000002", "120.00万元"), 3: "【更正公告】" + original.replace("\n", "\n  ")}
+
+    representatives = deduplicate(texts, prefix="p")
+    assert list(representatives) == [1, 2]
+    with open("batch/dedup/dedup_p.jsonl", encoding="utf-8") as f:
+        duplicates = [json.loads(line) for line in f]
+    assert [(d["custom_id"], d["representative"]) for d in duplicates] == [("p_split_000000000003",
+                                                                            "p_split_000000000001")]
+    assert duplicates[0]["similarity"] >= 0.9
+
+
+def test_duplicates_of_an_earlier_run_are_removed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    original = notice("ZC2016-0000001", "358.69万元")
+    texts = {1: original, 2: "【更正公告】" + original}
+    schema = Object([Text("项目编号", "项目编号")], prompt_system="你是一个政府采购公告的信息抽取助手。")
+    step_create_batches(texts, schema, prefix="p", dedup=0.9, manifest=Manifest("batch/manifest.db"))
+    assert load_duplicates() == {"p_split_000000000001": ["p_split_000000000002"]}
+    step_create_batches(texts, schema, prefix="p", manifest=Manifest("batch/manifest.db"))
+    assert load_duplicates() == {}
@@ -0,0 +1,64 @@
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+import pandas as pd
+
+from LLM.engine import extract_many
+from schema.schema import Object, Text
+
+
+class FakeChain:
+    """
+    Extractor chain answering with the text as 项目编号, later texts answer sooner so results complete out of order.
+    """
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def ainvoke(self, text: str):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01 / (int(text) + 1))
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("reset")
+            return SimpleNamespace(content="```json\n" + json.dumps({"项目编号": text}) + "\n```")
+        finally:
+            self.in_flight -= 1
+
+
+def test_extract_many_returns_results_in_input_order():
+    chain = FakeChain()
+    schema = Object([Text("项目编号", "项目编号")])
+    texts = [str(i) for i in range(20)]
+    results = extract_many(texts, chain, schema=schema, concurrency=4)
+    assert results == [{"项目编号": text} for text in texts]
+    assert chain.max_in_flight == 4
+
+
+def test_extract_many_retries_failed_requests():
+    chain = FakeChain(failures=2)
+    results = extract_many(["0", "1"], chain, concurrency=1, retries=2, backoff=0)
+    assert results == [{"项目编号": "0"}, {"项目编号": "1"}]
+
+    chain = FakeChain(failures=3)
+    results = extract_many(["0", "1"], chain, concurrency=1, retries=2, backoff=0)
+    assert results == [None, {"项目编号": "1"}]
+
+
+def test_extract_many_on_the_example_data():
+    class TitleChain:
+        async def ainvoke(self, text: str):
+            return SimpleNamespace(content="```json\n" + json.dumps({"项目编号": text[:20]}, ensure_ascii=False)
+                                   + "\n```")
+
+    # the texts of examples/example_single_call.py
+    df = pd.read_pickle(os.path.join(os.path.dirname(__file__), "..", "examples", "example_data.pkl"))
+    text_list = df['文本'].tolist()[70:100]
+    results = extract_many(text_list, TitleChain(), schema=Object([Text("项目编号", "项目编号")]), concurrency=8)
+    assert results == [{"项目编号": text[:20]} for text in text_list]
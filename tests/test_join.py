@@ -0,0 +1,35 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from batch.join import join_results
+from schema.schema import Number, Object, Text
+from schema.utils import normalize_amounts
+
+
+def test_normalize_amounts_keeps_numbers():
+    amounts = normalize_amounts([358.69, "350.5万元", None, "1.2亿元", "12000元", "无"])
+    np.testing.assert_allclose(amounts, [358.69, 350.5, np.nan, 12000, 1.2, np.nan])
+
+
+def test_join_normalizes_raw_amounts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "source.csv").write_text("text\na\nb\nc\nd\n", encoding="utf-8")
+    (tmp_path / "chunks").mkdir()
+    pd.DataFrame({"custom_id": [f"test_split_{i}" for i in range(4)], "path": str(tmp_path / "source.csv"),
+                  "row": range(4)}).to_csv(tmp_path / "chunks" / "index_test.csv", index=False)
+    results = [{"项目编号": "A", "预算金额": 358.69, "custom_id": "test_split_0"},
+               {"项目编号": "B", "预算金额": "350.5万元", "custom_id": "test_split_1"},
+               {"项目编号": "C", "预算金额": "1.2亿元", "custom_id": "test_split_3"}]
+    with open(tmp_path / "output.jsonl", "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(result, ensure_ascii=False) + "\n" for result in results)
+
+    schema = Object([Text("项目编号", "项目编号"), Number("预算金额", "预算金额", unit=True)])
+    paths = join_results(str(tmp_path / "output.jsonl"), schema=schema, out_dir=str(tmp_path / "joined"),
+                         index_dir=str(tmp_path / "chunks"), output_format="pkl")
+
+    frame = pd.read_pickle(paths[0])
+    assert frame["预算金额"].dtype == np.float64
+    np.testing.assert_allclose(frame["预算金额"], [358.69, 350.5, np.nan, 12000])
+    assert frame["项目编号"].isna().tolist() == [False, False, True, False]
@@ -0,0 +1,29 @@
+from batch.keys import KeyPool
+from batch.manifest import Manifest
+
+
+def test_keys_without_quota_take_turns(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = KeyPool(["a", "b", "c"], manifest=Manifest(str(tmp_path / "manifest.db")))
+    assert [pool.acquire() for _ in range(6)] == ["a", "b", "c", "a", "b", "c"]
+    pool.release("b")
+    assert pool.acquire() == "b"
+
+
+def test_full_key_is_skipped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = KeyPool({"a": 1, "b": 3}, manifest=Manifest(str(tmp_path / "manifest.db")))
+    assert [pool.acquire() for _ in range(4)] == ["a", "b", "b", "b"]
+    assert pool.acquire() is None
+    pool.release("a")
+    assert pool.acquire() == "a"
+
+
+def test_in_flight_batches_of_the_manifest_are_counted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    manifest = Manifest(str(tmp_path / "manifest.db"))
+    manifest.add_file("batch_input_test_0.jsonl", "test")
+    manifest.set_uploaded("batch_input_test_0.jsonl", "batch_0", "a")
+    pool = KeyPool({"a": 1, "b": 1}, manifest=manifest)
+    assert pool.acquire() == "b"
+    assert pool.acquire() is None
@@ -0,0 +1,36 @@
+from batch.manifest import Manifest
+
+
+def test_registering_a_file_again_keeps_its_batch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    manifest = Manifest("manifest.db")
+    manifest.add_file("batch_input_p_0.jsonl", "p", n_requests=10)
+    manifest.set_uploaded("batch_input_p_0.jsonl", "batch_0", "a")
+    manifest.set_state("batch_0", "in_progress")
+
+    manifest.add_file("batch_input_p_0.jsonl", "p", n_requests=12)
+    row = manifest.get("batch_input_p_0.jsonl")
+    assert (row["batch_id"], row["key"], row["state"], row["n_requests"]) == ("batch_0", "a", "in_progress", 12)
+    assert manifest.get_batch("batch_0")["file_path"] == "batch_input_p_0.jsonl"
+
+
+def test_registering_a_file_again_before_upload(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    manifest = Manifest("manifest.db")
+    manifest.add_file("batch_input_p_0.jsonl", "p", n_requests=10)
+    manifest.add_file("batch_input_p_0.jsonl", "p", n_requests=12, attempt=1)
+    row = manifest.get("batch_input_p_0.jsonl")
+    assert (row["batch_id"], row["state"], row["n_requests"], row["attempt"]) == (None, "created", 12, 1)
+    assert len(manifest.files()) == 1
+
+
+def test_registering_a_merged_file_again_starts_over(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    manifest = Manifest("manifest.db")
+    manifest.add_file("batch_input_p_0.jsonl", "p", n_requests=10)
+    manifest.set_uploaded("batch_input_p_0.jsonl", "batch_0", "a")
+    manifest.set_state("batch_0", "merged", output_path="output.jsonl")
+
+    manifest.add_file("batch_input_p_0.jsonl", "p", n_requests=12)
+    row = manifest.get("batch_input_p_0.jsonl")
+    assert (row["batch_id"], row["key"], row["state"], row["output_path"]) == (None, None, "created", None)
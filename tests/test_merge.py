@@ -0,0 +1,36 @@
+import json
+
+from batch.batch_steps import OutputMerger, _format_output_file, _init_merge_worker
+from batch.metrics import metrics
+from schema.schema import Object, Text
+
+
+def response_line(custom_id: str, content: str) -> str:
+    body = {"choices": [{"message": {"content": content}}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}}
+    return json.dumps({"custom_id": custom_id, "response": {"status_code": 200, "body": body}},
+                      ensure_ascii=False) + "\n"
+
+
+def test_parse_methods_are_counted_apart_from_usage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    schema = Object([Text("项目编号", "项目编号")])
+    with open("output.jsonl", "w", encoding="utf-8") as f:
+        f.write(response_line("p_split_1", '```json\n{"项目编号": "A"}\n```'))
+        f.write(response_line("p_split_2", '结果：{"项目编号": "B"}'))
+        f.write(response_line("p_split_3", '无法抽取'))
+    row = {"file_path": "input.jsonl", "output_path": "output.jsonl", "error_path": None, "attempt": 0,
+           "prefix": "p"}
+
+    _init_merge_worker(schema)
+    messages, responses, failed, succeeded, usage, methods = _format_output_file(row)
+    assert usage == {"prompt_tokens": 300, "completion_tokens": 60, "total_tokens": 360}
+    assert methods == {"parsed_fence": 1, "parsed_json": 1, "parsed_failed": 1}
+    assert failed == ["p_split_3"]
+
+    merger = OutputMerger(schema)
+    merger.add(row, (messages, responses, failed, succeeded, usage, methods))
+    assert merger.parse_summary() == "fence 1, json 1, failed 1"
+    stages = metrics.report()["stages"]
+    assert stages["parse"] == {"fence": 1, "json": 1, "failed": 1}
+    assert not any(name.startswith("parsed_") for name in stages["merge"])
@@ -0,0 +1,75 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from batch.batch_steps import format_custom_id, step_create_batches, upload_with_pool
+from batch.keys import KeyPool
+from batch.pipeline import Pipeline
+
+
+def make_pipeline(schema, manifest, **kwargs) -> Pipeline:
+    options = dict(keys=["a", "b"], manifest=manifest, min_interval=0.01, max_interval=0.05, compression=None,
+                   index=False)
+    return Pipeline(schema, **{**options, **kwargs})
+
+
+def read_output(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return {record["custom_id"]: record for record in map(json.loads, f)}
+
+
+def assert_extracted(records: dict, texts: dict):
+    assert set(records) == {"p_split_" + format_custom_id(i) for i in texts}
+    for i, text in texts.items():
+        assert records["p_split_" + format_custom_id(i)]["项目编号"] in text
+
+
+def test_run(mock_api, manifest, schema, texts):
+    pipeline = make_pipeline(schema, manifest)
+    path = pipeline.run(texts, prefix="p", max_tokens_per_file=5000)
+
+    assert_extracted(read_output(path), texts)
+    rows = manifest.files()
+    assert len(rows) > 2
+    assert {row["state"] for row in rows} == {"merged"}
+    assert {row["key"] for row in rows} == {"a", "b"}
+    assert pipeline.pool.in_flight == {"a": 0, "b": 0}
+
+
+def test_resume_in_flight_batches(mock_api, manifest, schema, texts):
+    paths = step_create_batches(texts, schema, prefix="p", max_tokens_per_file=5000, manifest=manifest,
+                                compression=None)
+    # interrupted after the first upload
+    upload_with_pool(paths[0], KeyPool(["a"], manifest=manifest), manifest=manifest)
+    assert manifest.get(paths[0])["state"] == "uploaded"
+
+    pipeline = make_pipeline(schema, manifest)
+    assert pipeline.pool.in_flight == {"a": 1, "b": 0}
+    path = pipeline.run()
+
+    assert_extracted(read_output(path), texts)
+    assert {row["state"] for row in manifest.files()} == {"merged"}
+    assert pipeline.pool.in_flight == {"a": 0, "b": 0}
+
+
+def failed_batch(batch_id: str):
+    return SimpleNamespace(id=batch_id, status="failed", output_file_id=None, error_file_id=None,
+                           request_counts=None)
+
+
+def unreachable_batch(batch_id: str):
+    raise RuntimeError("unreachable")
+
+
+@pytest.mark.parametrize("retrieve", [failed_batch, unreachable_batch])
+def test_keys_are_released_after_failed_batches(mock_api, manifest, schema, texts, retrieve, monkeypatch):
+    monkeypatch.setattr(mock_api.batches, "retrieve", retrieve)
+    pipeline = make_pipeline(schema, manifest, keys={"a": 1, "b": 1}, max_retries=0, max_poll_failures=2)
+    path = pipeline.run(texts, prefix="p", max_tokens_per_file=5000)
+
+    assert read_output(path) == {}
+    rows = manifest.files()
+    assert len(rows) > 2
+    assert {row["state"] for row in rows} == {"failed"}
+    assert pipeline.pool.in_flight == {"a": 0, "b": 0}
@@ -0,0 +1,77 @@
+import time
+from types import SimpleNamespace
+
+from langchain_core.messages import AIMessage
+
+from LLM.router import Router
+from benchmarks.corpus import answer_of
+
+
+class AnswerChain:
+    """
+    Online chain answering like the mock batch API.
+    """
+
+    def __init__(self):
+        self.texts = []
+
+    async def ainvoke(self, text: str):
+        self.texts.append(text)
+        return AIMessage(content=answer_of(text))
+
+
+def make_router(schema, **kwargs) -> Router:
+    # without deadline every document goes to the batch API
+    options = dict(schema=schema, max_online_chars=0, poll_interval=0.01, prefix="router")
+    return Router(AnswerChain(), **{**options, **kwargs})
+
+
+def test_is_online(schema):
+    router = Router(AnswerChain(), schema=schema, concurrency=2, max_online_chars=100, max_online_wait=30,
+                    batch_latency=3600, latency=10)
+    assert router.is_online("x" * 1000, deadline=time.time() + 60)
+    assert not router.is_online("x" * 1000)
+    assert router.is_online("x" * 100, queue_depth=3)
+    # four rounds of the queue, 40 seconds expected
+    assert not router.is_online("x" * 100, queue_depth=6)
+
+
+def test_route(mock_api, manifest, schema, texts):
+    # a batch of another run which must be left alone
+    manifest.add_file("batch/batch_input/batch_input_other_0.jsonl", "other")
+    manifest.set_uploaded("batch/batch_input/batch_input_other_0.jsonl", "batch-other", "key")
+
+    router = make_router(schema)
+    urgent = time.time()
+    documents = [(i, text, urgent) if i % 3 == 0 else (i, text) for i, text in texts.items()]
+    results = list(router.route(documents))
+
+    assert sorted(doc_id for doc_id, _, _ in results) == list(texts)
+    for doc_id, result, route in results:
+        assert route == ("online" if doc_id % 3 == 0 else "batch")
+        assert result["项目编号"] in texts[doc_id]
+    assert router.stats == {"online": 10, "batch": 20}
+    assert len(router.chain_extractor.texts) == 10
+    assert manifest.get_batch("batch-other")["state"] == "uploaded"
+
+
+def test_runs_do_not_share_custom_ids(mock_api, manifest, schema, texts):
+    router = make_router(schema)
+    first = dict((doc_id, result) for doc_id, result, _ in router.route(list(texts.items())[:10]))
+    second = dict((doc_id, result) for doc_id, result, _ in router.route(list(texts.items())[10:20]))
+
+    assert sorted(first) == list(range(10)) and sorted(second) == list(range(10, 20))
+    assert all(second[doc_id]["项目编号"] in texts[doc_id] for doc_id in second)
+    rows = manifest.files()
+    assert len({row["prefix"] for row in rows}) == 2
+    assert {row["state"] for row in rows} == {"merged"}
+
+
+def test_documents_of_failed_batches_have_no_result(mock_api, manifest, schema, texts, monkeypatch):
+    def retrieve(batch_id: str):
+        return SimpleNamespace(id=batch_id, status="failed", output_file_id=None, error_file_id=None)
+
+    monkeypatch.setattr(mock_api.batches, "retrieve", retrieve)
+    results = list(make_router(schema).route(list(texts.items())[:5]))
+    assert results == [(doc_id, None, "batch") for doc_id in range(5)]
+    assert {row["state"] for row in manifest.files()} == {"failed"}
@@ -0,0 +1,64 @@
+import json
+import os
+
+import pandas as pd
+
+from batch.batch_steps import format_custom_id, pre_extract, step_create_batches
+from batch.manifest import Manifest
+from schema.rules import apply_rules
+from schema.schema import Object, Text
+
+TEXTS = pd.Series({1: "项目编号：ZC2016-001，联系电话：021-65432100",
+                   2: "项目编号：ZC2016-002",
+                   3: "采购人：上海市杨浦区教育局"}, dtype=object)
+
+
+def make_schema() -> Object:
+    return Object([Text("项目编号", "项目编号", pattern=r"ZC\d{4}-\d{3}"),
+                   Text("联系电话", "联系电话", pattern=r"联系电话：(?P<phone>[\d-]+)"),
+                   Text("采购人名称", "采购人名称")],
+                  prompt_system="你是一个政府采购公告的信息抽取助手。")
+
+
+def test_apply_rules():
+    values = apply_rules(TEXTS, make_schema())
+    assert list(values.columns) == ["项目编号", "联系电话"]
+    assert values.to_dict("index") == {1: {"项目编号": "ZC2016-001", "联系电话": "021-65432100"},
+                                       2: {"项目编号": "ZC2016-002", "联系电话": None},
+                                       3: {"项目编号": None, "联系电话": None}}
+
+
+def test_pre_extract(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    groups = pre_extract(TEXTS, make_schema(), prefix="test", mode="fields")
+    with open("batch/rules/rules_test.jsonl", encoding="utf-8") as f:
+        rules = [json.loads(line) for line in f]
+    assert rules == [{"custom_id": "test_split_" + format_custom_id(1), "complete": False,
+                      "values": {"项目编号": "ZC2016-001", "联系电话": "021-65432100"}},
+                     {"custom_id": "test_split_" + format_custom_id(2), "complete": False,
+                      "values": {"项目编号": "ZC2016-002"}}]
+
+    # the whole schema first, then the unresolved fields of each document
+    assert [([field.id for field in schema.fields], list(texts.index)) for schema, texts in groups] == [
+        (["项目编号", "联系电话", "采购人名称"], [3]),
+        (["采购人名称"], [1]),
+        (["联系电话", "采购人名称"], [2])]
+
+
+def test_pre_extract_skips_complete_documents(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    schema = make_schema().subset(["项目编号", "联系电话"])
+    groups = pre_extract(TEXTS, schema, prefix="test")
+    with open("batch/rules/rules_test.jsonl", encoding="utf-8") as f:
+        rules = [json.loads(line) for line in f]
+    assert [(rule["custom_id"], rule["complete"]) for rule in rules] == [("test_split_" + format_custom_id(1), True)]
+    assert [list(texts.index) for _, texts in groups] == [[2, 3]]
+
+
+def test_rule_values_of_an_earlier_run_are_removed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    schema = make_schema()
+    step_create_batches(TEXTS, schema, prefix="test", rules="fields", manifest=Manifest("batch/manifest.db"))
+    assert os.path.exists("batch/rules/rules_test.jsonl")
+    step_create_batches(TEXTS, schema, prefix="test", manifest=Manifest("batch/manifest.db"))
+    assert not os.path.exists("batch/rules/rules_test.jsonl")
@@ -0,0 +1,29 @@
+from schema.schema import Object, Text
+from schema.utils import PARSE_FAILED, FormatterPlan, find_json_object, repair_json_object
+
+
+def make_formatter() -> FormatterPlan:
+    return FormatterPlan(Object([Text("项目编号", "项目编号"), Text("采购人名称", "采购人名称")]))
+
+
+def test_object_without_schema_fields_is_not_parsed():
+    formatter = make_formatter()
+    assert formatter.parse('text {"inner": {"a": 1}} more') == (None, PARSE_FAILED)
+
+    methods = {}
+    assert formatter('text {"inner": {"a": 1}} more', methods=methods) is None
+    assert methods == {"parsed_" + PARSE_FAILED: 1}
+
+
+def test_object_after_a_decoy_is_parsed():
+    formatter = make_formatter()
+    value, method = formatter.parse('见 {"inner": 1}，结果 {"项目编号": "ZC2016-001"}')
+    assert (value, method) == ({"项目编号": "ZC2016-001"}, "json")
+
+    value, method = formatter.parse('见 {"inner": 1}，结果 {"项目编号": "ZC2016-001", "采购人名称": "上海')
+    assert (value, method) == ({"项目编号": "ZC2016-001"}, "repair")
+
+
+def test_without_keys_any_object_is_found():
+    assert find_json_object('text {"inner": {"a": 1}} more') == {"inner": {"a": 1}}
+    assert repair_json_object('{"a": "1", "b": ["x", "y') == {"a": "1", "b": ["x"]}